@@ -0,0 +1,268 @@
+"""
+Benchmarks of the acquisition to analysis pipeline against the simulated mock station
+
+    python -m benchmarks.bench_pipeline --output bench.json
+    python -m benchmarks.bench_pipeline --quick --output new.json --compare bench.json
+
+Times generate_config and reload_config for 1-50 qubits, building the QUA program of every
+experiment, QTLQMExperiment.run, FileSystemDB.save_data/load_result and every analyze_data at
+several sizes. Results are stored as JSON, comparing against an earlier file reports regressions.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from qtl_control.qtl_station import QTLStation, ReadoutDisc
+from qtl_control.qtl_station.station import MockResHandles
+from qtl_control.qtl_station.qm_config import generate_config
+from qtl_control.qtl_experiments import QTLQMExperiment, ExperimentResult, experiments_dict
+from qtl_control.qtl_experiments.database import FileSystemDB
+
+
+QUBIT_COUNTS = [1, 5, 10, 20, 50]
+# Number of points for averaged experiments and number of shots for single shot experiments
+SIZES = [100, 10_000, 1_000_000]
+SINGLE_SHOT_SIZES = [1_000, 100_000, 10_000_000]
+
+
+def make_station_config(n_qubits):
+    return {
+        "QMManager": {
+            "host": None,
+            "port": None,
+            "cluster_name": None,
+            "mock": True,
+            "simulate": {"seed": 0},
+            "channels": {
+                "RF_in": ["RF_1_in"],
+                "RF_out": ["RF1", "RF2", "RF3", "RF4", "RF5"],
+                "analog_out": [f"AO{i}" for i in range(1, 11)],
+            },
+        },
+        "cryostat": {
+            "PL_in": "RF1",
+            "PL_out": "RF_1_in",
+        } | {
+            f"D{i}": f"RF{2 + i % 4}" for i in range(n_qubits)
+        } | {
+            f"F{i}": f"AO{1 + i % 10}" for i in range(n_qubits)
+        },
+        "chip": {
+            f"Q{i}": {"drive": f"D{i}", "flux": f"F{i}"} for i in range(n_qubits)
+        } | {
+            "PL": {"input": "PL_in", "output": "PL_out"},
+        },
+    }
+
+
+def make_station(n_qubits):
+    station = QTLStation(make_station_config(n_qubits))
+    for qubit in station.qubit_config.values():
+        # Settings some of the experiments read that are not part of TransmonQubit yet
+        qubit.X180_amplitude = 0.4
+        qubit.drag_coef = 0.0
+        qubit.readout_discriminator = ReadoutDisc(0, 1)
+    return station
+
+
+def point_sweeps(name, points):
+    """
+    Sweeps with about the given number of points for each experiment, and the Navg to run with
+    """
+    side = max(int(np.sqrt(points)), 2)
+    frequencies = np.linspace(5.79e9, 5.81e9, points)
+    return {
+        "QM-QubitSpectroscopy": ([frequencies], {}),
+        "QM-FluxQubitSpectroscopy": ([np.linspace(-0.5, 0.5, side), np.linspace(5.79e9, 5.81e9, side)], {}),
+        "QM-Rabi": ([np.linspace(0, 1, points)], {}),
+        "QM-TimeRabi": ([np.arange(4, 4 * (points + 1), 4)], {}),
+        "QM-Ramsey2F": ([np.array([-1e6, 1e6]), np.arange(16, 16 + 4 * (points // 2), 4)], {}),
+        "QM-T1": ([np.arange(16, 16 + 4 * points, 4)], {}),
+        "QM-ErrorRabi": ([np.linspace(0.3, 0.5, side), np.arange(1, side + 1)], {}),
+        "QM-DragCalibration": ([np.linspace(-1, 1, points // 2), np.array([0, 1])], {}),
+        "QM-DragCalibrationErrorAmp": ([np.linspace(-1, 1, side), np.arange(1, side + 1)], {}),
+        "QM-AllXY": ([], {}),
+        "QM-ReadoutResonatorSpectroscopy": ([frequencies], {}),
+        "QM-ReadoutFluxSpectroscopy": ([np.linspace(-0.5, 0.5, side), np.linspace(5.79e9, 5.81e9, side)], {}),
+        "QM-PunchOut": ([np.linspace(5.79e9, 5.81e9, side), np.linspace(0.05, 0.5, side)], {}),
+        "QM-DispersiveShift": ([np.linspace(5.79e9, 5.81e9, points // 2), np.array(["ground", "excited"])], {}),
+        "QM-SQRB": ([np.linspace(1, 200, min(points, 20)).astype(int)], {}),
+    }.get(name)
+
+
+def shot_sweeps(name, shots):
+    if name == "QM-SingleShotReadout":
+        Navg = shots // 2
+        return [np.arange(Navg), np.array(["ground", "excited"])], {"Navg": Navg}
+    if name == "QM-ReadoutOptimization":
+        Navg = max(shots // 40, 1)
+        return [np.linspace(5.79e9, 5.81e9, 5), np.linspace(0.05, 0.2, 4)], {"Navg": Navg}
+
+
+def get_sweeps(name, size, single_shot):
+    sweeps = shot_sweeps(name, size) if single_shot else point_sweeps(name, size)
+    if sweeps is None:
+        return None
+    sweeps, run_kwargs = sweeps
+    return [sweeps, run_kwargs | {"Navg": run_kwargs.get("Navg", 16)}]
+
+
+def timeit(function, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+        plt.close("all")
+    return {"min": min(times), "mean": sum(times) / len(times), "repeats": repeats}
+
+
+def record(results, key, function, repeats=3):
+    try:
+        results[key] = timeit(function, repeats)
+        print(f"{key}: {results[key]['min']:.4g} s")
+    except Exception as e:
+        results[key] = {"error": f"{type(e).__name__}: {e}"}
+        print(f"{key}: failed with {results[key]['error']}")
+
+
+def bench_config(results):
+    for n_qubits in QUBIT_COUNTS:
+        station = make_station(n_qubits)
+        elements = list(station.qubit_config.keys())
+        pulses = {element: station.config[element].pulses for element in elements}
+
+        record(results, f"generate_config/{n_qubits}_qubits", lambda: generate_config(
+            elements,
+            station.rf_output_channels,
+            station.rf_input_channels,
+            station.analog_output_channels,
+            station.qubit_config,
+            pulses,
+        ))
+
+        def reload_changed():
+            station.config[elements[0]].drive.gain = -20 if station.config[elements[0]].drive.gain != -20 else -19
+            station.reload_config(elements)
+        record(results, f"reload_config/{n_qubits}_qubits/unchanged", lambda: station.reload_config(elements))
+        record(results, f"reload_config/{n_qubits}_qubits/live", reload_changed)
+        record(results, f"reload_config/{n_qubits}_qubits/reopen", lambda: station.reload_config(elements, force=True))
+
+
+def bench_experiments(results, sizes, single_shot_sizes, db):
+    station = make_station(1)
+    QTLQMExperiment.station = station
+    ExperimentResult.db = db
+    station.reload_config(["Q0"])
+
+    for name, experiment_class in experiments_dict.items():
+        experiment = experiment_class()
+        single_shot = shot_sweeps(name, 2) is not None
+        bench_sizes = single_shot_sizes if single_shot else sizes
+
+        sweeps, run_kwargs = get_sweeps(name, bench_sizes[0], single_shot)
+        run_kwargs = dict(run_kwargs)
+        Navg = run_kwargs.pop("Navg")
+        full_sweeps = experiment.complete_sweeps(sweeps, Navg, **run_kwargs)
+        cache_size = station.program_cache.max_size
+        station.program_cache.max_size = 0
+        record(results, f"build_program/{name}", lambda: experiment.build_program("Q0", Navg, full_sweeps, **run_kwargs))
+        station.program_cache.max_size = cache_size
+        record(results, f"build_program_cached/{name}", lambda: experiment.build_program("Q0", Navg, full_sweeps, **run_kwargs))
+
+        for size in bench_sizes:
+            sweeps, run_kwargs = get_sweeps(name, size, single_shot)
+            exp_res = None
+
+            def run():
+                nonlocal exp_res
+                exp_res = experiment.run("Q0", sweeps, autosave=False, **run_kwargs)
+            record(results, f"run/{name}/{size}", run, repeats=1)
+            if exp_res is None:
+                continue
+
+            record(results, f"save_data/{name}/{size}", exp_res.save, repeats=1)
+            record(results, f"load_result/{name}/{size}", lambda: db.load_result(exp_res.id).data.load(), repeats=1)
+
+            if hasattr(experiment, "analyze_data"):
+                record(results, f"analyze/{name}/{size}", exp_res.analyze, repeats=1)
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None or "min" not in old or "min" not in result:
+            continue
+        if result["min"] > threshold * old["min"]:
+            regressions.append(key)
+            print(f"Regression {key}: {old['min']:.4g} s -> {result['min']:.4g} s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--compare", default=None, help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    parser.add_argument("--quick", action="store_true", help="skip the largest sizes")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    sizes = SIZES[:-1] if args.quick else SIZES
+    single_shot_sizes = SINGLE_SHOT_SIZES[:-1] if args.quick else SINGLE_SHOT_SIZES
+    MockResHandles.mock_data = [np.zeros(1), np.zeros(1), 0]
+
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The station and DB write files to the working directory
+        os.chdir(tmp_dir)
+        try:
+            db = FileSystemDB("bench_db", tmp_dir + "/")
+            bench_config(results)
+            bench_experiments(results, sizes, single_shot_sizes, db)
+        finally:
+            os.chdir(cwd)
+
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+
+    with open(output, "w+") as f:
+        json.dump({
+            "meta": {
+                "timestamp": time.strftime(r"%Y-%m-%d-%H-%M-%S"),
+                "revision": revision,
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "sizes": sizes,
+                "single_shot_sizes": single_shot_sizes,
+            },
+            "results": results,
+        }, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if baseline is not None and compare(results, baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,6 @@
-from .experiment import QTLQMExperiment, ExperimentResult
+from .experiment import QTLQMExperiment, ExperimentResult, run_merged
+from .metrics import RunMetrics, MetricsLog, JSONLinesSink
+from .runtime import RuntimeModel, plan_campaign, run_plan
 from .qubit_experiments import (
     QubitSpectroscopy,
     FluxQubitSpectrsocopy,
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def estimate_snr(iq):
+    """
+    Signal to noise ratio of averaged data, the signal is the largest deviation from the median and
+    the noise of each quadrature is estimated from the second differences along the last sweep
+    """
+    iq = np.asarray(iq)
+    if iq.shape[-1] < 3:
+        return 0.0
+
+    second_differences = np.diff(iq, n=2, axis=-1)
+    # Var of a second difference is 6 sigma^2 per quadrature
+    noise = np.sqrt(np.mean(np.abs(second_differences) ** 2) / 12)
+    signal = np.max(np.abs(iq - (np.median(iq.real) + 1.j * np.median(iq.imag))))
+    return signal / noise if noise > 0 else np.inf
+
+
+class TargetSNR:
+    """
+    Converged once the SNR of the averaged data reaches snr, see estimate_snr
+    """
+    def __init__(self, snr):
+        self.snr = snr
+
+    def __call__(self, experiment, data):
+        return estimate_snr(data["iq"].values) >= self.snr
+
+
+class FitConverged:
+    """
+    Converged once the standard error of a parameter from experiment.fit_parameters is below
+    rel_error of its value, or below abs_error. Experiments that support it define fit_parameters(data,
+    **fit_kwargs) giving {parameter: (value, standard error)}, fit_kwargs like initial guesses go to it
+    """
+    # The experiment hook the criterion needs, checked before the run
+    requires = "fit_parameters"
+
+    def __init__(self, parameter, rel_error=None, abs_error=None, **fit_kwargs):
+        self.parameter = parameter
+        self.rel_error = rel_error
+        self.abs_error = abs_error
+        self.fit_kwargs = fit_kwargs
+
+    def __call__(self, experiment, data):
+        try:
+            value, error = experiment.fit_parameters(data, **self.fit_kwargs)[self.parameter]
+        except (RuntimeError, ValueError): # The fit fails on the noisy first averages
+            return False
+
+        if not np.isfinite(error):
+            return False
+        if self.rel_error is not None and error <= self.rel_error * abs(value):
+            return True
+        return self.abs_error is not None and error <= self.abs_error
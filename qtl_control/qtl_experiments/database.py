@@ -41,7 +41,14 @@ class FileSystemDB:
         with open(self.db_path + "/id.txt", "w+") as f:
             f.write(str(self.current_id))
         
-        data.to_netcdf(f"{self.db_path}/{filename}", auto_complex=True)
+        # Written aside and moved in place, a crash never leaves a half written file under the ID
+        data.to_netcdf(f"{self.db_path}/.{filename}", auto_complex=True)
+        os.replace(f"{self.db_path}/.{filename}", f"{self.db_path}/{filename}")
+
+        if overwrite_id is not None: # Only the latest file of an ID is kept
+            for file in fnmatch.filter(os.listdir(self.db_path), f"{save_as_id}_*"):
+                if file != filename:
+                    os.remove(f"{self.db_path}/{file}")
 
         return save_as_id
 
@@ -1,12 +1,24 @@
+import copy
 import json
 
 import numpy as np
 import xarray as xr
 import matplotlib.pyplot as plt
 
+from contextlib import ExitStack, closing, contextmanager
 from inspect import signature, _empty
 
-from qtl_control.qtl_experiments.utils import ReadoutType
+from qm.qua import (
+    program, declare, declare_stream, declare_input_stream, advance_input_stream, fixed, for_, infinite_loop_,
+    assign, align, save, stream_processing, FUNCTIONS
+)
+from qtl_control.qtl_experiments.utils import (
+    ReadoutType, standard_readout, discrimination_weights, histogram_grid, qua_state, qua_histogram_bin,
+    qua_active_reset, save_reset_rounds
+)
+from qtl_control.qtl_experiments.metrics import RunMetrics
+from qtl_control.qtl_experiments.runtime import RuntimeModel
+from qtl_control.qtl_experiments.sweeps import loop_order, qua_loop, STATES
 
 class ExperimentResult:
     def __init__(self, data, experiment, existing_id=None):
@@ -15,12 +27,32 @@ class ExperimentResult:
         self.id = existing_id
 
     def analyze(self, **kwargs):
+        if "element" in self.data.dims: # Multiplexed, analyze each element
+            analysis_result = dict()
+            for element in self.data.coords["element"].values:
+                analysis_result |= self.for_element(element).analyze(**kwargs) or dict()
+            return analysis_result
+
         return self.experiment.analyze_data(self, **kwargs)
 
+    def for_element(self, element):
+        """
+        The result of one element of a multiplexed run
+        """
+        data = self.data.sel(element=element, drop=True)
+        data.attrs["element"] = str(element)
+        return ExperimentResult(data, self.experiment, self.id)
+
     def save(self):
         self.id = self.db.save_data(self.experiment.experiment_name, self.data, overwrite_id=self.id)
         print(f"Saved with ID {self.id}")
 
+    def resume(self, autosave=True):
+        """
+        Continue a checkpointed run from this result, see QTLQMExperiment.run_checkpointed
+        """
+        return self.experiment.resume(self, autosave=autosave)
+
     def get_title(self):
         return f"{self.id}_{self.experiment.experiment_name}_{self.data.attrs["element"]}"
 
@@ -70,12 +102,30 @@ class QTLQMExperiment:
     """
     station = None
     readout_type = ReadoutType.average # default
+    # Callable getting a dict with the stage timings etc. of every run, see metrics.py
+    metrics_sink = None
+    # Correction of the estimated durations learned from the runs, see runtime.py
+    runtime_model = RuntimeModel()
+    # wait_after is the wait for the qubit to decay, station.repetition_T1s x T1 by default, see with_repetition_delay
+    decay_wait = True
+    # Bins of I and Q, and half width in V, of ReadoutType.histogram runs, see utils.histogram_grid
+    histogram_bins = 32
+    histogram_range = None
+
+    def __init__(self, readout_type=None, histogram_bins=None, histogram_range=None):
+        # Single shot experiments can discriminate on the controller with the state or histogram readout_type
+        if readout_type is not None and readout_type.discriminated:
+            if self.readout_type != ReadoutType.single_shot or self.sweep_spec() is None:
+                raise ValueError(f"{self.experiment_name} can not discriminate on the controller")
+        self.readout_type = readout_type or self.readout_type
+        self.histogram_bins = histogram_bins or self.histogram_bins
+        self.histogram_range = histogram_range or self.histogram_range
 
     def hidden_sweeps(self, **kwargs):
         return dict()
 
-    def run(self, element, sweeps=None, Navg=1024, autosave=True, **kwargs):
-        sweeps = sweeps or []
+    def complete_sweeps(self, sweeps, Navg, **kwargs):
+        sweeps = list(sweeps or [])
         for index, sweep in self.hidden_sweeps(Navg=Navg, **kwargs).items():
             sweeps.insert(index, sweep)
         
@@ -85,29 +135,985 @@ class QTLQMExperiment:
             print("Hidden sweeps:", self.hidden_sweeps(Navg=Navg, **kwargs))
             return
 
-        program = self.get_program(element, Navg, sweeps, **kwargs)
-        results = self.station.execute(element, program, Navg, readout_type=self.readout_type)
+        return sweeps
 
-        run_kwargs = {
+    def get_run_kwargs(self, **kwargs):
+        return {
             k: v.default for k, v in signature(self.get_program).parameters.items() if v.default is not _empty
         } | kwargs
 
-        sweep_labels = [sl[0] for sl in self.sweep_labels()]
+    def with_repetition_delay(self, element, kwargs):
+        """
+        The run kwargs with wait_after station.repetition_T1s x T1 of the qubits (the longest for multiplexed runs),
+        unless wait_after is given, no T1 is known or the experiment does not wait for the qubit to decay
+        """
+        if not self.decay_wait or "wait_after" in kwargs or "wait_after" not in self.get_run_kwargs():
+            return kwargs
+
+        elements = element if type(element) is list else [element]
+        T1s = [self.station.config[el].T1 for el in elements]
+        if any(T1 is None for T1 in T1s):
+            return kwargs
+        # In ns, a multiple of the 4 ns clock cycle
+        return kwargs | {"wait_after": 4 * int(np.ceil(self.station.repetition_T1s * max(T1s) * 1e9 / 4))}
+
+    def pulse_length(self, element, pulse):
+        # In ns, the default pulses are 100 ns
+        pulses = self.station.config[element].pulses or dict()
+        return len(pulses[pulse][0]) if pulse in pulses else 100
+
+    def drive_duration(self, element, sweeps, run_kwargs):
+        """
+        Mean time in ns of a shot before the readout, given the dict of sweep values by label, the programs
+        give QUA durations and waits in 4 ns clock cycles. By default an x180, the mean of a "time" sweep
+        and the 400 ns wait before the readout, with a state sweep only the excited points drive.
+        """
+        delay = np.mean(sweeps["time"]) if "time" in sweeps else 0
+        excited = np.mean(np.asarray(sweeps["state"]) == STATES[1]) if "state" in sweeps else 1
+        return excited * (self.pulse_length(element, "x180") + 400) + delay
+
+    def shot_duration(self, element, sweeps, run_kwargs):
+        """
+        Mean time in ns of one shot, the drive_duration, readout_len and wait_after. With active_reset
+        the readout and every reset round wait reset_wait, half the shots need a round with an x180.
+        """
+        drive = self.drive_duration(element, sweeps, run_kwargs)
+        readout_len = self.station.config[element].readout_len
+        if run_kwargs.get("active_reset"):
+            x180s = 0.5
+            reset_wait = run_kwargs.get("reset_wait", 1000)
+            return drive + (readout_len + reset_wait) * (2 + x180s) + self.pulse_length(element, "x180") * x180s
+        return drive + readout_len + run_kwargs.get("wait_after", 0)
+
+    def drive_durations(self, element, sweeps, run_kwargs):
+        # The drive_duration of every element, given the sweeps in the order of the sweep_labels
+        sweeps = dict(zip([sl[0] for sl in self.sweep_labels()], sweeps))
+        elements = element if type(element) is list else [element]
+        return {el: float(self.drive_duration(el, sweeps, run_kwargs)) for el in elements}
+
+    def estimate_duration(self, element, Navg, sweeps, run_kwargs):
+        """
+        Hardware time of a run in seconds, Navg x sweep points x shot_duration. Multiplexed
+        elements run in parallel, timed as the slowest one.
+        """
+        sweeps = dict(zip([sl[0] for sl in self.sweep_labels()], sweeps))
+        # Single shot experiments sweep the averaging iteration
+        points = np.prod([len(values) for label, values in sweeps.items() if label != "iteration"])
+        elements = element if type(element) is list else [element]
+        return float(Navg * points * max(self.shot_duration(el, sweeps, run_kwargs) for el in elements) * 1e-9)
+
+    def estimate_runtime(self, element=None, sweeps=None, Navg=1024, elements=None, **kwargs):
+        """
+        Expected time in seconds of a run with the same arguments, from estimate_duration and the
+        correction runtime_model learned from the measured runs of the experiment
+        """
+        element = elements or element
+        sweeps = self.complete_sweeps(sweeps, Navg, **kwargs)
+        if sweeps is None:
+            return
+
+        run_kwargs = self.get_run_kwargs(**self.with_repetition_delay(element, kwargs))
+        return self.estimate_duration(element, Navg, sweeps, run_kwargs) * self.runtime_model.correction(self.experiment_name)
+
+    def sweep_spec(self):
+        """
+        The [Sweep, ...] describing the sweeps in the order of the dataset dimensions, see sweeps.py.
+        Experiments with a spec get their sweep_labels, program, multiplexed and streamed programs from it.
+        """
+        return None
+
+    def sweep_labels(self):
+        return [(sweep.label, sweep.unit) for sweep in self.sweep_spec()]
+
+    def loop_order(self):
+        return loop_order(self.sweep_spec())
+
+    def loop_sweeps(self, elements, sweeps):
+        """
+        The [(Sweep, QUA values), ...] of the QUA loops, outermost first
+        """
+        spec = self.sweep_spec()
+        loops = []
+        for index in self.loop_order():
+            if spec[index].averaging:
+                continue
+            values = [spec[index].qua_values(sweeps[index], element) for element in elements]
+            if any(not np.array_equal(values[0], other) for other in values[1:]):
+                raise ValueError(f"Sweep {spec[index].label} loops over different values for {elements}, run them separately")
+            loops.append((spec[index], values[0]))
+        return loops
+
+    def qua_shot(self, element, variables, **kwargs):
+        """
+        The QUA of one shot on an element before the readout, given the dict of sweep variables by label
+        """
+        pass
+
+    def qua_readout(self, element, variables, I, I_stream, Q, Q_stream, wait_after=0, **kwargs):
+        standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
+
+    def qua_point(self, elements, variables, IQ, IQ_streams, run_kwargs):
+        """
+        One shot of every element, with the resonators read out at the same time
+        """
+        for element in elements:
+            self.qua_shot(element, variables, **run_kwargs)
+
+        align(*[f"drive_{element}" for element in elements], *[f"resonator_{element}" for element in elements])
+        for element in elements:
+            self.qua_readout(
+                element, variables,
+                IQ[element][0], IQ_streams[element][0], IQ[element][1], IQ_streams[element][1],
+                **run_kwargs
+            )
+
+    def discriminator(self, element):
+        config = self.station.config[element]
+        if config.readout_discriminator is None:
+            raise ValueError(f"{element} has no readout_discriminator to discriminate on the controller")
+        return config.readout_discriminator
+
+    def qua_state(self, element, I, Q, stream):
+        """
+        Discriminate the shot of an element on the controller with its readout_discriminator and save the state
+        """
+        config = self.station.config[element]
+        qua_state(I, Q, discrimination_weights(self.discriminator(element), config.readout_len), stream)
+
+    def qua_active_reset(self, element, I, Q, rounds, rounds_stream, reset_rounds=4, reset_wait=1000, **kwargs):
+        """
+        Reset the qubit of an element to the ground state after a shot, measuring it with its readout_discriminator
+        and playing an x180 while it is excited, at most reset_rounds times. Runs with active_reset=True
+        do this in place of the wait_after for the qubit to decay, the readouts only wait reset_wait
+        for the resonator to deplete. The number of x180 of every shot is saved to rounds_stream.
+        """
+        config = self.station.config[element]
+        if config.readout_discriminator is None:
+            raise ValueError(f"{element} has no readout_discriminator for active reset")
+
+        weights = discrimination_weights(config.readout_discriminator, config.readout_len)
+        qua_active_reset(element, weights, I, Q, rounds, rounds_stream, reset_rounds, reset_wait)
+
+    def histogram_grid(self, element):
+        config = self.station.config[element]
+        return histogram_grid(config.readout_discriminator, config.readout_len, self.histogram_bins, self.histogram_range)
+
+    def program_settings(self, element):
+        """
+        Settings outside of the run kwargs and the QM config that change the program, for the program cache
+        """
+        # Discriminated runs and active resets discriminate with the readout_discriminator
+        elements = element if type(element) is list else [element]
+        discriminators = [self.station.config[el].readout_discriminator for el in elements]
+        return [self.readout_type.name, self.histogram_bins, self.histogram_range, [
+            None if disc is None else [disc.param_0, disc.param_1] for disc in discriminators
+        ]]
+
+    def loop_values(self, element, sweeps):
+        """
+        The QUA values of the sweeps of every element, for the program cache
+        """
+        if self.sweep_spec() is None:
+            return []
+        elements = element if type(element) is list else [element]
+        return [
+            spec.qua_values(values, el) for spec, values in zip(self.sweep_spec(), sweeps) if not spec.averaging
+            for el in elements
+        ]
+
+    def supports_multiplexing(self):
+        return self.sweep_spec() is not None
+
+    def supports_active_reset(self):
+        # Programs from the sweep spec reset in qua_active_reset, hand-written ones take active_reset themselves
+        return self.sweep_spec() is not None or "active_reset" in signature(self.get_program).parameters
+
+    def prepare(self, elements):
+        """
+        Settings to change on the elements before building the program
+        """
+        pass
+
+    def get_sweep_program(self, element, Navg, sweeps, **kwargs):
+        """
+        The program of the experiment on one element built from the sweep_spec
+        """
+        if self.readout_type == ReadoutType.histogram:
+            return self.get_histogram_program(element, Navg, sweeps, **kwargs)
+        return get_merged_program([(self, [element], sweeps, self.get_run_kwargs(**kwargs))], Navg, single_element=True)
+
+    def get_histogram_program(self, element, Navg, sweeps, **kwargs):
+        """
+        The ReadoutType.histogram program of the experiment on one element. Every sweep point runs its Navg
+        shots in a row, counting their IQ bins in an array of histogram_bins^2 on the controller, and saves
+        the counts once. The program and the stream processing do not grow with the number of bins.
+        """
+        run_kwargs = self.get_run_kwargs(**kwargs)
+        if run_kwargs.get("active_reset"): # The readouts only wait for the resonators to deplete
+            run_kwargs = run_kwargs | {"wait_after": run_kwargs.get("reset_wait", 1000)}
+        loops = self.loop_sweeps([element], sweeps)
+        bins = self.histogram_bins
+        grid = histogram_grid(self.discriminator(element), self.station.config[element].readout_len, bins, self.histogram_range)
+
+        with program() as histogram_program:
+            n, k, index = declare(int), declare(int), declare(int)
+            counts = declare(int, size=bins * bins)
+            counts_stream = declare_stream()
+            variables = {sweep.label: declare(sweep.qua_type) for sweep, _ in loops}
+            I, Q = declare(fixed), declare(fixed)
+            rounds, rounds_stream = declare(int), declare_stream()
+
+            with for_(k, 0, k < bins * bins, k + 1):
+                assign(counts[k], 0)
+            with ExitStack() as sweep_loops:
+                for sweep, values in loops:
+                    sweep_loops.enter_context(qua_loop(variables[sweep.label], values))
+                    sweep.apply_to([element], variables[sweep.label])
+
+                with for_(n, 0, n < Navg, n + 1):
+                    self.qua_point([element], variables, {element: (I, Q)}, {element: (None, None)}, run_kwargs)
+                    qua_histogram_bin(I, Q, grid, bins, index)
+                    assign(counts[index], counts[index] + 1)
+                    if run_kwargs.get("active_reset"):
+                        self.qua_active_reset(element, I, Q, rounds, rounds_stream, **run_kwargs)
+
+                with for_(k, 0, k < bins * bins, k + 1):
+                    save(counts[k], counts_stream)
+                    assign(counts[k], 0)
+
+            with stream_processing():
+                stream = counts_stream.buffer(bins * bins)
+                for _, values in reversed(loops):
+                    stream = stream.buffer(len(values))
+                stream.save("histogram")
+                if run_kwargs.get("active_reset"):
+                    save_reset_rounds(rounds_stream, "reset", run_kwargs.get("reset_rounds", 4))
+
+        return histogram_program
+
+    def get_multiplexed_program(self, elements, Navg, sweeps, **kwargs):
+        """
+        One program running the experiment on all elements in parallel, with the resonators read out
+        at the same time (frequency multiplexed on the probe line). Built from the sweep_spec,
+        the results of each element are saved to the I_{element} and Q_{element} streams.
+        """
+        return get_merged_program([(self, elements, sweeps, self.get_run_kwargs(**kwargs))], Navg)
+
+    def get_streamed_program(self, elements, Navg, sweeps, streamed_params=(), **kwargs):
+        """
+        A long-lived program of the experiment on the elements, that takes the QUA values of every sweep
+        from the sweep_{label} input streams and the streamed_params kwargs from input streams of their name.
+        For every push of all the input streams it runs Navg averages and saves the averaged results
+        of each element to the I_{element} and Q_{element} streams, one record per push.
+        Built from the sweep_spec, the sweep lengths are fixed by the given sweeps.
+        """
+        run_kwargs = self.get_run_kwargs(**kwargs)
+        loops = self.loop_sweeps(elements, sweeps)
+
+        with program() as streamed_program:
+            n = declare(int)
+            sweep_inputs = {
+                sweep.label: declare_input_stream(sweep.qua_type, name=f"sweep_{sweep.label}", size=len(values))
+                for sweep, values in loops
+            }
+            param_inputs = {
+                name: declare_input_stream(int if type(run_kwargs[name]) is int else fixed, name=name)
+                for name in streamed_params
+            }
+            indices = {sweep.label: declare(int) for sweep, _ in loops}
+            variables = {sweep.label: declare(sweep.qua_type) for sweep, _ in loops}
+            IQ = {element: (declare(fixed), declare(fixed)) for element in elements}
+            IQ_streams = {element: (declare_stream(), declare_stream()) for element in elements}
+
+            with infinite_loop_():
+                for input_stream in list(sweep_inputs.values()) + list(param_inputs.values()):
+                    advance_input_stream(input_stream)
+
+                with for_(n, 0, n < Navg, n + 1):
+                    with ExitStack() as sweep_loops:
+                        for sweep, values in loops:
+                            index = indices[sweep.label]
+                            sweep_loops.enter_context(for_(index, 0, index < len(values), index + 1))
+                            assign(variables[sweep.label], sweep_inputs[sweep.label][index])
+                            sweep.apply_to(elements, variables[sweep.label])
+
+                        self.qua_point(elements, variables, IQ, IQ_streams, run_kwargs | param_inputs)
+
+            with stream_processing():
+                for element in elements:
+                    for name, stream in zip([f"I_{element}", f"Q_{element}"], IQ_streams[element]):
+                        for _, values in reversed(loops):
+                            stream = stream.buffer(len(values))
+                        stream.buffer(Navg).map(FUNCTIONS.average(0)).save_all(name)
+
+        return streamed_program
+
+    def run_streamed(self, element, sweeps=None, Navg=1024, autosave=True, streamed_params=(), **kwargs):
+        """
+        Start a long-lived job of the experiment, compiled once, for a with block giving its StreamedRun.
+        Every StreamedRun.run gives a result for new sweep values (of the same lengths) and new values
+        of the streamed_params kwargs, at the speed of the loop instead of the compilation. The job
+        holds the QM until the end of the with block.
+        """
+        if not self.supports_multiplexing() or self.readout_type != ReadoutType.average:
+            print(f"{self.experiment_name} does not support streamed runs")
+            return
+
+        sweeps = self.complete_sweeps(sweeps, Navg, **kwargs)
+        if sweeps is None:
+            return
+
+        return self.streamed_run(element, Navg, sweeps, streamed_params, autosave, kwargs)
+
+    @contextmanager
+    def streamed_run(self, element, Navg, sweeps, streamed_params, autosave, kwargs):
+        streamed = StreamedRun(self, element, Navg, sweeps, streamed_params, autosave, kwargs)
+        with self.station.streamed_job(streamed.program) as streamed.job:
+            yield streamed
+
+    def describe_run(self, element, Navg, sweeps, run_kwargs):
+        # Description of the run put on the program, used by the simulated backend
+        return {
+            "experiment": self.experiment_name,
+            "element": element,
+            "Navg": Navg,
+            "sweeps": sweeps,
+            "sweep_labels": [sl[0] for sl in self.sweep_labels()],
+            "readout_type": self.readout_type,
+            "run_kwargs": run_kwargs,
+            "loop_order": self.loop_order() if self.sweep_spec() is not None else None,
+            "histogram_bins": self.histogram_bins,
+            "histogram_range": self.histogram_range,
+            "drive_duration": self.drive_durations(element, sweeps, run_kwargs),
+            "estimated_duration": self.estimate_duration(element, Navg, sweeps, run_kwargs),
+        }
+
+    def build_program(self, element, Navg, sweeps, metrics=None, **kwargs):
+        """
+        Build the QUA program, for a list of elements the multiplexed program
+        """
+        metrics = metrics or RunMetrics()
+        self.prepare(element if type(element) is list else [element])
+        kwargs = self.with_repetition_delay(element, kwargs)
+        with metrics.stage("signature"):
+            run_kwargs = self.get_run_kwargs(**kwargs)
+
+        with metrics.stage("get_program"):
+            cache = self.station.program_cache
+            key = cache.make_key(self, element, Navg, sweeps, run_kwargs, self.station.qm_structure_hash)
+            program = cache.get_program(key)
+            if program is not None:
+                metrics.add("program_cache_hits", 1)
+            else:
+                if type(element) is list:
+                    program = self.get_multiplexed_program(element, Navg, sweeps, **kwargs)
+                else:
+                    program = self.get_program(element, Navg, sweeps, **kwargs)
+                cache.put_program(key, program)
+        # The cached program is shared by the runs, the run description goes on a copy
+        program = copy.copy(program)
+        program.qtl_cache_key = key
+
+        program.qtl_run = self.describe_run(element, Navg, sweeps, run_kwargs)
+        metrics.add("estimated_duration", program.qtl_run["estimated_duration"])
+        return program
+
+    def make_dataset(self, element, sweeps, results, metrics=None, **kwargs):
+        metrics = metrics or RunMetrics()
+        with metrics.stage("signature"):
+            run_kwargs = self.get_run_kwargs(**self.with_repetition_delay(element, kwargs))
+
+        if self.readout_type.discriminated:
+            with metrics.stage("dataset"):
+                return self.make_discriminated_dataset(element, sweeps, results, run_kwargs)
+
+        with metrics.stage("dataset"):
+            sweep_labels = [sl[0] for sl in self.sweep_labels()]
+            coords = {sweep_label: values for sweep_label, values in zip(sweep_labels, sweeps)}
+            if self.sweep_spec() is not None:
+                # The results come in the order of the QUA loops, back to the order of the sweeps
+                axes = list(np.argsort(self.loop_order()))
+                if type(element) is list:
+                    axes = [0] + [axis + 1 for axis in axes]
+                results = np.transpose(results, axes)
+            if type(element) is list: # Multiplexed
+                sweep_labels = ["element"] + sweep_labels
+                coords["element"] = element
+
+            ds = xr.Dataset(
+                data_vars={"iq": (sweep_labels, results)},
+                coords=coords,
+                attrs={"element": element if type(element) is str else ",".join(element), "run_kwargs": json.dumps(run_kwargs)}
+            )
+
+            for label, unit in self.sweep_labels():
+                ds[label].attrs["units"] = unit
+
+        return ds
+
+    def make_discriminated_dataset(self, element, sweeps, results, run_kwargs):
+        """
+        Dataset of a run discriminated on the controller, without the single shot iteration. For ReadoutType.state
+        the excited state probability e_state of every point, for ReadoutType.histogram the counts of every
+        point over the centers of the I and Q bins.
+        """
+        spec = self.sweep_spec()
+        order = [i for i in self.loop_order() if not spec[i].averaging]
+        kept = sorted(order)
+        axes = list(np.argsort(order))
+        shape = [len(sweeps[i]) for i in order]
+        dims = [spec[i].label for i in kept]
+        coords = {spec[i].label: sweeps[i] for i in kept}
+
+        if self.readout_type == ReadoutType.histogram:
+            *_, edges_I, edges_Q = self.histogram_grid(element)
+            results = np.asarray(results).reshape(shape + [self.histogram_bins, self.histogram_bins])
+            axes, dims, name = axes + [len(order), len(order) + 1], dims + ["I", "Q"], "counts"
+            coords |= {"I": (edges_I[1:] + edges_I[:-1]) / 2, "Q": (edges_Q[1:] + edges_Q[:-1]) / 2}
+        elif type(element) is list: # Multiplexed
+            results = np.asarray(results).reshape([len(element)] + shape)
+            axes, dims, name = [0] + [axis + 1 for axis in axes], ["element"] + dims, "e_state"
+            coords["element"] = element
+        else:
+            results, name = np.asarray(results).reshape(shape), "e_state"
+
         ds = xr.Dataset(
-            data_vars={"iq": (sweep_labels, results)},
-            coords={sweep_label: values for sweep_label, values in zip(sweep_labels, sweeps)},
-            attrs={"element": element, "run_kwargs": json.dumps(run_kwargs)}
+            data_vars={name: (dims, np.transpose(results, axes))},
+            coords=coords,
+            attrs={
+                "element": element if type(element) is str else ",".join(element),
+                "run_kwargs": json.dumps(run_kwargs),
+                "Navg": len(sweeps[next(i for i, sweep in enumerate(spec) if sweep.averaging)]),
+            }
         )
-
         for label, unit in self.sweep_labels():
-            ds[label].attrs["units"] = unit
+            if label in ds.coords:
+                ds[label].attrs["units"] = unit
+        if self.readout_type == ReadoutType.histogram:
+            ds["I"].attrs["units"] = ds["Q"].attrs["units"] = "V"
+
+        return ds
+
+    def make_result(self, element, sweeps, results, autosave=True, metrics=None, **kwargs):
+        metrics = metrics or RunMetrics()
+        return self.finish_result(element, self.make_dataset(element, sweeps, results, metrics=metrics, **kwargs), autosave, metrics)
 
-        exp_res = ExperimentResult(ds, self)
+    def finish_result(self, element, ds, autosave=True, metrics=None, existing_id=None):
+        """
+        Make and save the ExperimentResult of a dataset. The run metrics go to attrs["metrics"] as json,
+        the saved file has them up to the save itself, and to the metrics_sink if there is one.
+        """
+        metrics = metrics or RunMetrics()
+        exp_res = ExperimentResult(ds, self, existing_id)
+        metrics.add("dataset_bytes", exp_res.data.nbytes)
 
         if autosave:
-            exp_res.save()
+            exp_res.data.attrs["metrics"] = json.dumps(metrics.as_dict())
+            with metrics.stage("save"):
+                exp_res.save()
+
+        record = metrics.as_dict()
+        exp_res.data.attrs["metrics"] = json.dumps(record)
+        self.runtime_model.record(self.experiment_name, record)
+        if self.metrics_sink is not None:
+            self.metrics_sink({"experiment": self.experiment_name, "element": element, "id": exp_res.id} | record)
 
         return exp_res
+
+    def run(self, element=None, sweeps=None, Navg=1024, autosave=True, elements=None, until=None, min_Navg=16, checkpoint_Navg=None, **kwargs):
+        """
+        Run the experiment on an element, or with elements=[...] on all of them at once in one
+        multiplexed program, giving a dataset with an element dimension. Runs with results
+        larger than station.max_result_bytes are split into chunks, see split_sweeps.
+        With a convergence criterion until, averaging stops early, see run_until.
+        With checkpoint_Navg, the averages run in chunks saved as they finish, see run_checkpointed.
+        """
+        element = elements or element
+        if type(element) is list and not self.supports_multiplexing():
+            print(f"{self.experiment_name} does not support multiplexed runs")
+            return
+        if until is not None and (type(element) is list or self.readout_type != ReadoutType.average):
+            print("Early stopping is for averaged runs on one element")
+            return
+        if self.readout_type.discriminated and (checkpoint_Navg is not None or until is not None):
+            print("Runs discriminated on the controller can not be checkpointed or stopped early")
+            return
+        if self.readout_type == ReadoutType.histogram and type(element) is list:
+            print("Histograms are binned per element, run them separately")
+            return
+        if kwargs.get("active_reset") and not self.supports_active_reset():
+            print(f"{self.experiment_name} does not support active reset")
+            return
+
+        metrics = RunMetrics()
+        with metrics.stage("complete_sweeps"):
+            sweeps = self.complete_sweeps(sweeps, Navg, **kwargs)
+        if sweeps is None:
+            return
+
+        if checkpoint_Navg is not None:
+            return self.run_checkpointed(element, sweeps, Navg, checkpoint_Navg, autosave=autosave, metrics=metrics, **kwargs)
+
+        if until is not None:
+            return self.run_until(element, sweeps, Navg, until, min_Navg=min_Navg, autosave=autosave, metrics=metrics, **kwargs)
+
+        axis, chunks = self.split_sweeps(element, Navg, sweeps)
+        if axis is not None:
+            return self.run_chunked(element, axis, chunks, autosave=autosave, metrics=metrics, **kwargs)
+
+        program = self.build_program(element, Navg, sweeps, metrics=metrics, **kwargs)
+        with metrics.stage("execute"):
+            results = self.station.execute(element, program, Navg, readout_type=self.readout_type, metrics=metrics)
+
+        return self.make_result(element, sweeps, results, autosave=autosave, metrics=metrics, **kwargs)
+
+    def run_until(self, element, sweeps, Navg, until, min_Navg=16, autosave=True, metrics=None, **kwargs):
+        """
+        Run an averaged experiment and halt the job once until(experiment, dataset) is met on the
+        live results, after at least min_Navg averages, see convergence.py. The averages that ran
+        are in attrs["Navg"] of the dataset, attrs["converged"] is 1 if it stopped early.
+        """
+        hook = getattr(until, "requires", None)
+        if hook is not None and not hasattr(self, hook):
+            print(f"{self.experiment_name} has no {hook} for this convergence criterion")
+            return
+
+        metrics = metrics or RunMetrics()
+        program = self.build_program(element, Navg, sweeps, metrics=metrics, **kwargs)
+
+        def converged(results, iteration):
+            if iteration + 1 < min_Navg:
+                return False
+            with metrics.stage("convergence"):
+                return until(self, self.make_dataset(element, sweeps, results, **kwargs))
+
+        with metrics.stage("execute"):
+            results, iteration, halted = self.station.execute_until(element, program, Navg, converged, metrics=metrics)
+        # Only the averages that ran
+        metrics.counters["estimated_duration"] *= (iteration + 1) / Navg
+
+        ds = self.make_dataset(element, sweeps, results, metrics=metrics, **kwargs)
+        ds.attrs["Navg"] = iteration + 1
+        ds.attrs["converged"] = int(halted)
+        return self.finish_result(element, ds, autosave, metrics)
+
+    def run_adaptive(self, element, sweeps, Navg=1024, coarse_Navg=None, levels=1, window=3, fine_points=None, autosave=True, **kwargs):
+        """
+        Coarse to fine run of an experiment with one sweep. The given sweep runs at coarse_Navg
+        (Navg // 8 by default), then every level runs fine_points at Navg within window steps of the
+        previous level around its locate_feature. By default 4 x window + 1 points, half the step of
+        the level before. The merged dataset has the points of all levels, the level of each point
+        in "level" and the levels in attrs["levels"]. Experiments that support it define
+        locate_feature(data), the sweep value of the feature (dip, peak) in the dataset of a level.
+        """
+        if type(element) is list or len(self.sweep_labels()) != 1:
+            print("Adaptive runs are for one element and one sweep")
+            return
+        if levels > 0 and not hasattr(self, "locate_feature"):
+            print(f"{self.experiment_name} has no locate_feature for adaptive runs")
+            return
+
+        label = self.sweep_labels()[0][0]
+        values = np.asarray(sweeps[0])
+        metrics = RunMetrics()
+        datasets, level_info = [], []
+        for level in range(levels + 1):
+            level_Navg = (coarse_Navg or max(Navg // 8, 1)) if level == 0 else Navg
+            program = self.build_program(element, level_Navg, [values], metrics=metrics, **kwargs)
+            with metrics.stage("execute"):
+                results = self.station.execute(element, program, level_Navg, readout_type=self.readout_type, metrics=metrics)
+            ds = self.make_dataset(element, [values], results, metrics=metrics, **kwargs)
+            datasets.append(ds.assign(level=(label, np.full(len(values), level))))
+            level_info.append({"Navg": level_Navg, "start": float(values[0]), "stop": float(values[-1]), "points": len(values)})
+
+            if level < levels:
+                center = self.locate_feature(ds)
+                step = (values.max() - values.min()) / (len(values) - 1)
+                values = np.linspace(center - window * step, center + window * step, fine_points or 4 * window + 1)
+
+        with metrics.stage("stitch"):
+            ds = xr.concat(datasets, dim=label, combine_attrs="override").sortby(label)
+            ds = ds.drop_duplicates(label, keep="last")
+            ds.attrs["levels"] = json.dumps(level_info)
+
+        return self.finish_result(element, ds, autosave, metrics)
+
+    def estimate_result_bytes(self, element, sweeps):
+        # I and Q of every point and element as float64, single shot sweeps include the iteration
+        elements = len(element) if type(element) is list else 1
+        if self.readout_type.discriminated: # A probability or histogram per point, without the iteration
+            points = np.prod([len(sweep) for sweep, spec in zip(sweeps, self.sweep_spec()) if not spec.averaging])
+            bins = self.histogram_bins ** 2 if self.readout_type == ReadoutType.histogram else 1
+            return 8 * elements * int(points) * bins
+        return 16 * elements * int(np.prod([len(sweep) for sweep in sweeps]))
+
+    def split_sweeps(self, element, Navg, sweeps):
+        """
+        Split a run with results over station.max_result_bytes into (axis, [(Navg, sweeps), ...]) chunks
+        of one sweep, the outermost loop long enough, axis is None for a run that fits.
+        Only experiments with a sweep_spec are split, the single shot iteration splits Navg.
+        """
+        n_chunks = int(np.ceil(self.estimate_result_bytes(element, sweeps) / self.station.max_result_bytes))
+        if n_chunks <= 1:
+            return None, [(Navg, sweeps)]
+        if self.sweep_spec() is None:
+            print(f"Warning: {self.experiment_name} has no sweep spec to split, running it in one job over {self.station.max_result_bytes} bytes")
+            return None, [(Navg, sweeps)]
+
+        # Discriminated results are reduced over the iteration, split another sweep
+        order = [i for i in self.loop_order() if not (self.readout_type.discriminated and self.sweep_spec()[i].averaging)]
+        axis = next((i for i in order if len(sweeps[i]) >= n_chunks), max(order, key=lambda i: len(sweeps[i])))
+        if len(sweeps[axis]) < n_chunks:
+            print(f"Warning: Can not split {self.experiment_name} enough to fit in {self.station.max_result_bytes} bytes")
+
+        chunks = []
+        for indices in np.array_split(np.arange(len(sweeps[axis])), min(n_chunks, len(sweeps[axis]))):
+            chunk_sweeps = list(sweeps)
+            chunk_sweeps[axis] = np.asarray(sweeps[axis])[indices]
+            chunks.append((len(indices) if self.sweep_spec()[axis].averaging else Navg, chunk_sweeps))
+        return axis, chunks
+
+    def run_chunked(self, element, axis, chunks, autosave=True, metrics=None, **kwargs):
+        """
+        Run the (Navg, sweeps) chunks of split_sweeps back to back, building each while the one before
+        runs, and stitch their datasets along the split sweep into one result
+        """
+        metrics = metrics or RunMetrics()
+        metrics.add("chunks", len(chunks))
+        acquisitions = []
+        for Navg, sweeps in chunks:
+            program = self.station.build_executor.submit(self.build_program, element, Navg, sweeps, metrics=metrics, **kwargs)
+            acquisitions.append(self.station.execute_async(element, program, Navg, readout_type=self.readout_type, metrics=metrics))
+
+        datasets = [
+            self.make_dataset(element, sweeps, acquisition.result(), metrics=metrics, **kwargs)
+            for (_, sweeps), acquisition in zip(chunks, acquisitions)
+        ]
+        with metrics.stage("stitch"):
+            ds = xr.concat(datasets, dim=self.sweep_labels()[axis][0], combine_attrs="override")
+
+        return self.finish_result(element, ds, autosave, metrics)
+
+    def averaging_axis(self):
+        # Index of the single shot iteration in the sweeps, None for averaged experiments
+        if self.readout_type != ReadoutType.single_shot:
+            return None
+        return next(i for i, sweep in enumerate(self.sweep_spec()) if sweep.averaging)
+
+    def run_checkpointed(self, element, sweeps, Navg, checkpoint_Navg, autosave=True, metrics=None, checkpoint=None, **kwargs):
+        """
+        Run Navg averages as jobs of checkpoint_Navg, merging each into the result and saving it under the
+        same ID before the next one starts. The saved dataset holds the mean so far, with the number of
+        averages in it in attrs["checkpoint"], so a killed run loses at most one chunk and continues
+        from the database with load_result(id).resume(). Single shot runs append the shots instead.
+        Without autosave nothing is saved, the chunks are only merged in memory.
+        """
+        if self.readout_type == ReadoutType.single_shot and self.sweep_spec() is None:
+            print(f"{self.experiment_name} does not support checkpointed runs")
+            return
+
+        metrics = metrics or RunMetrics()
+        axis = self.averaging_axis()
+        data, existing_id, count = None, None, 0
+        if checkpoint is not None:
+            data, existing_id = checkpoint.data, checkpoint.id
+            count = json.loads(data.attrs["checkpoint"])["count"]
+
+        while count < Navg:
+            chunk_Navg = min(checkpoint_Navg, Navg - count)
+            chunk_sweeps = list(sweeps)
+            if axis is not None:
+                chunk_sweeps[axis] = np.asarray(sweeps[axis])[count:count + chunk_Navg]
+
+            program = self.build_program(element, chunk_Navg, chunk_sweeps, metrics=metrics, **kwargs)
+            with metrics.stage("execute"):
+                results = self.station.execute(element, program, chunk_Navg, readout_type=self.readout_type, metrics=metrics)
+            ds = self.make_dataset(element, chunk_sweeps, results, metrics=metrics, **kwargs)
+
+            with metrics.stage("merge"):
+                if data is not None and axis is not None:
+                    ds = xr.concat([data, ds], dim=self.sweep_labels()[axis][0], combine_attrs="override")
+                elif data is not None:
+                    # Weighted by the averages of each, the running sum over the total count
+                    ds["iq"] = (ds["iq"].dims, (data["iq"].values * count + ds["iq"].values * chunk_Navg) / (count + chunk_Navg))
+            count += chunk_Navg
+            ds.attrs["checkpoint"] = json.dumps({"count": count, "Navg": Navg, "checkpoint_Navg": checkpoint_Navg})
+            data = ds
+
+            metrics.add("checkpoints", 1)
+            if autosave and count < Navg:
+                with metrics.stage("checkpoint"):
+                    result = ExperimentResult(ds, self, existing_id)
+                    result.save()
+                    existing_id = result.id
+
+        return self.finish_result(element, data, autosave, metrics, existing_id=existing_id)
+
+    def resume(self, checkpoint, autosave=True):
+        """
+        Continue the checkpointed run of a result loaded from the database up to its Navg
+        """
+        if "checkpoint" not in checkpoint.data.attrs:
+            print(f"{checkpoint.id} is not a checkpointed run")
+            return
+
+        data = checkpoint.data.load()
+        info = json.loads(data.attrs["checkpoint"])
+        element = [str(el) for el in data.coords["element"].values] if "element" in data.dims else data.attrs["element"]
+        sweeps = [data.coords[label].values for label, _ in self.sweep_labels()]
+        if self.averaging_axis() is not None:
+            sweeps[self.averaging_axis()] = np.arange(info["Navg"])
+
+        return self.run_checkpointed(
+            element, sweeps, info["Navg"], info["checkpoint_Navg"],
+            checkpoint=ExperimentResult(data, self, checkpoint.id), autosave=autosave,
+            **json.loads(data.attrs["run_kwargs"])
+        )
+
+    def run_async(self, element, sweeps=None, Navg=1024, autosave=True, **kwargs):
+        """
+        Same as run, but returns a future of the ExperimentResult. The program is built, acquired
+        and saved on the station pipeline threads, so consecutive calls overlap with each other.
+        """
+        if type(element) is list and not self.supports_multiplexing():
+            print(f"{self.experiment_name} does not support multiplexed runs")
+            return
+
+        metrics = RunMetrics()
+        with metrics.stage("complete_sweeps"):
+            sweeps = self.complete_sweeps(sweeps, Navg, **kwargs)
+        if sweeps is None:
+            return
+
+        program = self.station.build_executor.submit(self.build_program, element, Navg, sweeps, metrics=metrics, **kwargs)
+        results = self.station.execute_async(element, program, Navg, readout_type=self.readout_type, metrics=metrics)
+
+        return self.station.process_executor.submit(
+            lambda: self.make_result(element, sweeps, results.result(), autosave=autosave, metrics=metrics, **kwargs)
+        )
     
+    def run_live(self, element, sweeps=None, Navg=1024, autosave=True, max_rate=10, max_interval=2, **kwargs):
+        """
+        Run an averaged experiment and yield partial datasets while it runs, with the number of
+        averages so far in attrs["iteration"]. The final dataset is saved if autosave and all Navg
+        averages ran. Stopping early (a break, an interrupt) halts the job when the generator is
+        closed, use it in contextlib.closing to halt it right away.
+        """
+        sweeps = self.complete_sweeps(sweeps, Navg, **kwargs)
+        if sweeps is None:
+            return
+
+        program = self.build_program(element, Navg, sweeps, **kwargs)
+        ds = None
+        with closing(self.station.execute_live(element, program, Navg, max_rate=max_rate, max_interval=max_interval)) as live:
+            for results, iteration in live:
+                ds = self.make_dataset(element, sweeps, results, **kwargs)
+                ds.attrs["iteration"] = iteration
+                yield ds
+
+        if autosave and ds is not None and ds.attrs["iteration"] + 1 >= Navg:
+            ExperimentResult(ds, self).save()
+
     def load(self, id, data):
-        return ExperimentResult(data, self, id)
\ No newline at end of file
+        return ExperimentResult(data, self, id)
+
+
+class StreamedRun:
+    """
+    A running job of an experiment program from get_streamed_program, see run_streamed
+    """
+    def __init__(self, experiment, element, Navg, sweeps, streamed_params, autosave, kwargs):
+        self.experiment = experiment
+        self.station = experiment.station
+        self.element = element
+        self.elements = element if type(element) is list else [element]
+        self.Navg = Navg
+        self.sweeps = sweeps
+        self.autosave = autosave
+        self.kwargs = experiment.with_repetition_delay(element, kwargs)
+        self.run_kwargs = experiment.get_run_kwargs(**self.kwargs)
+        self.params = {name: self.run_kwargs[name] for name in streamed_params}
+        self.count = 0
+
+        experiment.prepare(self.elements)
+        self.program = experiment.get_streamed_program(self.elements, Navg, sweeps, streamed_params, **self.kwargs)
+        self.program.qtl_run = experiment.describe_run(self.elements, Navg, sweeps, self.run_kwargs)
+        self.program.qtl_streamed = [f"sweep_{sweep.label}" for sweep, _ in experiment.loop_sweeps(self.elements, sweeps)] + list(self.params)
+        self.job = None # Set by QTLQMExperiment.streamed_run while it holds the QM
+
+    def run(self, sweeps=None, **params):
+        """
+        Push new sweeps and streamed parameters to the job and return the ExperimentResult
+        """
+        metrics = RunMetrics()
+        if sweeps is not None:
+            with metrics.stage("complete_sweeps"):
+                sweeps = self.experiment.complete_sweeps(sweeps, self.Navg, **self.kwargs)
+            if sweeps is None:
+                return
+            if [len(sweep) for sweep in sweeps] != [len(sweep) for sweep in self.sweeps]:
+                print("Streamed runs need sweeps of the same lengths as the compiled program")
+                return
+            self.sweeps = sweeps
+        self.params |= params
+        self.run_kwargs |= params
+        self.program.qtl_run |= {
+            "sweeps": self.sweeps,
+            "run_kwargs": self.run_kwargs,
+            "drive_duration": self.experiment.drive_durations(self.element, self.sweeps, self.run_kwargs),
+            "estimated_duration": self.experiment.estimate_duration(self.element, self.Navg, self.sweeps, self.run_kwargs),
+        }
+        metrics.add("estimated_duration", self.program.qtl_run["estimated_duration"])
+
+        with metrics.stage("push"):
+            for sweep, values in self.experiment.loop_sweeps(self.elements, self.sweeps):
+                self.job.push_to_input_stream(f"sweep_{sweep.label}", values.tolist())
+            for name, value in self.params.items():
+                self.job.push_to_input_stream(name, value)
+
+        with metrics.stage("execute"):
+            results = self.station.fetch_streamed(self.elements, self.job, self.count, metrics=metrics)
+        self.count += 1
+
+        if type(self.element) is not list:
+            results = results[0]
+        return self.experiment.make_result(
+            self.element, self.sweeps, results, autosave=self.autosave, metrics=metrics, **(self.kwargs | self.params)
+        )
+
+
+def get_merged_program(parts, Navg, single_element=False):
+    """
+    One program running parts of (experiment, elements, sweeps, run_kwargs) on disjoint elements,
+    built from the sweep specs of the experiments. Every part has its own sweep loops inside the
+    shared averaging loop, and only aligns its own elements, so the parts run in parallel on the
+    hardware. The results of each element are saved to the I_{element} and Q_{element} streams,
+    or to I and Q for a single_element program.
+    """
+    with program() as merged_program:
+        n = declare(int)
+        n_stream = declare_stream()
+
+        part_variables = []
+        for experiment, elements, sweeps, run_kwargs in parts:
+            loops = experiment.loop_sweeps(elements, sweeps)
+            part_variables.append((
+                loops,
+                {sweep.label: declare(sweep.qua_type) for sweep, _ in loops},
+                {element: (declare(fixed), declare(fixed)) for element in elements},
+                {element: (declare_stream(), declare_stream()) for element in elements},
+                # Only the states of discriminated shots are saved
+                experiment.readout_type.discriminated,
+                # Reset rounds of every element with active_reset
+                {element: (declare(int), declare_stream()) for element in elements} if run_kwargs.get("active_reset") else None,
+            ))
+        # Single shot results are not averaged, no progress to save
+        averaged = all(experiment.readout_type == ReadoutType.average for experiment, *_ in parts)
+
+        with for_(n, 0, n < Navg, n + 1):
+            for (experiment, elements, sweeps, run_kwargs), (loops, variables, IQ, IQ_streams, discriminated, resets) in zip(parts, part_variables):
+                if resets is not None: # The readouts only wait for the resonators to deplete
+                    run_kwargs = run_kwargs | {"wait_after": run_kwargs.get("reset_wait", 1000)}
+                with ExitStack() as sweep_loops:
+                    for sweep, values in loops:
+                        sweep_loops.enter_context(qua_loop(variables[sweep.label], values))
+                        sweep.apply_to(elements, variables[sweep.label])
+
+                    if not discriminated:
+                        experiment.qua_point(elements, variables, IQ, IQ_streams, run_kwargs)
+                    else:
+                        experiment.qua_point(elements, variables, IQ, {element: (None, None) for element in elements}, run_kwargs)
+                        for element in elements:
+                            experiment.qua_state(element, *IQ[element], IQ_streams[element][0])
+
+                    if resets is not None:
+                        for element in elements:
+                            experiment.qua_active_reset(element, *IQ[element], *resets[element], **run_kwargs)
+            if averaged:
+                save(n, n_stream)
+
+        with stream_processing():
+            for (experiment, _, _, run_kwargs), (loops, _, _, IQ_streams, _, resets) in zip(parts, part_variables):
+                for element, (_, rounds_stream) in (resets or dict()).items():
+                    save_reset_rounds(rounds_stream, "reset" if single_element else f"reset_{element}", run_kwargs.get("reset_rounds", 4))
+
+                for element, (I_stream, Q_stream) in IQ_streams.items():
+                    if experiment.readout_type.discriminated:
+                        stream = I_stream.boolean_to_int()
+                        for _, values in reversed(loops):
+                            stream = stream.buffer(len(values))
+                        stream.average().save(experiment.readout_type.name if single_element else f"state_{element}")
+                        continue
+
+                    names = ["I", "Q"] if single_element else [f"I_{element}", f"Q_{element}"]
+                    for name, stream in zip(names, [I_stream, Q_stream]):
+                        for _, values in reversed(loops):
+                            stream = stream.buffer(len(values))
+                        if experiment.readout_type == ReadoutType.single_shot:
+                            stream.save_all(name)
+                        else:
+                            stream.average().save(name)
+            if averaged:
+                n_stream.save("iteration")
+
+    return merged_program
+
+
+def run_merged(items, Navg=1024, autosave=True):
+    """
+    Run different experiments on disjoint elements at the same time, in one program from
+    get_merged_program. Items are (experiment, element or list of elements, sweeps, kwargs),
+    returns the list of ExperimentResults of the items.
+    """
+    station = QTLQMExperiment.station
+    metrics = RunMetrics()
+
+    parts, used_elements = [], set()
+    with metrics.stage("complete_sweeps"):
+        for experiment, element, sweeps, kwargs in items:
+            elements = element if type(element) is list else [element]
+            if not experiment.supports_multiplexing() or experiment.readout_type != ReadoutType.average:
+                print(f"{experiment.experiment_name} does not support merged runs")
+                return
+            if used_elements & set(elements):
+                print(f"Elements {used_elements & set(elements)} are in more than one experiment")
+                return
+            used_elements |= set(elements)
+
+            sweeps = experiment.complete_sweeps(sweeps, Navg, **kwargs)
+            if sweeps is None:
+                return
+            parts.append((experiment, elements, sweeps, experiment.get_run_kwargs(**experiment.with_repetition_delay(elements, kwargs))))
+
+    with metrics.stage("get_program"):
+        for experiment, elements, _, _ in parts:
+            experiment.prepare(elements)
+        program = get_merged_program(parts, Navg)
+    program.qtl_run = {
+        "experiment": "merged",
+        "element": list(used_elements),
+        "Navg": Navg,
+        "parts": [
+            experiment.describe_run(elements, Navg, sweeps, run_kwargs)
+            for experiment, elements, sweeps, run_kwargs in parts
+        ],
+        "readout_type": ReadoutType.average,
+    }
+    # The parts run in parallel
+    program.qtl_run["estimated_duration"] = max(part["estimated_duration"] for part in program.qtl_run["parts"])
+    metrics.add("estimated_duration", program.qtl_run["estimated_duration"])
+
+    with metrics.stage("execute"):
+        results = station.execute(
+            [elements for _, elements, _, _ in parts], program, Navg, ReadoutType.average, metrics=metrics
+        )
+
+    exp_results = []
+    for (experiment, element, _, kwargs), (_, _, sweeps, _), part_results in zip(items, parts, results):
+        if type(element) is not list:
+            part_results = part_results[0]
+        exp_results.append(experiment.make_result(
+            element, sweeps, part_results, autosave=autosave, metrics=copy.deepcopy(metrics), **kwargs
+        ))
+
+    return exp_results
@@ -0,0 +1,67 @@
+import warnings
+
+import numpy as np
+import scipy.optimize as opt
+
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+
+@dataclass
+class SliceFits:
+    """
+    Results of fit_slices, the parameters and their standard errors of every slice (nan where the fit
+    failed) and the status of every slice, "converged" or why the fit failed
+    """
+    params: np.ndarray
+    errors: np.ndarray
+    status: list
+
+    @property
+    def converged(self):
+        return np.array([status == "converged" for status in self.status])
+
+
+def fit_slice(function, x, y, p0, kwargs):
+    try:
+        with warnings.catch_warnings(): # Reported as infinite errors instead
+            warnings.simplefilter("ignore", opt.OptimizeWarning)
+            params, cov, _, message, ier = opt.curve_fit(function, x, y, p0=p0, full_output=True, **kwargs)
+    except (RuntimeError, ValueError) as e:
+        return np.full(len(p0), np.nan), np.full(len(p0), np.nan), str(e)
+
+    errors = np.sqrt(np.abs(np.diag(cov)))
+    return params, errors, "converged" if ier in (1, 2, 3, 4) else message
+
+
+def fit_block(function, x, ys, p0s, warm_start, kwargs):
+    results = []
+    for y, p0 in zip(ys, p0s):
+        if warm_start and results and results[-1][2] == "converged":
+            p0 = results[-1][0]
+        results.append(fit_slice(function, x, y, p0, kwargs))
+    return results
+
+
+def fit_slices(function, x, ys, p0, warm_start=False, processes=None, **kwargs):
+    """
+    Fit function(x, *params) to every row of ys, independent 1D slices over the same x, with curve_fit
+    and its kwargs. p0 is the initial guess of every slice, or a list of one per slice. With warm_start
+    every fit starts from the solution of the slice before it if that converged, for maps that change
+    slowly from slice to slice. With processes the slices are fit in a pool of that many processes, in
+    contiguous blocks that warm start on their own, the function has to be importable to be sent to it.
+    Returns the SliceFits.
+    """
+    x, ys = np.asarray(x), np.asarray(ys)
+    p0s = np.broadcast_to(np.asarray(p0, dtype=float), (len(ys), np.shape(p0)[-1]))
+
+    if not processes or processes < 2 or len(ys) < 2:
+        results = fit_block(function, x, ys, p0s, warm_start, kwargs)
+    else:
+        blocks = [block for block in np.array_split(np.arange(len(ys)), processes) if len(block)]
+        with ProcessPoolExecutor(max_workers=len(blocks)) as pool:
+            futures = [pool.submit(fit_block, function, x, ys[block], p0s[block], warm_start, kwargs) for block in blocks]
+            results = [result for future in futures for result in future.result()]
+
+    params, errors, status = zip(*results)
+    return SliceFits(np.array(params), np.array(errors), list(status))
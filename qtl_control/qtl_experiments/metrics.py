@@ -0,0 +1,57 @@
+import json
+import time
+
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    """
+    Wall and CPU time of the stages of a run, and counters like the bytes transferred from the QM.
+    CPU time is of the thread running the stage, so the stages can run on the pipeline threads.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages = dict()
+        self.counters = dict()
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            stage["wall"] += time.perf_counter() - wall
+            stage["cpu"] += time.thread_time() - cpu
+
+    def add(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        return {
+            "total_wall": time.perf_counter() - self.start_time,
+            "stages": self.stages,
+        } | self.counters
+
+
+class MetricsLog:
+    """
+    Metrics sink that keeps the records in memory
+    """
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+class JSONLinesSink:
+    """
+    Metrics sink that appends every record as a line of json to a file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, "a+") as f:
+            f.write(json.dumps(record) + "\n")
@@ -9,157 +9,81 @@ from qm.qua import *
 from qualang_tools.loops import from_array
 
 from qtl_control.qtl_station.station import ReadoutType
-from qtl_control.qtl_station.station import u
 from qtl_control.qtl_experiments import QTLQMExperiment
 from qtl_control.qtl_station import ReadoutDisc
-from qtl_control.qtl_experiments.utils import standard_readout, format_res
+from qtl_control.qtl_experiments.utils import standard_readout, format_res, assignment_fidelity, exp_sine
+from qtl_control.qtl_experiments.fitting import fit_slices
+from qtl_control.qtl_experiments.sweeps import Sweep, frequency_sweep, flux_sweep, state_sweep, UPDATE_FREQUENCY_COST
 
 
 class QubitSpectroscopy(QTLQMExperiment):
     experiment_name = "QM-QubitSpectroscopy"
 
-    def sweep_labels(self):
-        return [("drive_frequency", "Hz"), ]
+    def sweep_spec(self):
+        return [
+            frequency_sweep("drive_frequency", "drive", lambda element: self.station.config[element].drive.LO_frequency),
+        ]
 
-    def get_program(self, element, Navg, sweeps, sat_amp=0.05, sat_len=10000, wait_after=10000):
-        saturation_len = sat_len * u.ns  # In ns
-        dfs = sweeps[0] - self.station.config[element].drive.LO_frequency
-        # === START QM program ===
-        with program() as spec_program:
-            n = declare(int)
-            df = declare(int)
-            I = declare(fixed)
-            Q = declare(fixed)
+    def get_program(self, element, Navg, sweeps, sat_amp=0.05, sat_len=10000, wait_after=10000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, sat_amp=sat_amp, sat_len=sat_len, wait_after=wait_after, **kwargs)
 
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return run_kwargs["sat_len"] + 400
 
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(df, dfs)):
-                    # Update the frequency of the digital oscillator linked to the qubit element
-                    update_frequency(f"drive_{element}", df)
-                    # Play the saturation pulse to put the qubit in a mixed state - Can adjust the amplitude on the fly [-2; 2)
-                    play("saturation" * amp(sat_amp), f"drive_{element}", duration=saturation_len * u.ns)
-                    # Align the two elements to measure after playing the qubit pulse.
-                    # One can also measure the resonator while driving the qubit by commenting the 'align'
-                    wait(400 * u.ns, f"drive_{element}")
-                    align(f"drive_{element}", f"resonator_{element}")
+    def qua_shot(self, element, variables, sat_amp=0.05, sat_len=10000, **kwargs):
+        # Play the saturation pulse to put the qubit in a mixed state - Can adjust the amplitude on the fly [-2; 2)
+        play("saturation" * amp(sat_amp), f"drive_{element}", duration=sat_len // 4) # in clock cycles
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
 
-                    # Measure the state of the resonator
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-                # Save the averaging iteration to get the progress bar
-                save(n, n_stream)
-
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(dfs)).average().save("I")
-                Q_stream.buffer(len(dfs)).average().save("Q")
-                n_stream.save("iteration")
-        # === END QM program ===
-        return spec_program
+    def locate_feature(self, data):
+        # The qubit line is the point furthest from the background
+        iq = data["iq"].values
+        background = np.median(iq.real) + 1.j * np.median(iq.imag)
+        return data.coords["drive_frequency"].values[np.argmax(np.abs(iq - background))]
 
 
 class FluxQubitSpectrsocopy(QTLQMExperiment):
     experiment_name = "QM-FluxQubitSpectroscopy"
 
-    def sweep_labels(self):
-        return [("amplitude", "arb"), ("drive_frequency", "Hz"), ]
-
-    def get_program(self, element, Navg, sweeps, sat_amp=0.05, wait_after=10000):
-        saturation_len = 10 * u.us  # In ns
-        amp_sweep = sweeps[0]
-        dfs = sweeps[1] - self.station.config[element].drive.LO_frequency
-        # === START QM program ===
-        with program() as spec_program:
-            n = declare(int)
-            df = declare(int)
-            a = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            I = declare(fixed)
-            Q = declare(fixed)
+    def sweep_spec(self):
+        return [
+            flux_sweep("amplitude", "arb"),
+            frequency_sweep("drive_frequency", "drive", lambda element: self.station.config[element].drive.LO_frequency),
+        ]
 
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
+    def get_program(self, element, Navg, sweeps, sat_amp=0.05, wait_after=10000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, sat_amp=sat_amp, wait_after=wait_after, **kwargs)
 
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(a, amp_sweep)):  # QUA for_ loop for sweeping the frequency
-                    set_dc_offset(f"flux_{element}", "single", a)
-                    with for_(*from_array(df, dfs)):
-                        # Update the frequency of the digital oscillator linked to the qubit element
-                        update_frequency(f"drive_{element}", df)
-                        # Play the saturation pulse to put the qubit in a mixed state - Can adjust the amplitude on the fly [-2; 2)
-                        play("saturation" * amp(sat_amp), f"drive_{element}", duration=saturation_len * u.ns)
-                        # Align the two elements to measure after playing the qubit pulse.
-                        # One can also measure the resonator while driving the qubit by commenting the 'align'
-                        wait(400 * u.ns, f"drive_{element}")
-                        align(f"drive_{element}", f"resonator_{element}")
-
-                        # Measure the state of the resonator
-                        standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-
-                    # Save the averaging iteration to get the progress bar
-                save(n, n_stream)
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 10000 + 400
 
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(dfs)).buffer(len(amp_sweep)).average().save("I")
-                Q_stream.buffer(len(dfs)).buffer(len(amp_sweep)).average().save("Q")
-                n_stream.save("iteration")
-        # === END QM program ===
-        return spec_program
+    def qua_shot(self, element, variables, sat_amp=0.05, **kwargs):
+        # Play the saturation pulse to put the qubit in a mixed state - Can adjust the amplitude on the fly [-2; 2)
+        play("saturation" * amp(sat_amp), f"drive_{element}", duration=10000 // 4) # 10 us in clock cycles
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
 
 
 class Rabi(QTLQMExperiment):
     experiment_name = "QM-Rabi"
 
-    def sweep_labels(self):
-        return [("amplitude", "arb"), ]
-
-    def get_program(self, element, Navg, sweeps, wait_after=50000):
-        with self.station.change_settings():
-            self.station.config[element].X180_amplitude = 1
-        
-        amp_range = sweeps[0]
-        # === START QM program ===
-        with program() as rabi:
-            n = declare(int)
-            a = declare(fixed)
-            I = declare(fixed)
-            Q = declare(fixed)
+    def sweep_spec(self):
+        return [Sweep("amplitude", "arb", fixed)]
 
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
-
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(a, amp_range)):  # QUA for_ loop for sweeping the pulse amplitude pre-factor
-                    # Play the qubit pulse with a variable amplitude (pre-factor to the pulse amplitude defined in the config)
-                    
-                    play(f"{element}_x180" * amp(a, 0, 0, a), f"drive_{element}")
-                    # play("gauss" * amp(a), element)
-                    
-                    # Align the two elements to measure after playing the qubit pulse.
-                    wait(400 * u.ns, f"drive_{element}")
-                    align(f"drive_{element}", f"resonator_{element}")
-                    # Measure the state of the resonator
-                    # The integration weights have changed to maximize the SNR after having calibrated the IQ blobs.
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
+    def get_program(self, element, Navg, sweeps, wait_after=50000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
 
-                # Save the averaging iteration to get the progress bar
-                save(n, n_stream)
+    def prepare(self, elements):
+        with self.station.change_settings():
+            for element in elements:
+                self.station.config[element].X180_amplitude = 1
 
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(amp_range)).average().save("I")
-                Q_stream.buffer(len(amp_range)).average().save("Q")
-                n_stream.save("iteration")
-        # === END QM program ===
+    def qua_shot(self, element, variables, **kwargs):
+        # Play the qubit pulse with a variable amplitude (pre-factor to the pulse amplitude defined in the config)
+        a = variables["amplitude"]
+        play(f"{element}_x180" * amp(a, 0, 0, a), f"drive_{element}")
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
 
-        return rabi
-    
-    def analyze_data(self, result, rabi_amp=None):
-        data = result.data
+    def fit(self, data, rabi_amp=None):
         def rabi(amplitudes, frequency, a0, b0, a1, b1):
             amplitudes_0 = amplitudes[0:len(amplitudes)//2]
             amplitudes_1 = amplitudes[len(amplitudes)//2:]
@@ -167,12 +91,9 @@ class Rabi(QTLQMExperiment):
                 a0 * np.cos(2 * np.pi * 0.5 * amplitudes_0/frequency) + b0,
                 a1 * np.cos(2 * np.pi * 0.5 * amplitudes_1/frequency) + b1,
             ])
-        
-        def rabi_check(amp, frequency):
-            return 0.5 - np.cos(2 * np.pi * 0.5 * amp/frequency) * 0.5
 
         p0 = [rabi_amp or 0.1, 1e-5, 2e-4, -1e-5, -5e-5]
-        res, _ = opt.curve_fit(
+        return opt.curve_fit(
             rabi,
             np.concatenate([np.array(data.coords["amplitude"]), np.array(data.coords["amplitude"])]),
             np.concatenate([np.array(data["iq"].real), np.array(data["iq"].imag)]),
@@ -180,6 +101,17 @@ class Rabi(QTLQMExperiment):
             ftol=1e-12, xtol=1e-12, gtol=1e-12
         )
 
+    def fit_parameters(self, data, rabi_amp=None):
+        res, cov = self.fit(data, rabi_amp)
+        return {"X180_amplitude": (res[0], np.sqrt(cov[0, 0]))}
+
+    def analyze_data(self, result, rabi_amp=None):
+        data = result.data
+        def rabi_check(amp, frequency):
+            return 0.5 - np.cos(2 * np.pi * 0.5 * amp/frequency) * 0.5
+
+        res, _ = self.fit(data, rabi_amp)
+
 
         rabi_f, a0, b0, a1, b1 = res
         g_state_readout = (b0 + a0) + (b1 + a1)*1.j
@@ -213,135 +145,85 @@ class Rabi(QTLQMExperiment):
 class TimeRabi(QTLQMExperiment):
     experiment_name = "QM-TimeRabi"
 
-    def sweep_labels(self):
-        return ["duration", ]
-
-    def get_program(self, element, Navg, sweeps, pulse_amplitude=0.1, wait_after=50000):
-        duration_sweep = sweeps[0]
-        # === START QM program ===
-        with program() as rabi_time:
-            n = declare(int)
-            a = declare(fixed)
-            t = declare(int)
-            I = declare(fixed)
-            Q = declare(fixed)
+    def sweep_spec(self):
+        return [Sweep("duration", "clock cycles", int)]
 
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
+    def get_program(self, element, Navg, sweeps, pulse_amplitude=0.1, wait_after=50000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, pulse_amplitude=pulse_amplitude, wait_after=wait_after, **kwargs)
 
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 4 * np.mean(sweeps["duration"]) # in clock cycles
 
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(t, duration_sweep)):  # QUA for_ loop for sweeping the pulse amplitude pre-factor
-                    # Play the qubit pulse with a variable amplitude (pre-factor to the pulse amplitude defined in the config)
-                    
-                    
-                    # play("x180" * amp(a), "qubit")
-                    play("gauss" * amp(pulse_amplitude), f"drive_{element}", duration=t)
-                    # wait(t, "qubit")
-                    
-                    # Align the two elements to measure after playing the qubit pulse.
-                    align(f"drive_{element}", f"resonator_{element}")
-                    # Measure the state of the resonator
-                    # The integration weights have changed to maximize the SNR after having calibrated the IQ blobs.
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
+    def qua_shot(self, element, variables, pulse_amplitude=0.1, **kwargs):
+        play("gauss" * amp(pulse_amplitude), f"drive_{element}", duration=variables["duration"])
 
-                # Save the averaging iteration to get the progress bar
-                save(n, n_stream)
 
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(duration_sweep)).average().save("I")
-                Q_stream.buffer(len(duration_sweep)).average().save("Q")
-                n_stream.save("iteration")
-        # === END QM program ===
+class Ramsey2F(QTLQMExperiment):
+    experiment_name = "QM-Ramsey2F"
 
-        return rabi_time
+    def sweep_spec(self):
+        return [
+            # Shift the qubit drive frequency to observe Ramsey oscillations
+            Sweep("detuning", "Hz", int, apply=self.update_detuning, cost=UPDATE_FREQUENCY_COST),
+            Sweep("time", "ns", int, to_qua=lambda values, element: np.asarray(values) // 4),
+        ]
 
+    def get_program(self, element, Navg, sweeps, wait_after=50000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
 
-class Ramsey2F(QTLQMExperiment):
-    experiment_name = "QM-Ramsey2F"
+    def qubit_IF(self, element):
+        return int(self.station.config[element].frequency - self.station.config[element].drive.LO_frequency)
 
-    def sweep_labels(self):
-        return [("detuning", "Hz"), ("time", "ns")]
-
-    def get_program(self, element, Navg, sweeps, wait_after=50000):
-        delay_sweep = sweeps[1]//4
-        qubit_IF = self.station.config[element].frequency - self.station.config[element].drive.LO_frequency
-        detuning_sweep = qubit_IF + sweeps[0]
-        wait_after = wait_after//4
-        # === START QM program ===
-        with program() as ramsey_prog:
-            n = declare(int)  # QUA variable for the averaging loop
-            tau = declare(int)  # QUA variable for the idle time
-            f = declare(int)  # QUA variable for the idle time
-
-            I = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            Q = declare(fixed)  # QUA variable for the measured 'Q' quadrature
-            I_stream = declare_stream()  # Stream for the 'I' quadrature
-            Q_stream = declare_stream()  # Stream for the 'Q' quadrature
-            n_st = declare_stream()  # Stream for the averaging iteration 'n'
+    def update_detuning(self, element, df):
+        update_frequency(f"drive_{element}", self.qubit_IF(element) + df)
 
-            # Shift the qubit drive frequency to observe Ramsey oscillations
+    def program_settings(self, element):
+        # The detuning is updated from the qubit IF
+        elements = element if type(element) is list else [element]
+        return [super().program_settings(element), [self.qubit_IF(el) for el in elements]]
 
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(f, detuning_sweep)):
-                    update_frequency(f"drive_{element}", f) 
-                    with for_(*from_array(tau, delay_sweep)):
-                        # 1st x90 gate
-                        play(f"{element}_x90", f"drive_{element}")
-                        # Wait a varying idle time
-                        wait(tau, f"drive_{element}")
-                        # 2nd x90 gate
-                        play(f"{element}_x90", f"drive_{element}")
-                        # Align the two elements to measure after playing the qubit pulse.
-                        wait(400 * u.ns, f"drive_{element}")
-                        align(f"drive_{element}", f"resonator_{element}")
-                        # Measure the state of the resonator
-                        standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-
-                    # Save the averaging iteration to get the progress bar
-                save(n, n_st)
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 2 * self.pulse_length(element, "x90") + np.mean(sweeps["time"]) + 400
 
-            with stream_processing():
-                # Cast the data into a 1D vector, average the 1D vectors together and store the results on the OPX processor
-                I_stream.buffer(len(delay_sweep)).buffer(len(detuning_sweep)).average().save("I")
-                Q_stream.buffer(len(delay_sweep)).buffer(len(detuning_sweep)).average().save("Q")
-                n_st.save("iteration")
-            
-        return ramsey_prog
+    def qua_shot(self, element, variables, **kwargs):
+        play(f"{element}_x90", f"drive_{element}")
+        wait(variables["time"], f"drive_{element}")
+        play(f"{element}_x90", f"drive_{element}")
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
     
-    def analyze_data(self, result):
+    def analyze_data(self, result, warm_start=False, processes=None):
         data = result.data
         element = data.attrs["element"]
         self.station.config[element].readout_discriminator.discriminate_data(result.data)
 
-        def exp_sine(time, detune, p0, tau, e0, e1):
-            return e0 + e1 * np.sin(2 * np.pi * detune * time/1e9 + p0) * np.exp(-(time/1e9)/tau)
-
         fig, ax = plt.subplots(constrained_layout=True)
         fig.suptitle(result.get_title())
 
-        detunes = []
-        for detun in data.coords["detuning"]:
-            _data = data["e_state"].sel(detuning=detun)
+        e_state = data["e_state"].transpose("detuning", "time")
+        fits = fit_slices(
+            exp_sine,
+            data["time"].values,
+            e_state.values,
+            [[np.abs(detun)*1.2, 0, 1e-6, 0.5, 0.5] for detun in data["detuning"].values],
+            warm_start=warm_start,
+            processes=processes,
+            maxfev=5000
+        )
+
+        for detun, _data, res in zip(data["detuning"].values, e_state, fits.params):
             _data.plot(ax=ax, x="time", label=f"Detuning (Hz): {float(detun)}")
-            p0 = [np.abs(detun)*1.2, 0, 1e-6, 0.5, 0.5]
-            res, _ = opt.curve_fit(
-                exp_sine,
-                _data["time"],
-                _data,
-                p0=p0,
-                maxfev=5000
-            )
             ax.plot(_data["time"], exp_sine(_data["time"], *res), label=format_res(
                 ["Frequency (Hz)", "T2 (s)"], [res[0], res[2]]
             ))
-            detunes.append(res[0])
 
         ax.set_title("")
         ax.legend()
 
+        if not fits.converged.all():
+            print(f"The Ramsey fit did not converge: {fits.status}")
+            return
+        detunes = fits.params[:, 0]
+
         if any([_det > sum(np.abs(data.coords["detuning"])) for _det in detunes]):
             new_f =  self.station.config[element].frequency + np.sign(data.coords["detuning"][0] - data.coords["detuning"][1]) * sum([np.abs(_det) for _det in detunes]) / 2
         else:
@@ -354,112 +236,85 @@ class Ramsey2F(QTLQMExperiment):
 class T1(QTLQMExperiment):
     experiment_name = "QM-T1"
 
-    def sweep_labels(self):
-        return [("time", "ns"), ]
+    def sweep_spec(self):
+        return [Sweep("time", "ns", int, to_qua=lambda values, element: np.asarray(values) // 4)]
 
-    def get_program(self, element, Navg, sweeps, wait_after=50000):
-        delay_sweep = sweeps[0]//4
-        # === START QM program ===
-        with program() as t1_program:
-            n = declare(int)
-            a = declare(fixed)
-            t = declare(int)
-            I = declare(fixed)
-            Q = declare(fixed)
+    def get_program(self, element, Navg, sweeps, wait_after=50000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
 
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
+    def qua_shot(self, element, variables, **kwargs):
+        play(f"{element}_x180", f"drive_{element}")
+        wait(variables["time"], f"drive_{element}") # in units of 4 ns
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
+    
+    @staticmethod
+    def t1(wait, tau, e0, e1):
+        return np.exp(-(wait/1e9)/tau) * e1 + e0
 
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(t, delay_sweep)):  # QUA for_ loop for sweeping the pulse amplitude pre-factor
-                    # Play the qubit pulse with a variable amplitude (pre-factor to the pulse amplitude defined in the config)
-                    
-                    # play("x180" * amp(a), "qubit")
-                    play(f"{element}_x180", f"drive_{element}")
-                    # wait(t, "qubit")
-                    wait(t, f"drive_{element}") # in units of 4 ns
-                    # Align the two elements to measure after playing the qubit pulse.
-                    wait(400 * u.ns, f"drive_{element}")
-                    align(f"drive_{element}", f"resonator_{element}")
-                    # Measure the state of the resonator
-                    # The integration weights have changed to maximize the SNR after having calibrated the IQ blobs.
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-                # Save the averaging iteration to get the progress bar
-                save(n, n_stream)
+    def fit(self, data):
+        self.station.config[data.attrs["element"]].readout_discriminator.discriminate_data(data)
+        return opt.curve_fit(
+            self.t1,
+            data["time"],
+            data["e_state"],
+            p0=[10e-6, 0, 1]
+        )
+
+    def fit_parameters(self, data):
+        res, cov = self.fit(data)
+        return {"T1": (res[0], np.sqrt(cov[0, 0]))}
 
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(delay_sweep)).average().save("I")
-                Q_stream.buffer(len(delay_sweep)).average().save("Q")
-                n_stream.save("iteration")
-        # === END QM program ===
-        return t1_program
-    
     def analyze_data(self, result):
         data = result.data
-        self.station.config[data.attrs["element"]].readout_discriminator.discriminate_data(data)
+        res, _ = self.fit(data)
 
         fig, ax = plt.subplots(constrained_layout=True)
         fig.suptitle(result.get_title())
 
-        def t1(wait, tau, e0, e1):
-            return np.exp(-(wait/1e9)/tau) * e1 + e0
-        
-        res, _ = opt.curve_fit(
-            t1,
-            data["time"],
-            data["e_state"],
-            p0=[10e-6, 0, 1]
-        )
-        
-
         data["e_state"].plot.scatter(ax=ax, x="time")
-        ax.plot(data.coords["time"], t1(data.coords["time"], *res), label=format_res(
+        ax.plot(data.coords["time"], self.t1(data.coords["time"], *res), label=format_res(
             ["T1 (s)"], [res[0]]
         ))
         ax.legend()
 
+        return {data.attrs["element"]: {
+            "T1": float(res[0])
+        }}
+
 
     
 class SingleShotReadout(QTLQMExperiment):
     experiment_name = "QM-SingleShotReadout"
     readout_type = ReadoutType.single_shot
 
-    def sweep_labels(self):
-        return [("iteration", ""), ("state", "")]
+    def sweep_spec(self):
+        return [Sweep("iteration", averaging=True), state_sweep("state")]
         
-    def get_program(self, element, Navg, sweeps, wait_after=100000):
-        self.station.single_shot = True
-        sweep = [0, 1]
-        with program() as IQ_blobs:
-            n = declare(int)
-            op = declare(int)
-            I = declare(fixed)
-            Q = declare(fixed)
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
+    def get_program(self, element, Navg, sweeps, wait_after=100000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
 
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(op, sweep)):  # QUA for_ loop for sweeping the pulse amplitude pre-factor
-                # Measure the state of the resonator
-                    with if_(op==1):
-                        play(f"{element}_x180", f"drive_{element}")
-                        wait(400 * u.ns, f"drive_{element}")
-                    align(f"drive_{element}", f"resonator_{element}")
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-
-            with stream_processing():
-                # Save all streamed points for plotting the IQ blobs
-                I_stream.buffer(len(sweep)).save_all("I")
-                Q_stream.buffer(len(sweep)).save_all("Q")
-        
-        return IQ_blobs
+    def qua_shot(self, element, variables, **kwargs):
+        with if_(variables["state"] == 1):
+            play(f"{element}_x180", f"drive_{element}")
+            wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
     
     def analyze_data(self, result):
+        if "e_state" in result.data: # Discriminated on the controller
+            e_state = result.data["e_state"]
+            fidelity = 0.5 * (1 - float(e_state.sel(state="ground")) + float(e_state.sel(state="excited")))
+            print(f"Assignment fidelity: {fidelity:.4f}")
+            return
+
         fig, ax = plt.subplots(constrained_layout=True)
         fig.suptitle(result.get_title())
 
+        if "counts" in result.data: # Histograms from the controller
+            for state in result.data["state"].values:
+                result.data["counts"].sel(state=state).plot.contour(ax=ax, x="I", y="Q", levels=5)
+            ax.set_xlabel("I")
+            ax.set_ylabel("Q")
+            return
+
         ax.scatter(
             result.data["iq"].sel(state="ground").real,
             result.data["iq"].sel(state="ground").imag,
@@ -490,136 +345,87 @@ class ReadoutOptimization(QTLQMExperiment):
     experiment_name = "QM-ReadoutOptimization"
     readout_type = ReadoutType.single_shot
 
-    def sweep_labels(self):
-        return [("iteration", ""), ("frequency", "Hz"), ("amplitude", ""), ("state", "")]
+    def sweep_spec(self):
+        return [
+            Sweep("iteration", averaging=True),
+            frequency_sweep("frequency", "resonator", lambda element: self.station.pl_config["PL"].LO_frequency),
+            Sweep("amplitude", "", fixed),
+            state_sweep("state"),
+        ]
     
     def hidden_sweeps(self, **kwargs):
         return {0: np.arange(0, kwargs["Navg"], 1), 3: ["ground", "excited"]}
 
-    def get_program(self, element, Navg, sweeps, wait_after=100000):
-        self.station.single_shot = True
-        sweep_ro_frequency = sweeps[1] - self.station.pl_config["PL"].LO_frequency
-        sweep_amplitude = sweeps[2]
-        sweep_state = [0, 1]
-        with program() as IQ_blobs:
-            n = declare(int)
-            ro_f = declare(int)
-            ro_ampl = declare(fixed)
-            op = declare(int)
-            I = declare(fixed)
-            Q = declare(fixed)
-            I_st = declare_stream()
-            Q_st = declare_stream()
-
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(ro_f, sweep_ro_frequency)):
-                    update_frequency(f"resonator_{element}", ro_f)
-                    with for_(*from_array(ro_ampl, sweep_amplitude)):
-                        with for_(*from_array(op, sweep_state)):  # QUA for_ loop for sweeping the pulse amplitude pre-factor
-                        # Measure the state of the resonator
-                            with if_(op==1):
-                                play(f"{element}_x180", f"drive_{element}")
-                                wait(400 * u.ns, f"drive_{element}")
-                            align(f"drive_{element}", f"resonator_{element}")
-                            measure(
-                                "readout" * amp(ro_ampl/self.station.config[element].readout_amplitude),
-                                f"resonator_{element}",
-                                None,
-                                dual_demod.full("cos", "sin", I),
-                                dual_demod.full("minus_sin", "cos", Q),
-                            )
-                        # Wait for the qubit to decay to the ground state in the case of measurement induced transitions
-                            wait(wait_after//4, f"resonator_{element}")
-                        # Save the 'I' & 'Q' quadratures to their respective streams for the ground state
-                            save(I, I_st)
-                            save(Q, Q_st)
-
-            with stream_processing():
-                # Save all streamed points for plotting the IQ blobs
-                I_st.buffer(len(sweep_state)).buffer(len(sweep_amplitude)).buffer(len(sweep_ro_frequency)).save_all("I")
-                Q_st.buffer(len(sweep_state)).buffer(len(sweep_amplitude)).buffer(len(sweep_ro_frequency)).save_all("Q")
-    
-        return IQ_blobs
-
+    def get_program(self, element, Navg, sweeps, wait_after=100000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
+
+    def qua_shot(self, element, variables, **kwargs):
+        with if_(variables["state"] == 1):
+            play(f"{element}_x180", f"drive_{element}")
+            wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
+
+    def qua_readout(self, element, variables, I, I_stream, Q, Q_stream, wait_after=100000, **kwargs):
+        measure(
+            "readout" * amp(variables["amplitude"] / self.station.config[element].readout_amplitude),
+            f"resonator_{element}",
+            None,
+            dual_demod.full("cos", "sin", I),
+            dual_demod.full("minus_sin", "cos", Q),
+        )
+        # Wait for the qubit to decay to the ground state in the case of measurement induced transitions
+        wait(wait_after//4, f"resonator_{element}")
+        if I_stream is not None: # Discriminated runs save the state instead
+            save(I, I_stream)
+            save(Q, Q_stream)
+
+
+    def fidelities(self, data, method="centroid", chunk_size=None):
+        """
+        Dataset of the ground and excited means and the assignment fidelity of every frequency and amplitude,
+        see utils.assignment_fidelity. With chunk_size only that many frequencies are in memory at once,
+        for datasets opened from disk that are larger than the RAM.
+        """
+        frequencies = data["frequency"].values
+        chunk_size = chunk_size or len(frequencies)
+        chunks = []
+        for start in range(0, len(frequencies), chunk_size):
+            iq = data["iq"].isel(frequency=slice(start, start + chunk_size)).sel(state=["ground", "excited"])
+            chunks.append(assignment_fidelity(iq.transpose("frequency", "amplitude", "iteration", "state").values, method))
+
+        g_mean, e_mean, fidelity = (np.concatenate(arrays) for arrays in zip(*chunks))
+        dims = ["frequency", "amplitude"]
+        return xr.Dataset(
+            data_vars={"g_mean": (dims, g_mean), "e_mean": (dims, e_mean), "fidelity": (dims, fidelity)},
+            coords={"frequency": frequencies, "amplitude": data["amplitude"].values},
+        )
 
-    def analyze_data(self, result):
-        res_data = result.data
+    def analyze_data(self, result, method="centroid", chunk_size=None):
         fig, ax = plt.subplots(constrained_layout=True)
         fig.suptitle(result.get_title())
 
-        fids = np.empty((len(res_data["frequency"].values), len(res_data["amplitude"].values)))
-
-        for i, ro_f in enumerate(res_data["frequency"]):
-            for j, ro_a in enumerate(res_data["amplitude"]):
-                dataslice = res_data.sel(amplitude=ro_a, frequency=ro_f)
-                g_mean = dataslice.sel(state="ground")["iq"].mean()
-                e_mean = dataslice.sel(state="excited")["iq"].mean()
-
-                dist_to_g = np.abs(dataslice["iq"] - g_mean)
-                dist_to_e = np.abs(dataslice["iq"] - e_mean)
-
-                disc_data = np.where(dist_to_e < dist_to_g, 1, 0)
-                dataslice["discriminated"] = xr.DataArray(disc_data, coords={
-                    "iteration": dataslice["iteration"].values,
-                    "state": dataslice["state"].values
-                }, dims=["iteration", "state"])
-                N = len(dataslice["iteration"].values)
-                
-                fid = 0.5 * (
-                    int(dataslice["discriminated"].sel(state="excited").sum())/N +
-                    (N - int(dataslice["discriminated"].sel(state="ground").sum()))/N
-                )
-
-                fids[i][j] = fid
-
-        fid_ds = xr.DataArray(
-            fids, coords={"frequency": res_data["frequency"].values, "amplitude": res_data["amplitude"].values},
-            dims=["frequency", "amplitude"]
-        )
-        fid_ds.plot(ax=ax, x="frequency")
+        self.fidelities(result.data, method, chunk_size)["fidelity"].plot(ax=ax, x="frequency")
 
 
 class ErrorRabi(QTLQMExperiment):
     experiment_name = "QM-ErrorRabi"
 
-    def sweep_labels(self):
-        return [("amplitude", ""), ("nr_of_pulses", "")]
+    def sweep_spec(self):
+        return [
+            Sweep("amplitude", "", fixed, to_qua=lambda values, element: np.asarray(values) / self.station.config[element].X180_amplitude),
+            Sweep("nr_of_pulses", "", int),
+        ]
     
-    def get_program(self, element, Navg, sweeps, wait_after=100000):
-        current_amp = self.station.config[element].X180_amplitude
-        amplitudes = sweeps[0] / current_amp
-        nr_of_puless = sweeps[1]
+    def get_program(self, element, Navg, sweeps, wait_after=100000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
 
-        with program() as error_rabi:
-            I = declare(fixed)
-            Q = declare(fixed)
-            n = declare(int)
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return np.mean(sweeps["nr_of_pulses"]) * self.pulse_length(element, "x180") + 400
 
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
-
-            var_amp = declare(fixed)
-            n_pulse = declare(int)
-            i = declare(int)
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(var_amp, amplitudes)):
-                    with for_(*from_array(n_pulse, nr_of_puless)):
-                        # Play pulses
-                        with for_(i, 0, i < n_pulse, i + 1):
-                            play(f"{element}_x180" * amp(var_amp), f"drive_{element}")
-                        wait(400 * u.ns, f"drive_{element}")
-                        align(f"drive_{element}", f"resonator_{element}")
-                        standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-                save(n, n_stream)
-
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(nr_of_puless)).buffer(len(amplitudes)).average().save("I")
-                Q_stream.buffer(len(nr_of_puless)).buffer(len(amplitudes)).average().save("Q")
-                n_stream.save("iteration")
-
-        return error_rabi
+    def qua_shot(self, element, variables, **kwargs):
+        i = declare(int)
+        with for_(i, 0, i < variables["nr_of_pulses"], i + 1):
+            play(f"{element}_x180" * amp(variables["amplitude"]), f"drive_{element}")
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
 
 
 class DragCalibration(QTLQMExperiment):
@@ -628,6 +434,10 @@ class DragCalibration(QTLQMExperiment):
     def sweep_labels(self):
         return [("coef", ""), ("seq_id", "")]
     
+    def drive_duration(self, element, sweeps, run_kwargs):
+        # Every seq_id point is its own readout
+        return self.pulse_length(element, "x180") + self.pulse_length(element, "x90") + 400
+
     def get_program(self, element, Navg, sweeps, wait_after=100000):
         current_coef = self.station.config[element].drag_coef
         with self.station.change_settings():
@@ -651,14 +461,14 @@ class DragCalibration(QTLQMExperiment):
                 with for_(*from_array(var_amp, coefs)):
                     play(f"{element}_x180" * amp(1, 0, 0, var_amp), f"drive_{element}")
                     play(f"{element}_y90" * amp(var_amp, 0, 0, 1), f"drive_{element}")
-                    wait(400 * u.ns, f"drive_{element}")
+                    wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
                     align(f"drive_{element}", f"resonator_{element}")
                     standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
                     
                     align()
                     play(f"{element}_y180" * amp(var_amp, 0, 0, 1), f"drive_{element}")
                     play(f"{element}_x90" * amp(1, 0, 0, var_amp), f"drive_{element}")
-                    wait(400 * u.ns, f"drive_{element}")
+                    wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
                     align(f"drive_{element}", f"resonator_{element}")
                     standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
                 save(n, n_stream)
@@ -676,149 +486,108 @@ class DragCalibration(QTLQMExperiment):
 class DragCalibrationErrorAmp(QTLQMExperiment):
     experiment_name = "QM-DragCalibrationErrorAmp"
 
-    def sweep_labels(self):
-        return [("coef", ""), ("nr_of_pulses", "")]
+    def sweep_spec(self):
+        return [Sweep("coef", "", fixed), Sweep("nr_of_pulses", "", int)]
     
-    def get_program(self, element, Navg, sweeps, wait_after=100000):
-        amplitudes = sweeps[0]
-        nr_of_puless = sweeps[1]
-
-        with program() as error_rabi:
-            I = declare(fixed)
-            Q = declare(fixed)
-            n = declare(int)
-
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
-
-            var_amp = declare(fixed)
-            n_pulse = declare(int)
-            i = declare(int)
-            with for_(n, 0, n < Navg, n + 1):
-                with for_(*from_array(var_amp, amplitudes)):
-                    with for_(*from_array(n_pulse, nr_of_puless)):
-                        # Play pulses
-                        with for_(i, 0, i < n_pulse, i + 1):
-                            play(f"{element}_x180" * amp(1, 0, 0, var_amp), f"drive_{element}")
-                            play(f"{element}_x180" * amp(-1, 0, 0, -var_amp), f"drive_{element}")
-                        wait(400 * u.ns, f"drive_{element}")
-                        align(f"drive_{element}", f"resonator_{element}")
-                        standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-                save(n, n_stream)
+    def get_program(self, element, Navg, sweeps, wait_after=100000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
 
-            with stream_processing():
-                # Cast the data into a 2D matrix, average the 2D matrices together and store the results on the OPX processor
-                I_stream.buffer(len(nr_of_puless)).buffer(len(amplitudes)).average().save("I")
-                Q_stream.buffer(len(nr_of_puless)).buffer(len(amplitudes)).average().save("Q")
-                n_stream.save("iteration")
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 2 * np.mean(sweeps["nr_of_pulses"]) * self.pulse_length(element, "x180") + 400
 
-        return error_rabi
+    def qua_shot(self, element, variables, **kwargs):
+        coef = variables["coef"]
+        i = declare(int)
+        with for_(i, 0, i < variables["nr_of_pulses"], i + 1):
+            play(f"{element}_x180" * amp(1, 0, 0, coef), f"drive_{element}")
+            play(f"{element}_x180" * amp(-1, 0, 0, -coef), f"drive_{element}")
+        wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
 
 
 class AllXY(QTLQMExperiment):
     experiment_name = "QM-AllXY"
 
-    def sweep_labels(self):
-        return [("gate", "")]
+    def sweep_spec(self):
+        return [Sweep("gate", "", int)]
     
     def hidden_sweeps(self, **kwargs):
         return {0: np.arange(0, 21, 1)}
     
-    def get_program(self, element, Navg, sweeps, wait_after=100000):
-        gate_indexes = sweeps[0]
-
-        with program() as allxy_prog:
-            i = declare(int)
-
-            I = declare(fixed)
-            Q = declare(fixed)
-            n = declare(int)
-
-            I_stream = declare_stream()
-            Q_stream = declare_stream()
-            n_stream = declare_stream()
-
-            with for_(n, 0, n < Navg, n+1):
-                with for_(i, 0, i < len(gate_indexes), i+1):
-                    with switch_(i):
-                        with case_(0):
-                            play(f"{element}_idle", f"drive_{element}")
-                            play(f"{element}_idle", f"drive_{element}")
-                        with case_(1):
-                            play(f"{element}_x180", f"drive_{element}")
-                            play(f"{element}_x180", f"drive_{element}")
-                        with case_(2):
-                            play(f"{element}_y180", f"drive_{element}")
-                            play(f"{element}_y180", f"drive_{element}")
-                        with case_(3):
-                            play(f"{element}_x180", f"drive_{element}")
-                            play(f"{element}_y180", f"drive_{element}")
-                        with case_(4):
-                            play(f"{element}_y180", f"drive_{element}")
-                            play(f"{element}_x180", f"drive_{element}")
-                        
-                        with case_(5):
-                            play(f"{element}_x90", f"drive_{element}")
-                            wait(100//4, f"drive_{element}")
-                        with case_(6):
-                            play(f"{element}_y90", f"drive_{element}")
-                            wait(100//4, f"drive_{element}")
-                        with case_(7):
-                            play(f"{element}_x90", f"drive_{element}")
-                            play(f"{element}_y90", f"drive_{element}")
-                        with case_(8):
-                            play(f"{element}_y90", f"drive_{element}")
-                            play(f"{element}_x90", f"drive_{element}")
-
-                        with case_(9):
-                            play(f"{element}_x90", f"drive_{element}")
-                            play(f"{element}_y180", f"drive_{element}")
-                        with case_(10):
-                            play(f"{element}_y90", f"drive_{element}")
-                            play(f"{element}_x180", f"drive_{element}")
-                        with case_(11):
-                            play(f"{element}_x180", f"drive_{element}")
-                            play(f"{element}_y90", f"drive_{element}")
-                        with case_(12):
-                            play(f"{element}_y180", f"drive_{element}")
-                            play(f"{element}_x90", f"drive_{element}")
-
-                        with case_(13):
-                            play(f"{element}_x90", f"drive_{element}")
-                            play(f"{element}_x180", f"drive_{element}")
-                        with case_(14):
-                            play(f"{element}_x180", f"drive_{element}")
-                            play(f"{element}_x90", f"drive_{element}")
-                        with case_(15):
-                            play(f"{element}_y90", f"drive_{element}")
-                            play(f"{element}_y180", f"drive_{element}")
-                        with case_(16):
-                            play(f"{element}_y180", f"drive_{element}")
-                            play(f"{element}_y90", f"drive_{element}")
-                        
-                        with case_(17):
-                            play(f"{element}_x180", f"drive_{element}")
-                            wait(100//4, f"drive_{element}")
-                        with case_(18):
-                            play(f"{element}_y180", f"drive_{element}")
-                            wait(100//4, f"drive_{element}")
-                        with case_(19):
-                            play(f"{element}_x90", f"drive_{element}")
-                            play(f"{element}_x90", f"drive_{element}")
-                        with case_(20):
-                            play(f"{element}_y90", f"drive_{element}")
-                            play(f"{element}_y90", f"drive_{element}")
-                    
-                    wait(100, f"drive_{element}")
-                    align(f"drive_{element}", f"resonator_{element}")
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
-                    align(f"drive_{element}", f"resonator_{element}")
-                    save(n, n_stream)
-
-            with stream_processing():
-                I_stream.buffer(len(gate_indexes)).average().save("I")
-                Q_stream.buffer(len(gate_indexes)).average().save("Q")
-                n_stream.save("iteration")
-
-        return allxy_prog
\ No newline at end of file
+    def get_program(self, element, Navg, sweeps, wait_after=100000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
+
+    def drive_duration(self, element, sweeps, run_kwargs):
+        # Two gates and the wait of 100 clock cycles
+        return 2 * self.pulse_length(element, "x180") + 400
+
+    def qua_shot(self, element, variables, **kwargs):
+        with switch_(variables["gate"]):
+            with case_(0):
+                play(f"{element}_idle", f"drive_{element}")
+                play(f"{element}_idle", f"drive_{element}")
+            with case_(1):
+                play(f"{element}_x180", f"drive_{element}")
+                play(f"{element}_x180", f"drive_{element}")
+            with case_(2):
+                play(f"{element}_y180", f"drive_{element}")
+                play(f"{element}_y180", f"drive_{element}")
+            with case_(3):
+                play(f"{element}_x180", f"drive_{element}")
+                play(f"{element}_y180", f"drive_{element}")
+            with case_(4):
+                play(f"{element}_y180", f"drive_{element}")
+                play(f"{element}_x180", f"drive_{element}")
+
+            with case_(5):
+                play(f"{element}_x90", f"drive_{element}")
+                wait(100//4, f"drive_{element}")
+            with case_(6):
+                play(f"{element}_y90", f"drive_{element}")
+                wait(100//4, f"drive_{element}")
+            with case_(7):
+                play(f"{element}_x90", f"drive_{element}")
+                play(f"{element}_y90", f"drive_{element}")
+            with case_(8):
+                play(f"{element}_y90", f"drive_{element}")
+                play(f"{element}_x90", f"drive_{element}")
+
+            with case_(9):
+                play(f"{element}_x90", f"drive_{element}")
+                play(f"{element}_y180", f"drive_{element}")
+            with case_(10):
+                play(f"{element}_y90", f"drive_{element}")
+                play(f"{element}_x180", f"drive_{element}")
+            with case_(11):
+                play(f"{element}_x180", f"drive_{element}")
+                play(f"{element}_y90", f"drive_{element}")
+            with case_(12):
+                play(f"{element}_y180", f"drive_{element}")
+                play(f"{element}_x90", f"drive_{element}")
+
+            with case_(13):
+                play(f"{element}_x90", f"drive_{element}")
+                play(f"{element}_x180", f"drive_{element}")
+            with case_(14):
+                play(f"{element}_x180", f"drive_{element}")
+                play(f"{element}_x90", f"drive_{element}")
+            with case_(15):
+                play(f"{element}_y90", f"drive_{element}")
+                play(f"{element}_y180", f"drive_{element}")
+            with case_(16):
+                play(f"{element}_y180", f"drive_{element}")
+                play(f"{element}_y90", f"drive_{element}")
+
+            with case_(17):
+                play(f"{element}_x180", f"drive_{element}")
+                wait(100//4, f"drive_{element}")
+            with case_(18):
+                play(f"{element}_y180", f"drive_{element}")
+                wait(100//4, f"drive_{element}")
+            with case_(19):
+                play(f"{element}_x90", f"drive_{element}")
+                play(f"{element}_x90", f"drive_{element}")
+            with case_(20):
+                play(f"{element}_y90", f"drive_{element}")
+                play(f"{element}_y90", f"drive_{element}")
+
+        wait(100, f"drive_{element}")
@@ -3,51 +3,54 @@ import scipy.optimize as opt
 import matplotlib.pyplot as plt
 
 from qm.qua import *
-from qualang_tools.loops import from_array
 
-from qtl_control.qtl_station.station import u
 from qtl_control.qtl_experiments import QTLQMExperiment
 from qtl_control.qtl_experiments.utils import *
+from qtl_control.qtl_experiments.sweeps import Sweep, frequency_sweep, flux_sweep, state_sweep
+from qtl_control.qtl_experiments.fitting import fit_slices
 
 class ReadoutResonatorSpectroscopy(QTLQMExperiment):
     experiment_name = "QM-ReadoutResonatorSpectroscopy"
+    decay_wait = False # wait_after is for the resonator to deplete
 
-    def sweep_labels(self):
-        return [("readout_frequency", "Hz"), ]
-
-    def get_program(self, element, Navg, sweeps, wait_after=1000):
-        sweep = sweeps[0] - self.station.config["PL"].LO_frequency
-        with program() as resonator_spec:
-            n = declare(int)  # QUA variable for the averaging loop
-            f = declare(int)  # QUA variable for the readout frequency
-            I = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            Q = declare(fixed)  # QUA variable for the measured 'Q' quadrature
-            I_st = declare_stream()  # Stream for the 'I' quadrature
-            Q_st = declare_stream()  # Stream for the 'Q' quadrature
-            n_st = declare_stream()  # Stream for the averaging iteration 'n'
-
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(f, sweep)):  # QUA for_ loop for sweeping the frequency
-                    update_frequency(f"resonator_{element}", f)
-                    # Measure the resonator (send a readout pulse and demodulate the signals to get the 'I' & 'Q' quadratures)
-                    standard_readout(f"resonator_{element}", I, I_st, Q, Q_st, wait_after)
-                # Save the averaging iteration to get the progress bar
-                save(n, n_st)
-
-            with stream_processing():
-                I_st.buffer(len(sweep)).average().save("I")
-                Q_st.buffer(len(sweep)).average().save("Q")
-                n_st.save("iteration")
-        
-        return resonator_spec
-    
-    def analyze_data(self, result, plot=True):
-        res, _ = opt.curve_fit(
+    def sweep_spec(self):
+        return [frequency_sweep("readout_frequency", "resonator", lambda element: self.station.config["PL"].LO_frequency)]
+
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 0 # No qubit drive
+
+    def get_program(self, element, Navg, sweeps, wait_after=1000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
+
+    def locate_feature(self, data):
+        # Minimum of the notch fit, the minimum of the data if it does not fit
+        frequencies = data.coords["readout_frequency"].values
+        magnitude = np.abs(data["iq"].values)
+        try:
+            res, _ = opt.curve_fit(
+                notch_res_abs, frequencies, magnitude,
+                p0=[frequencies[np.argmin(magnitude)], magnitude.max(), 0, 1e5, 1e5]
+            )
+        except RuntimeError:
+            return frequencies[np.argmin(magnitude)]
+
+        dense = np.linspace(frequencies.min(), frequencies.max(), 100 * len(frequencies))
+        return dense[np.argmin(notch_res_abs(dense, *res))]
+
+    def fit(self, data):
+        return opt.curve_fit(
             notch_res_abs,
-            result.data.coords["readout_frequency"],
-            np.abs(result.data["iq"]),
-            p0=[result.data.coords["readout_frequency"].mean(), np.abs(result.data["iq"]).max(), 0, 1e5, 1e5]
+            data.coords["readout_frequency"],
+            np.abs(data["iq"]),
+            p0=[data.coords["readout_frequency"].mean(), np.abs(data["iq"]).max(), 0, 1e5, 1e5]
         )
+
+    def fit_parameters(self, data):
+        res, cov = self.fit(data)
+        return {"readout_frequency": (res[0], np.sqrt(cov[0, 0]))}
+
+    def analyze_data(self, result, plot=True):
+        res, _ = self.fit(result.data)
         if plot:
             axs = result.mag_phase_plot()
             axs[0].plot(
@@ -68,57 +71,44 @@ class ReadoutResonatorSpectroscopy(QTLQMExperiment):
 
 class ReadoutFluxSpectroscopy(QTLQMExperiment):
     experiment_name = "QM-ReadoutFluxSpectroscopy"
+    decay_wait = False # wait_after is for the resonator to deplete
 
-    def sweep_labels(self):
-        return [("amplitude", "arb"), ("readout_frequency", "Hz")]
-
-    def get_program(self, element, Navg, sweeps, wait_after=1000):
-        amp_sweep = sweeps[0]
-        if_sweep = sweeps[1] - self.station.config["PL"].LO_frequency
-        with program() as resonator_spec:
-            n = declare(int)  # QUA variable for the averaging loop
-            f = declare(int)  # QUA variable for the readout frequency
-            a = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            I = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            Q = declare(fixed)  # QUA variable for the measured 'Q' quadrature
-            I_st = declare_stream()  # Stream for the 'I' quadrature
-            Q_st = declare_stream()  # Stream for the 'Q' quadrature
-            n_st = declare_stream()  # Stream for the averaging iteration 'n'
-
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(a, amp_sweep)):  # QUA for_ loop for sweeping the frequency
-                    set_dc_offset(f"flux_{element}", "single", a)
-                    with for_(*from_array(f, if_sweep)):  # QUA for_ loop for sweeping the frequency
-                        update_frequency(f"resonator_{element}", f)
-                        # Measure the resonator (send a readout pulse and demodulate the signals to get the 'I' & 'Q' quadratures)
-                        standard_readout(f"resonator_{element}", I, I_st, Q, Q_st, wait_after)
-
-                    # Save the averaging iteration to get the progress bar
-                save(n, n_st)
-
-            with stream_processing():
-                I_st.buffer(len(if_sweep)).buffer(len(amp_sweep)).average().save("I")
-                Q_st.buffer(len(if_sweep)).buffer(len(amp_sweep)).average().save("Q")
-                n_st.save("iteration")
-        
-        return resonator_spec
-    
-    def analyze_data(self, result, p0=None):
+    def sweep_spec(self):
+        return [
+            flux_sweep("amplitude", "arb"),
+            frequency_sweep("readout_frequency", "resonator", lambda element: self.station.config["PL"].LO_frequency),
+        ]
+
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 0 # No qubit drive
+
+    def get_program(self, element, Navg, sweeps, wait_after=1000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
+
+    def analyze_data(self, result, p0=None, warm_start=False, processes=None):
+        """
+        Notch fit of every flux amplitude with fit_slices, optionally warm started from the amplitude
+        before or in processes, and a cosine fit of the resonator frequencies of the converged ones
+        """
         data = result.data
+        readout_frequency = data["readout_frequency"].values
 
-        fits = []
-        amplitudes = data.coords["amplitude"]
-        for a in amplitudes:
-            data_slice = np.abs(data["iq"].sel(amplitude=a))
-            res, _ = opt.curve_fit(
-                notch_res_abs,
-                data_slice["readout_frequency"],
-                data_slice,
-                p0=[float(data_slice["readout_frequency"].mean()), 0.001, 0, 10e6, 10e6]
-            )
-            fits.append(res)
+        fits = fit_slices(
+            notch_res_abs,
+            readout_frequency,
+            np.abs(data["iq"].transpose("amplitude", "readout_frequency").values),
+            [readout_frequency.mean(), 0.001, 0, 10e6, 10e6],
+            warm_start=warm_start,
+            processes=processes,
+        )
+        if not fits.converged.any():
+            print("The notch fit did not converge for any amplitude")
+            return
+        if not fits.converged.all():
+            print(f"The notch fit did not converge for {np.sum(~fits.converged)} amplitudes")
 
-        frequencies = [_[0] for _ in fits]
+        amplitudes = data.coords["amplitude"].values[fits.converged]
+        frequencies = fits.params[fits.converged, 0]
 
         def cosine_dep(v, period, offset, a, b):
             return a * np.cos(2 * np.pi * (v-offset)/period) + b
@@ -129,8 +119,8 @@ class ReadoutFluxSpectroscopy(QTLQMExperiment):
             amplitudes,
             frequencies,
             bounds=(
-                [0.0001, -1, 0, float(data_slice["readout_frequency"].min())],
-                [1, 1, 1e9, float(data_slice["readout_frequency"].max())]
+                [0.0001, -1, 0, readout_frequency.min()],
+                [1, 1, 1e9, readout_frequency.max()]
             ),
             p0=p0,
             ftol=1e-10, xtol=1e-10, gtol=1e-10
@@ -155,90 +145,50 @@ class ReadoutFluxSpectroscopy(QTLQMExperiment):
 
 class PunchOut(QTLQMExperiment):
     experiment_name = "QM-PunchOut"
-
-    def sweep_labels(self):
-        return ["readout_frequency", "amplitude"]
-
-    def get_program(self, element, Navg, sweeps, wait_after=1000):
-        freq_sweep = sweeps[0] - self.station.config["PL"].LO_frequency
-        amplitude_sweep = sweeps[1]
-        with program() as resonator_spec:
-            n = declare(int)  # QUA variable for the averaging loop
-            f = declare(int)  # QUA variable for the readout frequency
-            a = declare(fixed)  # QUA variable for the readout amplitude pre-factor
-            I = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            Q = declare(fixed)  # QUA variable for the measured 'Q' quadrature
-            I_st = declare_stream()  # Stream for the 'I' quadrature
-            Q_st = declare_stream()  # Stream for the 'Q' quadrature
-            n_st = declare_stream()  # Stream for the averaging iteration 'n'
-
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(f, freq_sweep)):  # QUA for_ loop for sweeping the frequency
-                    update_frequency(f"resonator_{element}", f)
-                    with for_each_(a, amplitude_sweep):
-                    # Measure the resonator (send a readout pulse and demodulate the signals to get the 'I' & 'Q' quadratures)
-                        measure(
-                            "readout" * amp(a),
-                            f"resonator_{element}",
-                            None,
-                            dual_demod.full("cos", "sin", I),
-                            dual_demod.full("minus_sin", "cos", Q),
-                        )
-                        # Wait for the resonator to deplete
-                        wait(wait_after//4, f"resonator_{element}")
-                        # Save the 'I' & 'Q' quadratures to their respective streams
-                        save(I, I_st)
-                        save(Q, Q_st)
-                # Save the averaging iteration to get the progress bar
-                save(n, n_st)
-
-            with stream_processing():
-                I_st.buffer(len(amplitude_sweep)).buffer(len(freq_sweep)).average().save("I")
-                Q_st.buffer(len(amplitude_sweep)).buffer(len(freq_sweep)).average().save("Q")
-                n_st.save("iteration")
-        
-        return resonator_spec
+    decay_wait = False # wait_after is for the resonator to deplete
+
+    def sweep_spec(self):
+        return [
+            frequency_sweep("readout_frequency", "resonator", lambda element: self.station.config["PL"].LO_frequency),
+            Sweep("amplitude", "", fixed),
+        ]
+
+    def drive_duration(self, element, sweeps, run_kwargs):
+        return 0 # No qubit drive
+
+    def get_program(self, element, Navg, sweeps, wait_after=1000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
+
+    def qua_readout(self, element, variables, I, I_stream, Q, Q_stream, wait_after=1000, **kwargs):
+        measure(
+            "readout" * amp(variables["amplitude"]),
+            f"resonator_{element}",
+            None,
+            dual_demod.full("cos", "sin", I),
+            dual_demod.full("minus_sin", "cos", Q),
+        )
+        # Wait for the resonator to deplete
+        wait(wait_after//4, f"resonator_{element}")
+        save(I, I_stream)
+        save(Q, Q_stream)
 
 
 class DispersiveShift(QTLQMExperiment):
     experiment_name = "QM-DispersiveShift"
 
-    def sweep_labels(self):
-        return [("readout_frequency", "Hz"), ("state", "")]
-
-    def get_program(self, element, Navg, sweeps, wait_after=10000):
-        sweep = sweeps[0] - self.station.config["PL"].LO_frequency
-        sweep_state = [0, 1]
-        with program() as resonator_spec:
-            n = declare(int)  # QUA variable for the averaging loop
-            f = declare(int)  # QUA variable for the readout frequency
-            op = declare(int)
-            I = declare(fixed)  # QUA variable for the measured 'I' quadrature
-            Q = declare(fixed)  # QUA variable for the measured 'Q' quadrature
-            I_st = declare_stream()  # Stream for the 'I' quadrature
-            Q_st = declare_stream()  # Stream for the 'Q' quadrature
-            n_st = declare_stream()  # Stream for the averaging iteration 'n'
-
-            with for_(n, 0, n < Navg, n + 1):  # QUA for_ loop for averaging
-                with for_(*from_array(f, sweep)):  # QUA for_ loop for sweeping the frequency
-                    update_frequency(f"resonator_{element}", f)
-                    with for_(*from_array(op, sweep_state)):  # QUA for_ loop for sweeping the pulse amplitude pre-factor
-                # Measure the state of the resonator
-                        with if_(op==1):
-                            play(f"{element}_x180", f"drive_{element}")
-                            wait(400 * u.ns, f"drive_{element}")
-                        align(f"drive_{element}", f"resonator_{element}")
-                    # Measure the resonator (send a readout pulse and demodulate the signals to get the 'I' & 'Q' quadratures)
-                        standard_readout(f"resonator_{element}", I, I_st, Q, Q_st, wait_after)
-                # Save the averaging iteration to get the progress bar
-                save(n, n_st)
-
-            with stream_processing():
-                I_st.buffer(len(sweep_state)).buffer(len(sweep)).average().save("I")
-                Q_st.buffer(len(sweep_state)).buffer(len(sweep)).average().save("Q")
-                n_st.save("iteration")
-        
-        return resonator_spec
+    def sweep_spec(self):
+        return [
+            frequency_sweep("readout_frequency", "resonator", lambda element: self.station.config["PL"].LO_frequency),
+            state_sweep("state"),
+        ]
+
+    def get_program(self, element, Navg, sweeps, wait_after=10000, **kwargs):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after, **kwargs)
+
+    def qua_shot(self, element, variables, **kwargs):
+        with if_(variables["state"] == 1):
+            play(f"{element}_x180", f"drive_{element}")
+            wait(400 // 4, f"drive_{element}") # 400 ns in clock cycles
     
     def analyze_data(self, result):
         fig, ax = plt.subplots(constrained_layout=True)
@@ -0,0 +1,78 @@
+import json
+
+import numpy as np
+
+
+class RuntimeModel:
+    """
+    Learned correction of the estimated hardware time of the experiments, see
+    QTLQMExperiment.estimate_duration. Every run logs its estimated_duration against the measured
+    execute time, the correction of an experiment is the median ratio of its last window runs.
+    """
+    def __init__(self, window=20):
+        self.window = window
+        self.ratios = dict()
+        self.log = []
+
+    def update(self, experiment_name, estimated, measured):
+        if not estimated or not measured:
+            return
+        self.log.append({"experiment": experiment_name, "estimated": estimated, "measured": measured})
+        ratios = self.ratios.setdefault(experiment_name, [])
+        ratios.append(measured / estimated)
+        del ratios[:-self.window]
+
+    def record(self, experiment_name, record):
+        """
+        Update from the metrics record of a run, see metrics.py
+        """
+        execute = record["stages"].get("execute")
+        if execute is not None:
+            self.update(experiment_name, record.get("estimated_duration"), execute["wall"])
+
+    def correction(self, experiment_name):
+        ratios = self.ratios.get(experiment_name)
+        return float(np.median(ratios)) if ratios else 1.0
+
+    def load(self, path):
+        """
+        Learn from the records of a JSONLinesSink file
+        """
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                self.record(record["experiment"], record)
+        return self
+
+
+def plan_campaign(items, budget):
+    """
+    Pack items of (experiment, element, sweeps, kwargs), like for station.submit_batch, into a time
+    budget in seconds from their estimated durations. The items are in order of priority, every
+    item that still fits is scheduled and the others are deferred. Returns a dict with the
+    scheduled and deferred [(item, estimate), ...] and the total estimated time.
+    """
+    scheduled, deferred, total = [], [], 0.0
+    for item in items:
+        experiment, element, sweeps, kwargs = item
+        estimate = experiment.estimate_runtime(element, sweeps, **kwargs)
+        if estimate is None:
+            continue
+        if total + estimate <= budget:
+            scheduled.append((item, estimate))
+            total += estimate
+        else:
+            deferred.append((item, estimate))
+
+    return {"scheduled": scheduled, "deferred": deferred, "total": total}
+
+
+def run_plan(plan, autosave=True):
+    """
+    Submit the scheduled items of a plan back to back, returns the futures of their ExperimentResults
+    in order of plan["scheduled"], see station.submit_batch
+    """
+    items = [item for item, _ in plan["scheduled"]]
+    if not items:
+        return []
+    return items[0][0].station.submit_batch(items, autosave=autosave)
@@ -4,7 +4,7 @@ from qtl_control.qtl_experiments import QTLQMExperiment
 
 from qm.qua import *
 from qualang_tools.loops import from_array
-from qtl_control.qtl_experiments.utils import standard_readout, format_res
+from qtl_control.qtl_experiments.utils import standard_readout, save_reset_rounds, format_res
 
 
 # Define matrices
@@ -171,7 +171,11 @@ class SingleQubitRB(QTLQMExperiment):
     def sweep_labels(self):
         return [("clifford_depth", ""), ]
 
-    def get_program(self, element, Navg, sweeps, wait_after=50000):
+    def drive_duration(self, element, sweeps, run_kwargs):
+        # 1.875 pulses per clifford on average and the 400 ns wait
+        return 1.875 * np.mean(sweeps["clifford_depth"]) * self.pulse_length(element, "x180") + 400
+
+    def get_program(self, element, Navg, sweeps, wait_after=50000, active_reset=False, reset_rounds=4, reset_wait=1000):
         depth_sweep = sweeps[0]
         depth_sequencies = []
         for d in depth_sweep:
@@ -190,6 +194,8 @@ class SingleQubitRB(QTLQMExperiment):
             I_stream = declare_stream()
             Q_stream = declare_stream()
             n_stream = declare_stream()
+            rounds = declare(int)
+            rounds_stream = declare_stream()
             
             depths = declare(int, value=depth_sweep.tolist())
             depth_seqs = declare(int, value=depth_sequencies)
@@ -203,7 +209,9 @@ class SingleQubitRB(QTLQMExperiment):
                         play_sequence(depth_seqs, seqs_ind[i], depths[i], element)
                     wait(100, f"drive_{element}") # 400ns
                     align(f"drive_{element}", f"resonator_{element}")
-                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, wait_after)
+                    standard_readout(f"resonator_{element}", I, I_stream, Q, Q_stream, reset_wait if active_reset else wait_after)
+                    if active_reset:
+                        self.qua_active_reset(element, I, Q, rounds, rounds_stream, reset_rounds, reset_wait)
                     align(f"drive_{element}", f"resonator_{element}")
                 save(n, n_stream)
         
@@ -211,6 +219,8 @@ class SingleQubitRB(QTLQMExperiment):
                 I_stream.buffer(len(depth_sweep)).average().save("I")
                 Q_stream.buffer(len(depth_sweep)).average().save("Q")
                 n_stream.save("iteration")
+                if active_reset:
+                    save_reset_rounds(rounds_stream, "reset", reset_rounds)
         
         return rb_prog
     
@@ -0,0 +1,91 @@
+import numpy as np
+
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from qm.qua import fixed, for_, for_each_, update_frequency, set_dc_offset
+from qualang_tools.loops import from_array
+
+
+# Relative cost of changing a sweep value in the QUA loop, costlier sweeps get the outer loops
+UPDATE_FREQUENCY_COST = 1
+SET_DC_OFFSET_COST = 10
+
+STATES = ["ground", "excited"]
+
+
+@dataclass
+class Sweep:
+    """
+    One sweep of an experiment, the label and unit of its dataset coordinate and how it is looped over.
+    to_qua(values, element) gives the values of the QUA loop variable from the swept values, and
+    apply(element, variable) is the QUA to run on an element when the variable changes, costing cost.
+    The averaging sweep is the iteration of single shot experiments, it is the Navg loop itself.
+    """
+    label: str
+    unit: str = ""
+    qua_type: type = fixed
+    to_qua: Optional[Callable] = None
+    apply: Optional[Callable] = None
+    cost: int = 0
+    averaging: bool = False
+
+    def qua_values(self, values, element):
+        values = np.asarray(values if self.to_qua is None else self.to_qua(values, element))
+        if self.qua_type is int:
+            return np.rint(values).astype(int)
+        return values.astype(float)
+
+    def apply_to(self, elements, variable):
+        if self.apply is not None:
+            for element in elements:
+                self.apply(element, variable)
+
+
+def loop_order(spec):
+    """
+    Indices of the sweeps of a spec in the order of the QUA loops, outermost first. The averaging
+    sweep is always outermost, the others go from the most to the least expensive to change.
+    """
+    averaging = [i for i, sweep in enumerate(spec) if sweep.averaging]
+    loops = sorted((i for i, sweep in enumerate(spec) if not sweep.averaging), key=lambda i: -spec[i].cost)
+    return averaging + loops
+
+
+def qua_loop(variable, values):
+    """
+    Arithmetic for_ loop over evenly spaced values, for_each_ over an array for anything else
+    """
+    if len(values) > 1 and np.allclose(np.diff(values), values[1] - values[0], rtol=1e-9, atol=0):
+        return for_(*from_array(variable, values))
+    return for_each_(variable, values.tolist())
+
+
+def frequency_sweep(label, channel, lo_frequency):
+    """
+    Sweep of the frequency of {channel}_{element}, looped over the IF from lo_frequency(element)
+    """
+    return Sweep(
+        label, "Hz", int,
+        to_qua=lambda values, element: np.asarray(values) - lo_frequency(element),
+        apply=lambda element, f: update_frequency(f"{channel}_{element}", f),
+        cost=UPDATE_FREQUENCY_COST,
+    )
+
+
+def flux_sweep(label="amplitude", unit="arb"):
+    """
+    Sweep of the DC offset of flux_{element}
+    """
+    return Sweep(
+        label, unit, fixed,
+        apply=lambda element, a: set_dc_offset(f"flux_{element}", "single", a),
+        cost=SET_DC_OFFSET_COST,
+    )
+
+
+def state_sweep(label="state"):
+    """
+    Sweep of the prepared qubit state, the QUA variable is 0 for ground and 1 for excited
+    """
+    return Sweep(label, "", int, to_qua=lambda values, element: [STATES.index(state) for state in values])
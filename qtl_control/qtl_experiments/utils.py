@@ -1,13 +1,8 @@
 import numpy as np
 
-from enum import Enum
-
 from qm.qua import *
 
-
-class ReadoutType(Enum):
-    average = 1
-    single_shot = 2
+from qtl_control.qtl_station.station import ReadoutType, u
 
 
 def notch_res(f, f0, a, alpha, phi, kext, kint):
@@ -16,9 +11,42 @@ def notch_res(f, f0, a, alpha, phi, kext, kint):
 def notch_res_abs(f, f0, a, phi, kext, kint):
     return np.abs(notch_res(f, f0, a, 0, phi, kext, kint))
 
+def exp_sine(time, detune, p0, tau, e0, e1):
+    # Decaying Ramsey oscillation, time in ns
+    return e0 + e1 * np.sin(2 * np.pi * detune * time/1e9 + p0) * np.exp(-(time/1e9)/tau)
+
 def format_res(labels, values):
     return f"Fit:\n" + "\n".join([f"{label}: {float(v):.3e}" for label, v in zip(labels, values)])
 
+def assignment_fidelity(iq, method="centroid"):
+    """
+    The (ground mean, excited mean, assignment fidelity) of single shots iq[..., shot, state], ground
+    at state 0 and excited at 1, over all the leading dimensions at once. The shots are assigned to the
+    nearest mean with method "centroid", or with "threshold" to a side of the threshold on the axis
+    through the means that maximizes the fidelity, 0.5 (P(e|e) + P(g|g)).
+    """
+    iq = np.asarray(iq)
+    means = iq.mean(axis=-2)
+    g_mean, e_mean = means[..., 0], means[..., 1]
+    # Projection on the ground to excited axis, 0 at the ground and 1 at the excited mean
+    axis = (e_mean - g_mean)[..., None, None]
+    x = ((iq - g_mean[..., None, None]) * np.conj(axis)).real / np.abs(axis) ** 2
+
+    if method == "centroid":
+        excited = x > 0.5
+        fidelity = 0.5 * (excited[..., 1].mean(axis=-1) + 1 - excited[..., 0].mean(axis=-1))
+        return g_mean, e_mean, fidelity
+
+    # Every threshold between the sorted shots, ground counted below and excited above it
+    N = x.shape[-2]
+    x = np.concatenate([x[..., 0], x[..., 1]], axis=-1)
+    is_ground = np.concatenate([np.ones(N), np.zeros(N)])[np.argsort(x, axis=-1)]
+    ground_below = np.cumsum(is_ground, axis=-1)
+    excited_above = N - (np.arange(1, 2 * N + 1) - ground_below)
+    fidelity = 0.5 * (ground_below + excited_above) / N
+    # Or all shots excited, at 0.5
+    return g_mean, e_mean, np.maximum(fidelity.max(axis=-1), 0.5)
+
 def standard_readout(element, I, I_st, Q, Q_st, wait_after):
     measure(
         "readout",
@@ -29,6 +57,90 @@ def standard_readout(element, I, I_st, Q, Q_st, wait_after):
     )
     # Wait for the resonator to deplete
     # Save the 'I' & 'Q' quadratures to their respective streams
-    save(I, I_st)
-    save(Q, Q_st)
-    wait(wait_after//4, element)
\ No newline at end of file
+    if I_st is not None: # Discriminated runs save the state instead
+        save(I, I_st)
+        save(Q, Q_st)
+    wait(wait_after//4, element)
+
+def discrimination_weights(disc, readout_len):
+    """
+    The (w_I, w_Q, threshold) of a ReadoutDisc for the raw demodulated I and Q, a shot is excited when
+    w_I I + w_Q Q > threshold. Scaled to weights of at most 1 to fit the QUA fixed point range.
+    """
+    volts_per_unit = u.demod2volts(1, readout_len)
+    w_I, w_Q = volts_per_unit * disc.param_1.real, -volts_per_unit * disc.param_1.imag
+    threshold = 0.5 + (disc.param_0 * disc.param_1).real
+    scale = max(abs(w_I), abs(w_Q))
+    return w_I / scale, w_Q / scale, threshold / scale
+
+def histogram_grid(disc, readout_len, bins, half_width=None):
+    """
+    The (I0, Q0, K, I edges, Q edges) of bins x bins IQ histograms centered between the ground and excited
+    states of a ReadoutDisc, half_width (V) is 1.5 |excited - ground| by default. The bin of a raw I is
+    floor(K (I - I0)), K is an integer for QUA, the edges are in V.
+    """
+    volts_per_unit = u.demod2volts(1, readout_len)
+    separation = 1 / disc.param_1 # excited - ground
+    center = disc.param_0 + separation / 2
+    half_width = half_width or 1.5 * abs(separation)
+
+    K = max(1, int(round(bins * volts_per_unit / (2 * half_width))))
+    I0 = (center.real - half_width) / volts_per_unit
+    Q0 = (center.imag - half_width) / volts_per_unit
+    edges = np.arange(bins + 1) / K
+    return I0, Q0, K, (I0 + edges) * volts_per_unit, (Q0 + edges) * volts_per_unit
+
+def qua_state(I, Q, weights, state_st):
+    w_I, w_Q, threshold = weights
+    state = declare(bool)
+    assign(state, I * w_I + Q * w_Q > threshold)
+    save(state, state_st)
+
+def qua_histogram_bin(I, Q, grid, bins, index):
+    # Assign the flat index of the IQ bin of the shot, I major
+    I0, Q0, K = grid[:3]
+    i, q = declare(int), declare(int)
+    for bin_index, value, offset in [(i, I, I0), (q, Q, Q0)]:
+        assign(bin_index, Cast.mul_int_by_fixed(K, value - offset))
+        # Shots outside of the histogram go to the edge bins
+        with if_(bin_index < 0):
+            assign(bin_index, 0)
+        with if_(bin_index > bins - 1):
+            assign(bin_index, bins - 1)
+    assign(index, i * bins + q)
+
+def qua_active_reset(element, weights, I, Q, rounds, rounds_st, max_rounds, reset_wait):
+    """
+    Measure the qubit of element and play an x180 while it is measured excited, at most max_rounds times.
+    Saves the number of x180 played to rounds_st, max_rounds + 1 if it was still excited after them.
+    """
+    w_I, w_Q, threshold = weights
+    excited = declare(bool)
+
+    def measure_state():
+        measure(
+            "readout",
+            f"resonator_{element}",
+            None,
+            dual_demod.full("cos", "sin", I),
+            dual_demod.full("minus_sin", "cos", Q),
+        )
+        assign(excited, I * w_I + Q * w_Q > threshold)
+        # Wait for the resonator to deplete before the pulse
+        wait(reset_wait//4, f"resonator_{element}")
+        align(f"drive_{element}", f"resonator_{element}")
+
+    assign(rounds, 0)
+    measure_state()
+    with while_(excited & (rounds < max_rounds)):
+        play(f"{element}_x180", f"drive_{element}")
+        align(f"drive_{element}", f"resonator_{element}")
+        measure_state()
+        assign(rounds, rounds + 1)
+    with if_(excited):
+        assign(rounds, max_rounds + 1)
+    save(rounds, rounds_st)
+
+def save_reset_rounds(rounds_st, name, max_rounds):
+    # Counts of the shots by the number of x180 their active reset played, see qua_active_reset
+    rounds_st.histogram([[rounds - 0.5, rounds + 0.5] for rounds in range(max_rounds + 2)]).save(name)
@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+from qm import Program
+
+
+class ProgramCache:
+    """
+    LRU cache of built QUA programs and their compiled program ids on the open QM.
+    Built programs can also be stored on disk in path, to persist between sessions. Compiled
+    programs only live as long as the QM they were compiled on. Programs are keyed on the
+    structure of the QM config, live updates like IFs and DC offsets keep them, and the values
+    the program loops over, which can depend on settings like the LO frequency. The build and acquire threads share the cache.
+    """
+    def __init__(self, max_size=32, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def make_key(experiment, element, Navg, sweeps, run_kwargs, structure_hash):
+        key = hashlib.sha256()
+        key.update(json.dumps([
+            type(experiment).__module__,
+            type(experiment).__qualname__,
+            element,
+            Navg,
+            run_kwargs,
+            structure_hash,
+            experiment.program_settings(element),
+        ], sort_keys=True, default=str).encode())
+
+        for sweep in list(sweeps) + experiment.loop_values(element, sweeps):
+            sweep = np.ascontiguousarray(sweep)
+            key.update(f"{sweep.dtype.str}{sweep.shape}".encode())
+            key.update(sweep.tobytes())
+
+        return key.hexdigest()
+
+    def get_program(self, key):
+        with self.lock:
+            if self.max_size <= 0:
+                return None
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]["program"]
+
+            if self.path is not None and os.path.exists(filename := self.filename(key)):
+                self.hits += 1
+                with open(filename, "rb") as f:
+                    program = Program.from_protobuf(f.read())
+                self.add_entry(key, program)
+                return program
+
+            self.misses += 1
+            return None
+
+    def put_program(self, key, program):
+        with self.lock:
+            if self.max_size <= 0:
+                return
+
+            self.add_entry(key, program)
+            if self.path is not None:
+                # Only the QUA program, the configuration is the one of the QM it runs on
+                with open(self.filename(key), "wb") as f:
+                    f.write(program.qua_program.SerializeToString())
+
+    def get_compiled(self, key, qm):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["qm"] is not qm:
+                return None
+            return entry["program_id"]
+
+    def put_compiled(self, key, qm, program_id):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] |= {"qm": qm, "program_id": program_id}
+
+    def add_entry(self, key, program):
+        with self.lock:
+            self.entries[key] = {"program": program, "qm": None, "program_id": None}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def filename(self, key):
+        return os.path.join(self.path, f"{key}.qua")
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
@@ -1,3 +1,7 @@
+import copy
+import json
+import hashlib
+
 import numpy as np
 
 from qualang_tools.config.waveform_tools import drag_gaussian_pulse_waveforms
@@ -84,7 +88,7 @@ def generate_config(
         f"drive_{qb_id}": {
             "RF_inputs": {"port": ("oct1", int(element_conn[qb_id].drive.channel_id.strip("RF")))},
             "intermediate_frequency": element_conn[qb_id].frequency - element_conn[qb_id].drive.LO_frequency,
-            "operations": OPERATIONS | OPERATIONS_PER_ELEMENT[qb_id]
+            "operations": OPERATIONS | OPERATIONS_PER_ELEMENT.get(qb_id, {})
         } for qb_id in elements_to_run
     }
     # ADD READOUT
@@ -339,3 +343,52 @@ def generate_config(
         })
 
     return config
+
+
+def hash_config(configuration):
+    """
+    Content hash of a generated configuration, used to detect if the QM needs reopening
+    """
+    return hashlib.sha256(json.dumps(configuration, sort_keys=True).encode()).hexdigest()
+
+
+def hash_config_structure(configuration):
+    """
+    Content hash of a generated configuration without the settings that are updated on the open QM,
+    IFs, DC offsets and Octave LO/gain, see split_config_changes. Used by the program cache.
+    """
+    configuration = copy.deepcopy(configuration)
+    for element in configuration.get("elements", {}).values():
+        element.pop("intermediate_frequency", None)
+    for controller in configuration.get("controllers", {}).values():
+        for output in controller.get("analog_outputs", {}).values():
+            output.pop("offset", None)
+    for octave in configuration.get("octaves", {}).values():
+        for ports, settings in [("RF_outputs", ["LO_frequency", "gain"]), ("RF_inputs", ["LO_frequency"])]:
+            for port in octave.get(ports, {}).values():
+                for setting in settings:
+                    port.pop(setting, None)
+    return hash_config(configuration)
+
+
+def diff_config(old_configuration, new_configuration):
+    """
+    Report which entries (elements, pulses, waveforms, ...) were added, removed or changed
+    in each section of the configuration. Sections without changes are left out.
+    """
+    old_configuration = old_configuration or dict()
+    diff = {}
+    for section, new_entries in new_configuration.items():
+        old_entries = old_configuration.get(section, dict())
+        if not isinstance(new_entries, dict) or old_entries == new_entries:
+            continue
+
+        diff[section] = {
+            "added": sorted(str(k) for k in new_entries.keys() - old_entries.keys()),
+            "removed": sorted(str(k) for k in old_entries.keys() - new_entries.keys()),
+            "changed": sorted(
+                str(k) for k in new_entries.keys() & old_entries.keys() if new_entries[k] != old_entries[k]
+            ),
+        }
+
+    return diff
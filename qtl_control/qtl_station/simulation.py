@@ -0,0 +1,326 @@
+"""
+Simulated backend for the mock station
+
+Generates synthetic results for jobs from the run description that QTLQMExperiment.build_program
+puts on the program. Responses are computed with numpy over the whole sweep at once, with
+shapes taken from the sweeps, so the full run -> dataset -> save -> analyze pipeline can be
+exercised at production data sizes without an OPX.
+
+With a time_dilation the simulator also models how long each job takes on the hardware, from
+the drive_duration of the experiment on the run description, the readout_len and the wait_after
+or the active reset rounds of the simulated qubit, and keeps a timeline of the jobs to report
+shots per second and the hardware idle fraction.
+"""
+import time
+
+import numpy as np
+
+from dataclasses import dataclass
+
+from qtl_control.qtl_station.station import u, ReadoutType, MockResHandles
+from qtl_control.qtl_experiments.utils import notch_res, discrimination_weights, histogram_grid
+
+
+@dataclass
+class SimulatedQubit:
+    """
+    Physical parameters of a simulated qubit and its readout resonator, relative to the station config
+    """
+    resonator_detuning: float = 0.1e6  # resonator frequency - readout_frequency (Hz)
+    dispersive_shift: float = -0.5e6  # Hz
+    kext: float = 1e6
+    kint: float = 0.2e6
+    phi: float = 0.1
+    response_per_amplitude: float = 2e-3  # V of transmission per unit of readout amplitude
+    qubit_detuning: float = 0.2e6  # qubit frequency - frequency (Hz)
+    linewidth: float = 0.5e6  # FWHM of the saturated qubit line (Hz)
+    pi_amplitude: float = 0.4  # amplitude of a pi pulse
+    T1: float = 20e-6
+    T2: float = 10e-6
+    shot_noise: float = 5e-5  # V, per single shot
+    excited_after_shot: float = 0.5  # population an active reset starts from
+    reset_error: float = 0.01  # probability to be measured excited after a reset x180
+
+
+class QMSimulator:
+    def __init__(self, station, seed=None, qubits=None, time_dilation=None):
+        self.station = station
+        self.rng = np.random.default_rng(seed)
+        self.qubits = qubits or dict()
+
+        # Wall clock seconds per simulated hardware second, None to finish jobs instantly
+        self.time_dilation = time_dilation
+        self.hardware_free_at = 0
+        self.timeline = []
+
+    def get_qubit(self, element):
+        return self.qubits.setdefault(element, SimulatedQubit())
+
+    def resonator_response(self, element, frequencies=None, excited=0.0, amplitude=None):
+        """
+        Transmission of the readout resonator, for an excited state population between 0 and 1
+        """
+        qubit = self.get_qubit(element)
+        element_config = self.station.config[element]
+        frequencies = element_config.readout_frequency if frequencies is None else frequencies
+        amplitude = element_config.readout_amplitude if amplitude is None else amplitude
+
+        f0 = element_config.readout_frequency + qubit.resonator_detuning
+        a = qubit.response_per_amplitude * amplitude
+        ground = notch_res(frequencies, f0, a, 0, qubit.phi, qubit.kext, qubit.kint)
+        excited_response = notch_res(frequencies, f0 + qubit.dispersive_shift, a, 0, qubit.phi, qubit.kext, qubit.kint)
+
+        return ground + (excited_response - ground) * excited
+
+    def single_shots(self, element, excited, Navg, frequencies=None, amplitude=None):
+        """
+        IQ blobs of Navg shots per point, excited is the population to project on each shot
+        """
+        qubit = self.get_qubit(element)
+        ground = self.resonator_response(element, frequencies, 0, amplitude)
+        excited_response = self.resonator_response(element, frequencies, 1, amplitude)
+        shape = (Navg, *np.broadcast(ground, excited).shape)
+
+        projected = self.rng.random(shape) < excited
+        return np.where(projected, excited_response, ground) + self.noise(shape, qubit.shot_noise)
+
+    def noise(self, shape, sigma):
+        return self.rng.normal(0, sigma, shape) + 1.j * self.rng.normal(0, sigma, shape)
+
+    def pulse_length(self, element, pulse):
+        # In ns, the default pulses are 100 ns
+        pulses = self.station.config[element].pulses or dict()
+        return len(pulses[pulse][0]) if pulse in pulses else 100
+
+    def job_duration(self, run):
+        """
+        Hardware time of a run in seconds, Navg x sweep points x the shot_duration
+        """
+        if "parts" in run: # Merged, the parts run in parallel
+            return max(self.job_duration(part) for part in run["parts"])
+
+        # Single shot experiments sweep the averaging iteration
+        points = np.prod([len(sweep) for label, sweep in zip(run["sweep_labels"], run["sweeps"]) if label != "iteration"])
+        # Multiplexed elements run in parallel, timed as the slowest
+        elements = run["element"] if type(run["element"]) is list else [run["element"]]
+        return max(float(run["Navg"] * points * self.shot_duration(run, element) * 1e-9) for element in elements)
+
+    def shot_duration(self, run, element):
+        """
+        Mean time in ns of a shot, the drive_duration of the experiment, then the readout and wait_after.
+        With active_reset the readout and every reset readout wait reset_wait, the excited shots of the
+        simulated qubit play an x180 and read out again until a reset succeeds, at most reset_rounds times.
+        """
+        run_kwargs = run["run_kwargs"]
+        drive = run["drive_duration"][element]
+        readout_len = self.station.config[element].readout_len
+        if not run_kwargs.get("active_reset"):
+            return drive + readout_len + run_kwargs.get("wait_after", 0)
+
+        qubit = self.get_qubit(element)
+        reset_wait = run_kwargs.get("reset_wait", 1000)
+        # Expected x180s, every round starts from an excited measurement
+        x180s = qubit.excited_after_shot * sum(qubit.reset_error ** k for k in range(run_kwargs.get("reset_rounds", 4)))
+        return drive + (readout_len + reset_wait) * (2 + x180s) + self.pulse_length(element, "x180") * x180s
+
+    def schedule(self, program):
+        """
+        Place a queued job on the simulated hardware timeline, returns its wall clock (start, end)
+        """
+        if self.time_dilation is None or not hasattr(program, "qtl_run"):
+            return None
+
+        run = program.qtl_run
+        start = max(time.time(), self.hardware_free_at)
+        end = start + self.job_duration(run) * self.time_dilation
+        self.hardware_free_at = end
+
+        self.timeline.append((start, end, self.shots(run)))
+        return start, end
+
+    def shots(self, run):
+        if "parts" in run:
+            return sum(self.shots(part) for part in run["parts"])
+
+        points = np.prod([len(sweep) for sweep in run["sweeps"]])
+        return run["Navg"] * points if run["readout_type"] == ReadoutType.average else points
+
+    def timing_report(self):
+        """
+        Throughput of the jobs so far in simulated hardware time
+        """
+        if not self.timeline:
+            return dict()
+
+        busy = sum(end - start for start, end, _ in self.timeline)
+        elapsed = max(time.time(), self.timeline[-1][1]) - self.timeline[0][0]
+        shots = sum(shots for *_, shots in self.timeline)
+        return {
+            "jobs": len(self.timeline),
+            "shots": int(shots),
+            "hardware_time": busy / self.time_dilation,
+            "elapsed_time": elapsed / self.time_dilation,
+            "shots_per_second": shots * self.time_dilation / elapsed,
+            "idle_fraction": 1 - busy / elapsed,
+        }
+
+    def reset_timing(self):
+        self.timeline = []
+
+    def simulate(self, run, start_time=None, end_time=None):
+        """
+        Make result handles with the synthetic I, Q and iteration of a run,
+        multiplexed runs get I_{element} and Q_{element} streams for each element.
+        Runs discriminated on the controller get the state or histogram stream instead of I and Q.
+        """
+        if type(run["element"]) is not list:
+            if run["readout_type"].discriminated:
+                data, streams = [self.simulate_element(run, run["element"])], {run["readout_type"].name: 0}
+            else:
+                data, streams = [*self.simulate_element(run, run["element"]), run["Navg"] - 1], MockResHandles.mock_streams
+            if run["run_kwargs"].get("active_reset"):
+                streams = streams | {"reset": len(data)}
+                data.append(self.reset_rounds(run, run["element"]))
+            return MockResHandles(data, start_time, end_time, streams)
+
+        data, streams = [], dict()
+        for part in run.get("parts", [run]):
+            for element in part["element"]:
+                if part["run_kwargs"].get("active_reset"):
+                    streams[f"reset_{element}"] = len(data)
+                    data.append(self.reset_rounds(part, element))
+                if part["readout_type"].discriminated:
+                    streams[f"{part['readout_type'].name}_{element}"] = len(data)
+                    data.append(self.simulate_element(part, element))
+                    continue
+                streams[f"I_{element}"], streams[f"Q_{element}"] = len(data), len(data) + 1
+                data.extend(self.simulate_element(part, element))
+        streams["iteration"] = len(data)
+        data.append(run["Navg"] - 1)
+        return MockResHandles(data, start_time, end_time, streams)
+
+    def simulate_element(self, run, element):
+        """
+        The raw I and Q of one element, as the QM would stream them
+        """
+        Navg = run["Navg"]
+        model = SIMULATED_EXPERIMENTS.get(run["experiment"], simulate_idle)
+        S = np.asarray(model(self, element, [np.asarray(sweep) for sweep in run["sweeps"]], Navg, run["run_kwargs"]))
+
+        if run["readout_type"] == ReadoutType.average:
+            S = np.broadcast_to(S, tuple(len(sweep) for sweep in run["sweeps"]))
+            S = S + self.noise(S.shape, self.get_qubit(element).shot_noise / np.sqrt(Navg))
+
+        # The models follow the sweeps, the QM streams the results in the order of the loops
+        if run.get("loop_order") is not None and S.ndim == len(run["loop_order"]):
+            S = np.transpose(S, run["loop_order"])
+
+        if run["readout_type"].discriminated:
+            return self.discriminate(run, element, S)
+
+        volts_per_unit = u.demod2volts(1, self.station.config[element].readout_len)
+        return S.real / volts_per_unit, S.imag / volts_per_unit
+
+
+    def reset_rounds(self, run, element):
+        """
+        Counts of the shots of a run by the x180 their active reset played, the last for the failed resets
+        """
+        qubit = self.get_qubit(element)
+        max_rounds = run["run_kwargs"].get("reset_rounds", 4)
+        shots = run["Navg"] * int(np.prod([len(sweep) for label, sweep in zip(run["sweep_labels"], run["sweeps"]) if label != "iteration"]))
+
+        # Every x180 leaves the qubit excited with the reset_error
+        excited = self.rng.random(shots) < qubit.excited_after_shot
+        rounds = np.where(excited, self.rng.geometric(1 - qubit.reset_error, shots), 0)
+        return np.bincount(np.minimum(rounds, max_rounds + 1), minlength=max_rounds + 2)
+
+    def discriminate(self, run, element, S):
+        """
+        What the controller streams for shots S in volts discriminated with the readout_discriminator,
+        S has the iteration first as in the order of the loops
+        """
+        config = self.station.config[element]
+        raw = S / u.demod2volts(1, config.readout_len)
+        if run["readout_type"] == ReadoutType.state:
+            w_I, w_Q, threshold = discrimination_weights(config.readout_discriminator, config.readout_len)
+            return np.mean(raw.real * w_I + raw.imag * w_Q > threshold, axis=0)
+
+        bins = run["histogram_bins"]
+        I0, Q0, K, *_ = histogram_grid(config.readout_discriminator, config.readout_len, bins, run["histogram_range"])
+        i = np.clip(np.floor(K * (raw.real - I0)), 0, bins - 1).astype(int)
+        q = np.clip(np.floor(K * (raw.imag - Q0)), 0, bins - 1).astype(int)
+        point = np.arange(int(np.prod(S.shape[1:]))).reshape(S.shape[1:])
+        return np.bincount((point * bins * bins + i * bins + q).ravel(), minlength=point.size * bins * bins)
+
+
+def simulate_idle(simulator, element, sweeps, Navg, run_kwargs):
+    # Qubit stays in the ground state, only the readout point
+    return simulator.resonator_response(element)
+
+
+def simulate_resonator_spectroscopy(simulator, element, sweeps, Navg, run_kwargs):
+    return simulator.resonator_response(element, frequencies=sweeps[0])
+
+
+def simulate_resonator_flux_spectroscopy(simulator, element, sweeps, Navg, run_kwargs):
+    # No flux dependence of the resonator modelled, the same spectroscopy at every flux point
+    return simulator.resonator_response(element, frequencies=sweeps[1][None, :])
+
+
+def simulate_dispersive_shift(simulator, element, sweeps, Navg, run_kwargs):
+    return simulator.resonator_response(element, frequencies=sweeps[0][:, None], excited=np.array([0, 1])[None, :])
+
+
+def simulate_qubit_spectroscopy(simulator, element, sweeps, Navg, run_kwargs):
+    qubit = simulator.get_qubit(element)
+    detuning = sweeps[0] - (simulator.station.config[element].frequency + qubit.qubit_detuning)
+    excited = 0.5 / (1 + (2 * detuning / qubit.linewidth) ** 2)
+    return simulator.resonator_response(element, excited=excited)
+
+
+def simulate_rabi(simulator, element, sweeps, Navg, run_kwargs):
+    qubit = simulator.get_qubit(element)
+    excited = 0.5 * (1 - np.cos(np.pi * sweeps[0] / qubit.pi_amplitude))
+    return simulator.resonator_response(element, excited=excited)
+
+
+def simulate_t1(simulator, element, sweeps, Navg, run_kwargs):
+    qubit = simulator.get_qubit(element)
+    excited = np.exp(-(sweeps[0] / 1e9) / qubit.T1)
+    return simulator.resonator_response(element, excited=excited)
+
+
+def simulate_ramsey(simulator, element, sweeps, Navg, run_kwargs):
+    qubit = simulator.get_qubit(element)
+    detuning = sweeps[0][:, None] - qubit.qubit_detuning
+    time = sweeps[1][None, :] / 1e9
+    excited = 0.5 * (1 + np.cos(2 * np.pi * detuning * time) * np.exp(-time / qubit.T2))
+    return simulator.resonator_response(element, excited=excited)
+
+
+def simulate_single_shot_readout(simulator, element, sweeps, Navg, run_kwargs):
+    return simulator.single_shots(element, np.array([0, 1]), Navg)
+
+
+def simulate_readout_optimization(simulator, element, sweeps, Navg, run_kwargs):
+    return simulator.single_shots(
+        element,
+        np.array([0, 1]),
+        Navg,
+        frequencies=sweeps[1][:, None, None],
+        amplitude=sweeps[2][None, :, None],
+    )
+
+
+SIMULATED_EXPERIMENTS = {
+    "QM-ReadoutResonatorSpectroscopy": simulate_resonator_spectroscopy,
+    "QM-ReadoutFluxSpectroscopy": simulate_resonator_flux_spectroscopy,
+    "QM-DispersiveShift": simulate_dispersive_shift,
+    "QM-QubitSpectroscopy": simulate_qubit_spectroscopy,
+    "QM-Rabi": simulate_rabi,
+    "QM-T1": simulate_t1,
+    "QM-Ramsey2F": simulate_ramsey,
+    "QM-SingleShotReadout": simulate_single_shot_readout,
+    "QM-ReadoutOptimization": simulate_readout_optimization,
+}
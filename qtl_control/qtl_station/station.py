@@ -1,17 +1,23 @@
+import os
 import time
+import tempfile
 import json
+import threading
 
 import numpy as np
 from enum import Enum
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from qm import QuantumMachinesManager
 from qm.octave import QmOctaveConfig
-from qualang_tools.results import progress_counter, fetching_tool
+from qualang_tools.results import progress_counter
 from qualang_tools.units import unit
 u = unit(coerce_to_integer=True)
 
 import qtl_control.qtl_station.station_nodes as qtl_nodes
-from qtl_control.qtl_station.qm_config import generate_config
+from qtl_control.qtl_station.qm_config import generate_config, hash_config, hash_config_structure, diff_config
+from qtl_control.qtl_station.program_cache import ProgramCache
 
 # === Taking care to kill QM whatever happens ===
 import sys
@@ -25,46 +31,311 @@ signal.signal(signal.SIGTERM, kill_handler)
 # === END ===
 
 
+class MockStreamHandle():
+    def __init__(self, data, progress=lambda: 1.0):
+        self.data = data
+        # Fraction of the job done, simulated jobs fill the streams over time
+        self.progress = progress
+
+    def fetch_all(self):
+        if self.data is None: # As the QM before the first values
+            return None
+        if np.ndim(self.data) == 0:
+            return int(self.data * self.progress())
+        return self.data
+
+    def wait_for_values(self, count=1):
+        pass
+
+    def count_so_far(self):
+        return int(len(self.data) * self.progress())
+
+    def fetch(self, item):
+        # save_all streams return structured arrays with the buffers in "value"
+        values = np.asarray(self.data)[item]
+        records = np.empty(len(values), dtype=[("value", values.dtype, values.shape[1:])])
+        records["value"] = values
+        return records
+
 class MockResHandles():
     mock_data = [np.array([1]), np.array([1]), 1]
+    # Index of the named streams in mock_data
+    mock_streams = {"I": 0, "Q": 1, "iteration": 2}
 
-    def __init__(self):
+    def __init__(self, data=None, start_time=None, end_time=None, streams=None):
         self.gen = (_ for _ in [True, False])
+        # Simulated jobs bring their own data, streams and run time, otherwise use the static mock_data
+        self.data = data if data is not None else self.mock_data
+        self.streams = streams or self.mock_streams
+        self.start_time = start_time
+        self.end_time = end_time
 
     def wait_for_all_values(self):
         pass
 
     def get(self, measurement_key):
-        class MockData:
-            def fetch_all():
-                return self.mock_data
-        return MockData()
+        # Multiplexed streams like I_Q7 fall back to the I data
+        index = self.streams.get(measurement_key, self.streams.get(measurement_key.split("_")[0]))
+        if index is None: # As the QM, no handle for streams the program does not save
+            return None
+        return MockStreamHandle(self.data[index], self.progress)
+
+    def progress(self):
+        if self.end_time is None or self.end_time <= self.start_time:
+            return 1.0
+        return min(1.0, max(0.0, (time.time() - self.start_time) / (self.end_time - self.start_time)))
     
     def is_processing(self):
-        return next(self.gen)
+        if self.end_time is None:
+            return next(self.gen, False)
+        return time.time() < self.end_time
+
+    def halt(self):
+        # The streams keep what the job had done when it was halted
+        progress = self.progress()
+        self.progress = lambda: progress
+        self.end_time = time.time()
 
     def fetch_all(self):
-        return self.mock_data
+        return self.data
     
     def get_start_time(self):
         return time.time()
 
 class MockQMJob():
-    def __init__(self):
-        self.result_handles = MockResHandles()
+    def __init__(self, program=None, simulator=None, schedule=None):
+        self.program = program
+        self.simulator = simulator
+        self.halted = False
+
+        if hasattr(program, "qtl_streamed"):
+            # Long-lived job, a result is saved every time all the input streams were pushed
+            self.pushed = dict()
+            streams = dict()
+            for element in program.qtl_run["element"]:
+                streams[f"I_{element}"], streams[f"Q_{element}"] = len(streams), len(streams) + 1
+            self.result_handles = MockResHandles([[] for _ in streams], streams=streams)
+        elif simulator is not None and hasattr(program, "qtl_run"):
+            self.result_handles = simulator.simulate(program.qtl_run, *(schedule or (None, None)))
+        else:
+            self.result_handles = MockResHandles()
+
+    def push_to_input_stream(self, name, data):
+        self.pushed[name] = data
+        if not set(self.program.qtl_streamed) <= set(self.pushed):
+            return
+
+        self.pushed = dict()
+        if self.simulator is not None:
+            handles = self.simulator.simulate(self.program.qtl_run)
+        else:
+            handles = MockResHandles()
+        for stream, index in self.result_handles.streams.items():
+            self.result_handles.data[index].append(np.asarray(handles.get(stream).fetch_all()))
+
+    def halt(self):
+        self.halted = True
+        end_time = getattr(self.result_handles, "end_time", None)
+        if end_time is not None and time.time() < end_time:
+            self.result_handles.halt()
+            if self.simulator is not None and self.simulator.hardware_free_at == end_time:
+                self.simulator.hardware_free_at = time.time()
+        return True
+
+class MockQMOctave():
+    def __init__(self, live_updates):
+        self.live_updates = live_updates
+
+    def set_lo_frequency(self, element, lo_frequency):
+        self.live_updates.append(("LO_frequency", element, lo_frequency))
+
+    def set_rf_output_gain(self, element, gain_in_db):
+        self.live_updates.append(("gain", element, gain_in_db))
+
+    def set_downconversion(self, element, lo_frequency=None):
+        self.live_updates.append(("downconversion_LO_frequency", element, lo_frequency))
+
+class MockQMPendingJob():
+    def __init__(self, queue, program):
+        self.queue = queue
+        self.program = program
+        # With a timing model the job is scheduled on the hardware as soon as it is queued
+        self.simulator = queue.qm.manager.simulator
+        self.schedule = self.simulator.schedule(program) if self.simulator is not None else None
+
+    def wait_for_execution(self):
+        # Jobs run in the order they were added
+        while self.queue.pending_jobs[0] is not self:
+            self.queue.pending_jobs[0].wait_for_execution()
+        self.queue.pending_jobs.pop(0)
+        self.queue.executed += 1
+        if self.schedule is not None:
+            time.sleep(max(0, self.schedule[0] - time.time()))
+        return MockQMJob(self.program, self.simulator, self.schedule)
+
+class MockQMQueue():
+    def __init__(self, qm):
+        self.qm = qm
+        self.pending_jobs = []
+        self.executed = 0
+
+    @property
+    def count(self):
+        return len(self.pending_jobs)
+
+    def add(self, program):
+        pending_job = MockQMPendingJob(self, program)
+        self.pending_jobs.append(pending_job)
+        return pending_job
+
+    def add_compiled(self, program_id):
+        return self.add(self.qm.compiled_programs[program_id])
+
+    def clear(self):
+        cleared = len(self.pending_jobs)
+        self.pending_jobs = []
+        return cleared
 
 class MockQM():
-    def execute(sefl, program):
-        # Execute mock program
-        return MockQMJob()
+    def __init__(self, manager, configuration=None):
+        self.manager = manager
+        self.configuration = configuration
+        # Settings applied to the open mock QM without reopening
+        self.live_updates = []
+        self.octave = MockQMOctave(self.live_updates)
+        self.queue = MockQMQueue(self)
+        self.compiled_programs = dict()
+
+    def compile(self, program):
+        program_id = f"mock-program-{len(self.compiled_programs)}"
+        self.compiled_programs[program_id] = program
+        return program_id
+
+    def execute(self, program):
+        # Execute mock program, like the QM this clears the queue
+        self.queue.clear()
+        return self.queue.add(program).wait_for_execution()
+
+    def close(self):
+        return True
+
+    def set_intermediate_frequency(self, element, freq):
+        self.live_updates.append(("intermediate_frequency", element, freq))
+
+    def set_output_dc_offset_by_element(self, element, input, offset):
+        self.live_updates.append(("dc_offset", element, offset))
 
 class MockQMManager():
-    pass
+    def __init__(self, simulator=None):
+        self.open_count = 0
+        # Generates synthetic results for jobs, see simulation.QMSimulator
+        self.simulator = simulator
+
+    def open_qm(self, configuration):
+        self.open_count += 1
+        return MockQM(self, configuration)
 
 
 class ReadoutType(Enum):
     average = 1
     single_shot = 2
+    state = 3 # Single shots discriminated on the controller, averaged to the excited state probability
+    histogram = 4 # Single shots binned on the controller into IQ histograms
+
+    @property
+    def discriminated(self):
+        return self in (ReadoutType.state, ReadoutType.histogram)
+
+
+# Settings that can be changed on an open QM, applied as (setting, element, value)
+LIVE_SETTERS = {
+    "intermediate_frequency": lambda qm, element, value: qm.set_intermediate_frequency(element, value),
+    "dc_offset": lambda qm, element, value: qm.set_output_dc_offset_by_element(element, "single", value),
+    "LO_frequency": lambda qm, element, value: qm.octave.set_lo_frequency(element, value),
+    "gain": lambda qm, element, value: qm.octave.set_rf_output_gain(element, value),
+    "downconversion_LO_frequency": lambda qm, element, value: qm.octave.set_downconversion(element, lo_frequency=value),
+}
+
+
+def split_config_changes(old_configuration, new_configuration):
+    """
+    Sort the differences between two configurations into live-updatable settings and structural changes.
+    Returns the list of live updates and whether the QM has to be reopened.
+    """
+    if old_configuration is None or old_configuration.keys() != new_configuration.keys():
+        return [], True
+
+    for section in new_configuration.keys() - {"elements", "controllers", "octaves"}:
+        if old_configuration[section] != new_configuration[section]:
+            return [], True
+
+    live_updates = []
+    old_elements = old_configuration["elements"]
+    new_elements = new_configuration["elements"]
+    if old_elements.keys() != new_elements.keys():
+        return [], True
+
+    for element, new_element in new_elements.items():
+        old_element = old_elements[element]
+        if old_element == new_element:
+            continue
+        if old_element | {"intermediate_frequency": None} != new_element | {"intermediate_frequency": None}:
+            return [], True
+        live_updates.append(("intermediate_frequency", element, new_element["intermediate_frequency"]))
+
+    def elements_on_port(port_type, port):
+        return [element for element, conf in new_elements.items() if conf.get(port_type, {}).get("port") == port]
+
+    # DC offsets can only be set through an element connected to the output
+    for controller, new_controller in new_configuration["controllers"].items():
+        old_controller = old_configuration["controllers"].get(controller)
+        if old_controller == new_controller:
+            continue
+        if old_controller is None or old_controller.keys() != new_controller.keys():
+            return [], True
+        if any(old_controller[k] != new_controller[k] for k in new_controller.keys() - {"analog_outputs"}):
+            return [], True
+        if old_controller["analog_outputs"].keys() != new_controller["analog_outputs"].keys():
+            return [], True
+
+        for port, new_output in new_controller["analog_outputs"].items():
+            old_output = old_controller["analog_outputs"][port]
+            if old_output == new_output:
+                continue
+            port_elements = elements_on_port("singleInput", (controller, port))
+            if old_output | {"offset": None} != new_output | {"offset": None} or not port_elements:
+                return [], True
+            live_updates.append(("dc_offset", port_elements[0], new_output["offset"]))
+
+    # Octave LO and gain are set per port, through any element using the port
+    for octave, new_octave in new_configuration["octaves"].items():
+        old_octave = old_configuration["octaves"].get(octave)
+        if old_octave == new_octave:
+            continue
+        if old_octave is None or old_octave.keys() != new_octave.keys():
+            return [], True
+        if any(old_octave[k] != new_octave[k] for k in new_octave.keys() - {"RF_outputs", "RF_inputs"}):
+            return [], True
+
+        for ports, port_type, settings in [
+            ("RF_outputs", "RF_inputs", {"LO_frequency": "LO_frequency", "gain": "gain"}),
+            ("RF_inputs", "RF_outputs", {"LO_frequency": "downconversion_LO_frequency"}),
+        ]:
+            if old_octave[ports].keys() != new_octave[ports].keys():
+                return [], True
+            for port, new_port in new_octave[ports].items():
+                old_port = old_octave[ports][port]
+                if old_port == new_port:
+                    continue
+                port_elements = elements_on_port(port_type, (octave, port))
+                unchanged = {k: None for k in settings}
+                if old_port | unchanged != new_port | unchanged or not port_elements:
+                    return [], True
+                for key, setting in settings.items():
+                    if old_port[key] != new_port[key]:
+                        live_updates.append((setting, port_elements[0], new_port[key]))
+
+    return live_updates, False
 
 
 class QTLStation:
@@ -122,9 +393,35 @@ class QTLStation:
             default_pulses,
         )
 
-        # For debug purposes
-        with open("qtl_qm_config.json", "w+") as f:
-            json.dump(configuration, f)
+        # Currently loaded configuration, kept to skip reopening the QM when nothing changed
+        self.qm = None
+        self.qm_configuration = None
+        self.qm_configuration_hash = None
+        # Without the settings updated on the open QM, the programs do not depend on them
+        self.qm_structure_hash = None
+        self.config_diff = dict()
+        # How the last configuration was loaded: "unchanged", "live" or "reopen"
+        self.last_load = None
+
+        # Pipeline stages, one thread each so that building the next program, acquiring the
+        # current job and processing the previous result overlap while keeping submission order
+        self.qm_lock = threading.RLock()
+        self.build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qtl_build")
+        self.acquire_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qtl_acquire")
+        self.process_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qtl_process")
+
+        # Single shot results are fetched into one preallocated buffer, optionally memory-mapped
+        single_shot_config = qm_config.get("single_shot") or dict()
+        self.single_shot_dtype = np.dtype(single_shot_config.get("dtype", "complex128"))
+        self.single_shot_memmap_dir = single_shot_config.get("memmap_dir")
+
+        # Built and compiled programs, reused when the same experiment runs again on the same config
+        self.program_cache = ProgramCache(**(qm_config.get("program_cache") or dict()))
+
+        # Runs with larger results are split into chunks of sweeps that run back to back
+        self.max_result_bytes = qm_config.get("max_result_bytes", 2**28)
+        # Shots wait this many T1 of the qubit to decay, when its T1 is known
+        self.repetition_T1s = qm_config.get("repetition_T1s", 5)
 
         if not self.mock:
             octave_config = QmOctaveConfig()
@@ -136,17 +433,21 @@ class QTLStation:
                 octave=octave_config
             )
 
-            self.qm = self.qm_manager.open_qm(configuration)
             def exit_handler():
                 print("Cleaning up, closing QM")
                 self.qm.close()
             atexit.register(exit_handler)
         else:
-            self.qm = MockQM()
-            self.qm_manager = MockQMManager()
+            simulator = None
+            if simulation_config := qm_config.get("simulate"):
+                # Imported here, the simulation models use the experiment utils which import the station
+                from qtl_control.qtl_station.simulation import QMSimulator
+                simulator = QMSimulator(self, **(simulation_config if type(simulation_config) is dict else dict()))
+            self.qm_manager = MockQMManager(simulator)
 
+        self.load_configuration(configuration)
 
-    def reload_config(self, elements, new_settings=None):
+    def reload_config(self, elements, new_settings=None, force=False):
         self.elements = elements
 
         new_settings = new_settings or dict()
@@ -173,40 +474,351 @@ class QTLStation:
             pulses
         )
 
+        return self.load_configuration(configuration, force=force)
+
+    def load_configuration(self, configuration, force=False):
+        """
+        Open the QM with the configuration, unless the same configuration is already loaded.
+        Frequencies, DC offsets and Octave LO/gain changes are applied to the open QM, only
+        structural changes reopen it. Returns a report of the elements, pulses, waveforms etc. that changed.
+        """
+        with self.qm_lock:
+            return self._load_configuration(configuration, force)
+
+    def _load_configuration(self, configuration, force):
+        configuration_hash = hash_config(configuration)
+        if configuration_hash == self.qm_configuration_hash and not force:
+            self.config_diff = dict()
+            self.last_load = "unchanged"
+            return self.config_diff
+
+        self.config_diff = diff_config(self.qm_configuration, configuration)
+
+        # For debug purposes
         with open("qtl_qm_config.json", "w+") as f:
             json.dump(configuration, f)
 
-        if not self.mock:
-            self.qm.close()
-            self.qm = self.qm_manager.open_qm(configuration)
+        live_updates, requires_reopen = split_config_changes(self.qm_configuration, configuration)
+        if not requires_reopen and not force:
+            for setting, element, value in live_updates:
+                LIVE_SETTERS[setting](self.qm, element, value)
+            self.last_load = "live"
         else:
-            self.qm = MockQM()
+            if self.qm is not None:
+                self.qm.close()
+            self.qm = self.qm_manager.open_qm(configuration)
+            self.last_load = "reopen"
+
+        self.qm_configuration = configuration
+        self.qm_configuration_hash = configuration_hash
+        self.qm_structure_hash = hash_config_structure(configuration)
+
+        return self.config_diff
 
     def print_tree(self):
         for element in self.elements:
             print(f"{element}:\n{self.config[element].get_tree(indent=1)}")
         print(f"PL:\n{self.pl_config["PL"].get_tree(indent=1)}")
 
-    def execute(self, element, program, Navg, readout_type):
-        if readout_type == ReadoutType.single_shot: # Single shot
-            job = self.qm.execute(program)
+    def execute(self, element, program, Navg, readout_type, metrics=None):
+        with self.qm_lock:
+            job = self.execute_program(program)
+            return self.fetch_results(element, job, Navg, readout_type, metrics=metrics)
+
+    def execute_program(self, program):
+        if getattr(program, "qtl_cache_key", None) is None:
+            return self.qm.execute(program)
+        return self.queue_program(program).wait_for_execution()
+
+    def queue_program(self, program):
+        """
+        Add the program to the QM queue. Programs from the program cache are compiled once per
+        open QM and then added by their program id, skipping the compilation.
+        """
+        key = getattr(program, "qtl_cache_key", None)
+        if key is None:
+            return self.qm.queue.add(program)
+
+        program_id = self.program_cache.get_compiled(key, self.qm)
+        if program_id is None:
+            program_id = self.qm.compile(program)
+            self.program_cache.put_compiled(key, self.qm, program_id)
+        return self.qm.queue.add_compiled(program_id)
+
+    def fetch_results(self, element, job, Navg, readout_type, metrics=None, streams=("I", "Q")):
+        if type(element) is list: # Multiplexed, streams of each element saved as I_{element} and Q_{element}
+            results = [
+                self.fetch_results(el, job, Navg, readout_type, metrics=metrics, streams=(f"I_{el}", f"Q_{el}"))
+                for el in element
+            ]
+            # Merged programs give a list of the results of each list of elements
+            return np.stack(results) if all(type(el) is str for el in element) else results
+
+        if readout_type.discriminated: # Reduced on the controller, saved as state or histogram in place of I
             res_handles = job.result_handles
             res_handles.wait_for_all_values()
-            I = res_handles.get("I").fetch_all()["value"]
-            Q = res_handles.get("Q").fetch_all()["value"]
+            S = np.asarray(res_handles.get(readout_type.name + streams[0][1:]).fetch_all())
+            if metrics is not None:
+                metrics.add("bytes_transferred", S.nbytes)
 
-            S = u.demod2volts(I + 1.j * Q, self.config[element].readout_len)
+        elif readout_type == ReadoutType.single_shot: # Single shot
+            S = self.fetch_single_shots(element, job, Navg, metrics=metrics, streams=streams)
 
         else: # Averaged
-            job = self.qm.execute(program)
-            results = fetching_tool(job, data_list=["I", "Q", "iteration"], mode="live") if not self.mock else MockResHandles()
-            while results.is_processing():
-                I, Q, iteration = results.fetch_all()
-                S = u.demod2volts(I + 1.j * Q, self.config[element].readout_len)
-                progress_counter(iteration, Navg, start_time=results.get_start_time())
+            S = None
+            for S, iteration in self.stream_results(element, job, Navg, metrics=metrics, streams=streams):
+                pass
 
+        self.fetch_reset_statistics(job, "reset" + streams[0][1:], metrics)
         return S
 
+    def fetch_reset_statistics(self, job, name, metrics):
+        """
+        Add the shots, x180 pulses and failures (still excited after all rounds) of the active reset of a job
+        to the counters of the RunMetrics, if the job saved the reset rounds to the stream name
+        """
+        handle = job.result_handles.get(name)
+        if handle is None or metrics is None:
+            return
+
+        job.result_handles.wait_for_all_values()
+        counts = np.asarray(handle.fetch_all())
+        max_rounds = len(counts) - 2
+        metrics.add("reset_shots", int(counts.sum()))
+        metrics.add("reset_pulses", int(np.dot(np.arange(max_rounds + 1), counts[:-1]) + max_rounds * counts[-1]))
+        metrics.add("reset_failures", int(counts[-1]))
+
+    def stream_results(self, element, job, Navg, max_rate=10, max_interval=2, metrics=None, streams=("I", "Q")):
+        """
+        Yield the averaged (S, iteration) of a running job, at most max_rate times per second.
+        Data is only fetched and converted when the iteration changed, otherwise polling backs
+        off up to max_interval seconds. The final data is always yielded once the job is done.
+        The fetched bytes are added to the bytes_transferred of the RunMetrics if given.
+        """
+        res_handles = job.result_handles
+        start_time = time.time()
+        min_interval = 1 / max_rate
+        interval = min_interval
+        last_iteration = None
+        waited = False
+
+        processing = True
+        while processing:
+            poll_time = time.time()
+            processing = res_handles.is_processing()
+            iteration = res_handles.get("iteration").fetch_all()
+
+            if iteration is not None and (iteration != last_iteration or not processing):
+                I = res_handles.get(streams[0]).fetch_all()
+                Q = res_handles.get(streams[1]).fetch_all()
+                # The streams are not fetched at once, I or Q can still be missing or of another length
+                if I is None or Q is None or np.shape(I) != np.shape(Q):
+                    if not processing:
+                        if waited:
+                            raise RuntimeError(f"Incomplete {streams} results of the finished job")
+                        res_handles.wait_for_all_values()
+                        processing = waited = True
+                    interval = min_interval
+                else:
+                    if metrics is not None:
+                        metrics.add("bytes_transferred", np.asarray(I).nbytes + np.asarray(Q).nbytes)
+                    progress_counter(iteration, Navg, start_time=start_time)
+                    yield u.demod2volts(I + 1.j * Q, self.config[element].readout_len), int(iteration)
+
+                    last_iteration = iteration
+                    interval = min_interval
+            else:
+                interval = min(2 * interval, max_interval)
+
+            if processing:
+                time.sleep(max(0, interval - (time.time() - poll_time)))
+
+    def fetch_single_shots(self, element, job, Navg, poll_interval=0.1, metrics=None, streams=("I", "Q")):
+        """
+        Fetch the save_all I/Q streams of a single shot job in chunks while it is running, into one
+        preallocated complex buffer of Navg records converted to volts in place. The buffer dtype is
+        single_shot_dtype and it is memory-mapped to a file in single_shot_memmap_dir if that is set,
+        see allocate_single_shots. Raises a RuntimeError if the job stops before all Navg records.
+        """
+        res_handles = job.result_handles
+        I_handle = res_handles.get(streams[0])
+        Q_handle = res_handles.get(streams[1])
+        volts_per_unit = u.demod2volts(1, self.config[element].readout_len)
+
+        S = None
+        fetched = 0
+        while fetched < Navg:
+            processing = res_handles.is_processing()
+            count = min(I_handle.count_so_far(), Q_handle.count_so_far(), Navg)
+
+            if count > fetched:
+                I = I_handle.fetch(slice(fetched, count))["value"]
+                Q = Q_handle.fetch(slice(fetched, count))["value"]
+                if metrics is not None:
+                    metrics.add("bytes_transferred", I.nbytes + Q.nbytes)
+                if S is None:
+                    S = self.allocate_single_shots((Navg, *I.shape[1:]))
+
+                chunk = S[fetched:count]
+                chunk.real = I
+                chunk.imag = Q
+                chunk *= volts_per_unit
+                fetched = count
+            elif not processing:
+                break
+            else:
+                time.sleep(poll_interval)
+
+        if fetched < Navg: # Halted or failed, the dataset would be missing shots
+            raise RuntimeError(f"Single shot job stopped after {fetched} of {Navg} records")
+        return S
+
+    def allocate_single_shots(self, shape):
+        """
+        Buffer of the single shots, memory-mapped to an anonymous temporary file in single_shot_memmap_dir
+        if that is set. The file has no name on disk and its space is freed with the buffer, once the
+        dataset built from it is saved and released.
+        """
+        if self.single_shot_memmap_dir is None:
+            return np.empty(shape, dtype=self.single_shot_dtype)
+
+        os.makedirs(self.single_shot_memmap_dir, exist_ok=True)
+        # The map keeps its own handle of the file, it lives as long as the buffer
+        with tempfile.TemporaryFile(prefix="single_shots_", dir=self.single_shot_memmap_dir) as f:
+            return np.memmap(f, dtype=self.single_shot_dtype, mode="w+", shape=shape)
+
+    def execute_live(self, element, program, Navg, max_rate=10, max_interval=2):
+        """
+        Execute an averaged program and yield (S, iteration) while it runs, see stream_results.
+        If the consumer stops early (a break, an interrupt), closing the generator halts the job.
+        """
+        with self.qm_lock:
+            job = self.execute_program(program)
+            try:
+                yield from self.stream_results(element, job, Navg, max_rate=max_rate, max_interval=max_interval)
+            finally:
+                if job.result_handles.is_processing():
+                    job.halt()
+
+    def execute_until(self, element, program, Navg, converged, max_rate=10, max_interval=2, metrics=None):
+        """
+        Execute an averaged program and halt the job as soon as converged(S, iteration) is true for
+        the live results, see stream_results. Returns the final (S, iteration, halted).
+        """
+        with self.qm_lock:
+            job = self.execute_program(program)
+            halted = False
+            for S, iteration in self.stream_results(element, job, Navg, max_rate=max_rate, max_interval=max_interval, metrics=metrics):
+                if iteration + 1 < Navg and converged(S, iteration):
+                    job.halt()
+                    halted = True
+                    break
+
+            if halted:
+                # Fetch again, the averages done up to the halt
+                for S, iteration in self.stream_results(element, job, Navg, metrics=metrics):
+                    pass
+            return S, iteration, halted
+
+    @contextmanager
+    def streamed_job(self, program):
+        """
+        Run a long-lived job fed over input streams, it holds the QM inside the with block and is halted on leaving it
+        """
+        with self.qm_lock:
+            job = self.qm.execute(program)
+            try:
+                yield job
+            finally:
+                job.halt()
+
+    def fetch_streamed(self, elements, job, index, metrics=None):
+        """
+        Wait for and fetch record index of the I_{element} and Q_{element} save_all streams of a streamed job
+        """
+        results = []
+        for element in elements:
+            I, Q = [], []
+            for name, values in [(f"I_{element}", I), (f"Q_{element}", Q)]:
+                handle = job.result_handles.get(name)
+                handle.wait_for_values(index + 1)
+                values.append(handle.fetch(slice(index, index + 1))["value"][0])
+            if metrics is not None:
+                metrics.add("bytes_transferred", I[0].nbytes + Q[0].nbytes)
+            results.append(u.demod2volts(I[0] + 1.j * Q[0], self.config[element].readout_len))
+
+        return np.stack(results)
+
+    def execute_async(self, element, program, Navg, readout_type, metrics=None):
+        """
+        Queue the program for acquisition and return a future of the results.
+        The program can itself be a future, e.g. of a program still being built.
+        """
+        def acquire():
+            program_to_run = program.result() if isinstance(program, Future) else program
+            if metrics is None:
+                return self.execute(element, program_to_run, Navg, readout_type)
+            with metrics.stage("execute"):
+                return self.execute(element, program_to_run, Navg, readout_type, metrics=metrics)
+        return self.acquire_executor.submit(acquire)
+
+    def submit_batch(self, items, autosave=True):
+        """
+        Run a batch of (experiment, element, sweeps, kwargs) items, where kwargs can include Navg.
+        Programs are built and added to the QM job queue back to back, so the hardware does not
+        idle between jobs. Returns a list of futures of the ExperimentResults in order of the items,
+        the future of an item with missing sweeps is resolved to None, like run returns None.
+        """
+        # Imported here, the experiments import the station
+        from qtl_control.qtl_experiments.metrics import RunMetrics
+
+        batch, futures = [], []
+        for experiment, element, sweeps, kwargs in items:
+            kwargs = dict(kwargs)
+            Navg = kwargs.pop("Navg", 1024)
+            metrics = RunMetrics()
+            with metrics.stage("complete_sweeps"):
+                sweeps = experiment.complete_sweeps(sweeps, Navg, **kwargs)
+            if sweeps is None:
+                skipped = Future()
+                skipped.set_result(None)
+                futures.append(skipped)
+                continue
+            program = self.build_executor.submit(
+                experiment.build_program, element, Navg, sweeps, metrics=metrics, **kwargs
+            )
+            batch.append((experiment, element, sweeps, Navg, kwargs, metrics, program, Future()))
+            futures.append(None)
+
+        def acquire():
+            try:
+                # Building can change settings and reload the config, so wait for all programs before queueing
+                programs = [program.result() for *_, program, _ in batch]
+                with self.qm_lock:
+                    pending_jobs = [self.queue_program(program) for program in programs]
+                    for (experiment, element, _, Navg, _, metrics, _, acquisition), pending_job in zip(batch, pending_jobs):
+                        # Includes waiting for the jobs before in the queue
+                        with metrics.stage("execute"):
+                            job = pending_job.wait_for_execution()
+                            results = self.fetch_results(element, job, Navg, experiment.readout_type, metrics=metrics)
+                        acquisition.set_result(results)
+            except Exception as e:
+                for *_, acquisition in batch:
+                    if not acquisition.done():
+                        acquisition.set_exception(e)
+
+        def process(experiment, element, sweeps, kwargs, metrics, acquisition):
+            return experiment.make_result(
+                element, sweeps, acquisition.result(), autosave=autosave, metrics=metrics, **kwargs
+            )
+
+        self.acquire_executor.submit(acquire)
+        processed = iter([
+            self.process_executor.submit(process, experiment, element, sweeps, kwargs, metrics, acquisition)
+            for experiment, element, sweeps, _, kwargs, metrics, _, acquisition in batch
+        ])
+        return [future if future is not None else next(processed) for future in futures]
+
     def change_settings(self):
         return StationSettingsChanger(self)
 
@@ -73,4 +73,5 @@ class TransmonQubit(StationNode):
     readout_amplitude: float = 0.1
     readout_len: int = 2000
     readout_discriminator: Optional[ReadoutDisc] = None
-    pulses: Optional[dict] = None
\ No newline at end of file
+    pulses: Optional[dict] = None
+    T1: Optional[float] = None # s, from the last T1 analysis
\ No newline at end of file
@@ -6,7 +6,7 @@ from qtl_control.start import start_station
 
 @pytest.fixture
 def station():
-    station = start_station(
+    station, db = start_station(
         config=str(Path(__file__).parent / "test_station.yaml"),
         db_path="tests/",
         db_name="test_db"
@@ -1,7 +1,25 @@
+import os
+import json
+import pytest
 import numpy as np
+import xarray as xr
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from qtl_control.qtl_experiments.resonator_experiments import *
 from qtl_control.qtl_experiments.qubit_experiments import *
-from qtl_control.qtl_station.station import MockResHandles
+from qtl_control.qtl_station.station import MockResHandles, MockStreamHandle, ReadoutType, u
+from qtl_control.qtl_station import ReadoutDisc
+from qtl_control.qtl_station.simulation import QMSimulator, SimulatedQubit
+from qtl_control.qtl_experiments.metrics import MetricsLog, JSONLinesSink
+from qtl_control.qtl_experiments import run_merged, ExperimentResult, QTLQMExperiment
+from qtl_control.qtl_experiments.runtime import RuntimeModel, plan_campaign, run_plan
+from qtl_control.qtl_station.program_cache import ProgramCache
+from qtl_control.qtl_experiments.sweeps import Sweep, flux_sweep, loop_order
+from qtl_control.qtl_experiments.convergence import FitConverged, TargetSNR
+from qtl_control.qtl_experiments.fitting import fit_slices
+from qtl_control.qtl_experiments.utils import notch_res_abs
+from qtl_control.qtl_experiments.single_qubit_rb import SingleQubitRB
+from qm import generate_qua_script
 
 
 def test_readout_spectroscopy(station):
@@ -34,4 +52,646 @@ def test_run_sweeps(station):
     allxy = AllXY()
     MockResHandles.mock_data = [np.ones(21), np.ones(21), 1024]
     res = allxy.run("Q7")
-    
\ No newline at end of file
+    
+
+def test_stream_results_waits_for_both_streams(station):
+    class LateQHandles(MockResHandles):
+        polls = 0
+
+        def get(self, measurement_key):
+            if measurement_key == "Q":
+                self.polls += 1
+                if self.polls == 1: # Not there yet on the first poll
+                    return MockStreamHandle(None)
+            return super().get(measurement_key)
+
+    handles = LateQHandles([np.ones(10), np.ones(10), 1023])
+    job = type("Job", (), {"result_handles": handles})()
+    results = list(station.stream_results("Q7", job, 1024, max_rate=100))
+    assert handles.polls == 2
+    assert len(results) == 1 and results[0][0].shape == (10, ) and results[0][1] == 1023
+
+
+def test_run_async(station):
+    t1 = T1()
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1024]
+
+    futures = [t1.run_async("Q7", [np.arange(0, 1000, 100)], autosave=False) for _ in range(3)]
+    results = [future.result() for future in futures]
+    for res in results:
+        assert res.data["iq"].shape == (10, )
+        assert res.data.attrs["element"] == "Q7"
+
+
+def test_submit_batch(station):
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1024]
+    futures = station.submit_batch([
+        (T1(), "Q7", [np.arange(0, 1000, 100)], {"Navg": 10}),
+        (Rabi(), "Q4", [np.arange(0, 1, 0.1)], {}),
+        (T1(), "Q4", [np.arange(0, 1000, 100)], {"wait_after": 1000}),
+    ], autosave=False)
+    results = [future.result() for future in futures]
+
+    assert [res.data.attrs["element"] for res in results] == ["Q7", "Q4", "Q4"]
+    assert station.qm.queue.executed == 3
+    assert station.qm.queue.count == 0
+
+
+def test_submit_batch_missing_sweeps(station):
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1024]
+    futures = station.submit_batch([
+        (T1(), "Q7", [np.arange(0, 1000, 100)], {}),
+        (T1(), "Q7", [], {}),
+        (Rabi(), "Q4", [np.arange(0, 1, 0.1)], {}),
+    ], autosave=False)
+
+    assert len(futures) == 3
+    assert futures[1].result() is None
+    assert [futures[i].result().data.attrs["element"] for i in (0, 2)] == ["Q7", "Q4"]
+    assert futures[2].result().experiment.experiment_name == "QM-Rabi"
+
+
+def test_run_live(station):
+    t1 = T1()
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1023]
+
+    datasets = list(t1.run_live("Q7", [np.arange(0, 1000, 100)], autosave=False, max_rate=100))
+    # Iteration does not change in the mock, only the final data is yielded again
+    assert len(datasets) == 2
+    assert datasets[-1].attrs["iteration"] == 1023
+    assert datasets[-1]["iq"].shape == (10, )
+
+    # Stopping early halts the job, frees the QM and saves nothing
+    station.qm_manager.simulator = QMSimulator(station, seed=0, time_dilation=10)
+    jobs, execute_program = [], station.execute_program
+    station.execute_program = lambda program: jobs.append(execute_program(program)) or jobs[-1]
+    saved_id = ExperimentResult.db.current_id
+    with closing(t1.run_live("Q7", [np.arange(0, 1000, 100)], Navg=1000, max_rate=100)) as live:
+        for ds in live:
+            break
+    assert jobs[0].halted and ds.attrs["iteration"] + 1 < 1000
+    assert ExperimentResult.db.current_id == saved_id
+    with ThreadPoolExecutor(1) as pool:
+        assert pool.submit(station.qm_lock.acquire, blocking=False).result()
+
+
+def test_single_shot_fetch(station, tmp_path):
+    ssr = SingleShotReadout()
+    MockResHandles.mock_data = [np.ones((100, 2)), np.zeros((100, 2)), 100]
+
+    res = ssr.run("Q7", [np.arange(100), ["ground", "excited"]], Navg=100, autosave=False)
+    assert res.data["iq"].shape == (100, 2)
+    assert np.allclose(res.data["iq"], u.demod2volts(1, station.config["Q7"].readout_len))
+
+    station.single_shot_dtype = np.dtype("complex64")
+    station.single_shot_memmap_dir = str(tmp_path)
+    S = station.execute("Q7", None, 100, ReadoutType.single_shot)
+    assert isinstance(S, np.memmap)
+    assert S.dtype == np.complex64
+    assert np.allclose(S.real, u.demod2volts(1, station.config["Q7"].readout_len))
+    # The buffer file has no name on disk, nothing is left behind
+    assert list(tmp_path.iterdir()) == []
+
+    # A job that stops early does not give a dataset with missing shots
+    MockResHandles.mock_data = [np.ones((60, 2)), np.zeros((60, 2)), 60]
+    with pytest.raises(RuntimeError):
+        station.execute("Q7", None, 100, ReadoutType.single_shot)
+
+
+def test_simulated_pipeline(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    qubit = station.qm_manager.simulator.get_qubit("Q7")
+
+    rrs = ReadoutResonatorSpectroscopy()
+    res = rrs.run("Q7", [np.linspace(5.79e9, 5.81e9, 201)], autosave=False)
+    f0 = res.analyze(plot=False)["Q7"]["readout_frequency"]
+    assert abs(f0 - (station.config["Q7"].readout_frequency + qubit.resonator_detuning)) < 0.5e6
+
+    rabi = Rabi()
+    res = rabi.run("Q7", [np.linspace(0, 1, 51)], autosave=False)
+    analysis_result = res.analyze(rabi_amp=0.3)
+    assert abs(analysis_result["Q7"]["X180_amplitude"] - qubit.pi_amplitude) < 0.05
+
+    station.config["Q7"].readout_discriminator = analysis_result["Q7"]["readout_discriminator"]
+    res = T1().run("Q7", [np.arange(0, 100000, 2000)], autosave=False)
+    assert res.data["iq"].shape == (50, )
+    res.analyze()
+
+    ro = ReadoutOptimization()
+    res = ro.run("Q7", [np.linspace(5.79e9, 5.81e9, 5), np.linspace(0.05, 0.2, 4)], Navg=200, autosave=False)
+    assert res.data["iq"].shape == (200, 5, 4, 2)
+
+
+def test_simulated_timing(station):
+    simulator = QMSimulator(station, seed=0, time_dilation=1)
+    station.qm_manager.simulator = simulator
+
+    # An x180, the time sweep and the wait of 100 clock cycles before the readout
+    t1 = T1().build_program("Q7", 100, [np.arange(0, 10000, 1000)])
+    assert "wait(100, 'drive_Q7')" in generate_qua_script(t1)
+    run = t1.qtl_run
+    shot_len = 100 + 4500 + 400 + station.config["Q7"].readout_len + 50000
+    assert np.isclose(simulator.job_duration(run), 100 * 10 * shot_len * 1e-9)
+
+    # sat_len is in ns, played as 2500 clock cycles of 4 ns for sat_len=10000
+    frequencies = [np.linspace(5.78e9, 5.82e9, 10)]
+    spectroscopy = QubitSpectroscopy().build_program("Q7", 100, frequencies, sat_len=10000, wait_after=10000)
+    assert "duration=2500" in generate_qua_script(spectroscopy)
+    assert spectroscopy.qtl_run["drive_duration"] == {"Q7": 10000 + 400}
+    shot_len = 10000 + 400 + station.config["Q7"].readout_len + 10000
+    assert np.isclose(simulator.job_duration(spectroscopy.qtl_run), 100 * 10 * shot_len * 1e-9)
+
+    # Only the excited state plays the x180, the simulated active reset reads out twice and resets 0.5 x (1 + 0.01) times
+    with station.change_settings():
+        station.config["Q7"].readout_discriminator = ReadoutDisc(0, 1)
+    sweeps = [np.arange(100), ["ground", "excited"]]
+    run = SingleShotReadout().build_program("Q7", 100, sweeps, active_reset=True, reset_rounds=2).qtl_run
+    x180s = 0.5 * (1 + 0.01)
+    reset_len = (station.config["Q7"].readout_len + 1000) * (2 + x180s) + 100 * x180s
+    assert np.isclose(simulator.job_duration(run), 100 * (2 * reset_len + 100 + 400) * 1e-9)
+
+    futures = station.submit_batch(
+        [(T1(), "Q7", [np.arange(0, 10000, 1000)], {"Navg": 100}) for _ in range(3)], autosave=False
+    )
+    [future.result() for future in futures]
+
+    report = simulator.timing_report()
+    assert report["jobs"] == 3
+    assert report["shots"] == 3000
+    assert report["idle_fraction"] < 0.5
+
+
+def test_run_metrics(station):
+    log = MetricsLog()
+    T1.metrics_sink = log
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1024]
+    try:
+        res = T1().run("Q7", [np.arange(0, 1000, 100)], autosave=False)
+        futures = station.submit_batch([(T1(), "Q4", [np.arange(0, 1000, 100)], {})], autosave=False)
+        futures[0].result()
+    finally:
+        T1.metrics_sink = None
+
+    metrics = json.loads(res.data.attrs["metrics"])
+    for stage in ["complete_sweeps", "get_program", "signature", "execute", "dataset"]:
+        assert metrics["stages"][stage]["wall"] >= 0
+    # I and Q on every fetch while streaming
+    assert metrics["bytes_transferred"] % (2 * np.ones(10).nbytes) == 0
+    assert metrics["bytes_transferred"] > 0
+    assert metrics["dataset_bytes"] == res.data.nbytes
+
+    assert [record["element"] for record in log.records] == ["Q7", "Q4"]
+    assert "execute" in log.records[1]["stages"]
+
+
+def test_multiplexed_run(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+
+    rabi = Rabi()
+    res = rabi.run(elements=["Q7", "Q4"], sweeps=[np.linspace(0, 1, 51)], autosave=False)
+    assert res.data["iq"].dims == ("element", "amplitude")
+    assert list(res.data.coords["element"].values) == ["Q7", "Q4"]
+    assert res.for_element("Q4").data.attrs["element"] == "Q4"
+
+    analysis_result = res.analyze(rabi_amp=0.3)
+    for element in ["Q7", "Q4"]:
+        assert abs(analysis_result[element]["X180_amplitude"] - 0.4) < 0.05
+
+    res = Ramsey2F().run(elements=["Q7", "Q4"], sweeps=[np.array([-1e6, 1e6]), np.arange(16, 4000, 40)], autosave=False)
+    assert res.data["iq"].shape == (2, 2, 100)
+
+    res = SingleShotReadout().run(elements=["Q7", "Q4"], sweeps=[np.arange(10), ["ground", "excited"]], Navg=10, autosave=False)
+    assert res.data["iq"].dims == ("element", "iteration", "state")
+    assert res.data["iq"].shape == (2, 10, 2)
+
+
+def test_run_merged(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+
+    t1_res, rabi_res = run_merged([
+        (T1(), "Q4", [np.arange(0, 100000, 2000)], {}),
+        (Rabi(), ["Q7"], [np.linspace(0, 1, 51)], {"wait_after": 100000}),
+    ], Navg=100, autosave=False)
+
+    assert t1_res.data["iq"].dims == ("time", )
+    assert t1_res.data.attrs["element"] == "Q4"
+    assert rabi_res.data["iq"].dims == ("element", "amplitude")
+    assert abs(rabi_res.analyze(rabi_amp=0.3)["Q7"]["X180_amplitude"] - 0.4) < 0.05
+
+    assert run_merged([(T1(), "Q4", [np.arange(0, 1000, 100)], {}), (Rabi(), "Q4", [np.linspace(0, 1, 11)], {})]) is None
+
+
+def test_program_cache(station, tmp_path):
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1024]
+    station.program_cache = ProgramCache(max_size=2, path=str(tmp_path))
+    t1 = T1()
+
+    builds = []
+    get_program = t1.get_program
+    t1.get_program = lambda *args, **kwargs: builds.append(args) or get_program(*args, **kwargs)
+
+    res = t1.run("Q7", [np.arange(0, 1000, 100)], autosave=False)
+    res = t1.run("Q7", [np.arange(0, 1000, 100)], autosave=False)
+    assert len(builds) == 1
+    assert len(station.qm.compiled_programs) == 1
+    assert json.loads(res.data.attrs["metrics"])["program_cache_hits"] == 1
+
+    t1.run("Q7", [np.arange(0, 2000, 200)], autosave=False)
+    t1.run("Q7", [np.arange(0, 1000, 100)], Navg=10, autosave=False)
+    assert len(builds) == 3
+    assert len(station.program_cache.entries) == 2
+
+    # Programs stored on disk are used by a new cache
+    station.program_cache = ProgramCache(max_size=2, path=str(tmp_path))
+    t1.run("Q7", [np.arange(0, 1000, 100)], autosave=False)
+    assert len(builds) == 3
+
+
+def test_program_cache_live_updates(station):
+    MockResHandles.mock_data = [np.ones(10), np.ones(10), 1024]
+    station.program_cache = ProgramCache(max_size=8)
+    t1, spectroscopy = T1(), ReadoutResonatorSpectroscopy()
+    sweeps, frequencies = [np.arange(0, 1000, 100)], [np.linspace(5.79e9, 5.81e9, 10)]
+
+    first = t1.build_program("Q7", 100, sweeps)
+    spectroscopy.build_program("Q7", 100, frequencies)
+    # Tracking the qubit frequency only updates the IF on the open QM
+    with station.change_settings():
+        station.config["Q7"].frequency += 1e5
+    assert station.last_load == "live"
+    second = t1.build_program("Q7", 100, sweeps)
+    assert station.program_cache.hits == 1
+    assert second.qtl_cache_key == first.qtl_cache_key
+
+    # The runs share the cached program, not the run description
+    assert second is not first and second.qtl_run is not first.qtl_run
+    assert not hasattr(station.program_cache.entries[first.qtl_cache_key]["program"], "qtl_run")
+
+    # The IFs of a frequency sweep are in the program
+    with station.change_settings():
+        station.config["PL"].LO_frequency += 1e6
+    spectroscopy.build_program("Q7", 100, frequencies)
+    assert station.program_cache.hits == 1
+
+
+def test_run_streamed(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    qubit = station.qm_manager.simulator.get_qubit("Q7")
+
+    with Ramsey2F().run_streamed("Q7", [np.array([-1e6, 1e6]), np.arange(16, 4000, 40)], Navg=100, autosave=False) as streamed:
+        results = [streamed.run() for _ in range(2)]
+        results.append(streamed.run([np.array([-2e6, 2e6]), np.arange(16, 4000, 40)]))
+        assert streamed.run([np.array([-2e6, 2e6]), np.arange(16, 2000, 40)]) is None
+
+    assert streamed.job.halted
+    assert len(station.qm.compiled_programs) == 0
+    assert [res.data["iq"].shape for res in results] == [(2, 100)] * 3
+    assert list(results[2].data.coords["detuning"].values) == [-2e6, 2e6]
+
+    rrs = ReadoutResonatorSpectroscopy()
+    with rrs.run_streamed("Q7", [np.linspace(5.79e9, 5.81e9, 201)], autosave=False) as streamed:
+        f0 = station.config["Q7"].readout_frequency + qubit.resonator_detuning
+        res = streamed.run([np.linspace(f0 - 1e6, f0 + 1e6, 201)])
+        assert abs(res.analyze(plot=False)["Q7"]["readout_frequency"] - f0) < 0.1e6
+
+    # The QM is free again
+    T1().run("Q7", [np.arange(0, 1000, 100)], autosave=False)
+
+    # Also after an error in the with block, for the other threads too
+    with pytest.raises(KeyboardInterrupt):
+        with rrs.run_streamed("Q7", [np.linspace(5.79e9, 5.81e9, 201)], autosave=False) as streamed:
+            raise KeyboardInterrupt
+    assert streamed.job.halted
+    with ThreadPoolExecutor(1) as pool:
+        assert pool.submit(station.qm_lock.acquire, blocking=False).result()
+
+
+class FluxRabi(QTLQMExperiment):
+    experiment_name = "QM-FluxRabi"
+
+    def sweep_spec(self):
+        return [Sweep("amplitude", "arb", fixed), flux_sweep("flux", "arb")]
+
+    def get_program(self, element, Navg, sweeps, wait_after=1000):
+        return self.get_sweep_program(element, Navg, sweeps, wait_after=wait_after)
+
+    def qua_shot(self, element, variables, **kwargs):
+        play(f"{element}_x180" * amp(variables["amplitude"]), f"drive_{element}")
+
+
+def test_sweep_spec(station):
+    experiment = FluxRabi()
+    assert experiment.sweep_labels() == [("amplitude", "arb"), ("flux", "arb")]
+    # The DC offset is the expensive one to change, so it gets the outer loop
+    assert experiment.loop_order() == [1, 0]
+    assert loop_order(SingleShotReadout().sweep_spec()) == [0, 1]
+
+    # Evenly spaced sweeps loop arithmetically, anything else over the values
+    amplitudes, fluxes = np.linspace(0, 1, 5), np.array([0.0, 0.1, 0.3])
+    script = generate_qua_script(experiment.get_program("Q7", 10, [amplitudes, fluxes]))
+    assert "for_each_" in script and "set_dc_offset" in script
+    assert script.index("for_each_") < script.index("set_dc_offset") < script.rindex("with for_(")
+
+    # The QM streams the results in the loop order, the dataset is in the order of the sweeps
+    MockResHandles.mock_data = [np.arange(15).reshape(3, 5), np.zeros((3, 5)), 9]
+    res = experiment.run("Q7", sweeps=[amplitudes, fluxes], Navg=10, autosave=False)
+    assert res.data["iq"].dims == ("amplitude", "flux")
+    assert res.data["iq"].real.sel(amplitude=0.25, flux=0.3) == pytest.approx(11 * u.demod2volts(1, station.config["Q7"].readout_len))
+
+
+def test_chunked_run(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    sweeps = [np.linspace(-0.5, 0.5, 7), np.linspace(5.79e9, 5.81e9, 11)]
+    full = ReadoutFluxSpectroscopy().run("Q7", sweeps=sweeps, Navg=100, autosave=False)
+
+    station.max_result_bytes = 16 * 11 * 2
+    metrics_sink = MetricsLog()
+    ReadoutFluxSpectroscopy.metrics_sink = metrics_sink
+    try:
+        chunked = ReadoutFluxSpectroscopy().run("Q7", sweeps=sweeps, Navg=100, autosave=False)
+    finally:
+        ReadoutFluxSpectroscopy.metrics_sink = None
+    assert metrics_sink.records[0]["chunks"] == 4
+    assert chunked.data["iq"].dims == full.data["iq"].dims
+    np.testing.assert_array_equal(chunked.data["amplitude"], sweeps[0])
+    np.testing.assert_allclose(chunked.data["iq"], full.data["iq"], atol=1e-4)
+    assert chunked.data["readout_frequency"].attrs["units"] == "Hz"
+
+    # Single shots are split along the iteration, each chunk running its part of Navg
+    res = ReadoutOptimization().run("Q7", sweeps=[np.linspace(5.79e9, 5.81e9, 3), np.array([0.1, 0.2])], Navg=50, autosave=False)
+    assert res.data["iq"].shape == (50, 3, 2, 2)
+    np.testing.assert_array_equal(res.data["iteration"], np.arange(50))
+
+
+def test_run_adaptive(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    qubit = station.qm_manager.simulator.get_qubit("Q7")
+
+    coarse = np.linspace(5.79e9, 5.81e9, 41)
+    res = ReadoutResonatorSpectroscopy().run_adaptive("Q7", [coarse], Navg=256, levels=2, autosave=False)
+    levels = json.loads(res.data.attrs["levels"])
+    assert [level["Navg"] for level in levels] == [32, 256, 256]
+    assert [level["points"] for level in levels] == [41, 13, 13]
+    assert (res.data["level"] == 2).sum() == 13
+    assert np.all(np.diff(res.data["readout_frequency"]) > 0)
+    # Fewer shots than a single run of the coarse sweep at Navg
+    assert sum(level["Navg"] * level["points"] for level in levels) < 256 * len(coarse)
+
+    # The finest level has a quarter of the coarse step
+    dense = np.linspace(5.79e9, 5.81e9, 200001)
+    true_f0 = dense[np.argmin(np.abs(station.qm_manager.simulator.resonator_response("Q7", dense)))]
+    f0 = res.analyze(plot=False)["Q7"]["readout_frequency"]
+    assert abs(f0 - true_f0) < (coarse[1] - coarse[0]) / 10
+
+    station.qm_manager.simulator.qubits["Q7"] = qubit = SimulatedQubit(linewidth=3e6, shot_noise=1e-5)
+    res = QubitSpectroscopy().run_adaptive("Q7", [np.linspace(5.78e9, 5.82e9, 41)], Navg=256)
+    assert res.id is not None
+    fine = res.data.where(res.data["level"] == 1, drop=True)["drive_frequency"]
+    assert fine.min() <= station.config["Q7"].frequency + qubit.qubit_detuning <= fine.max()
+
+    # Without a locate_feature the run does not start
+    assert Rabi().run_adaptive("Q7", [np.linspace(0, 1, 11)], Navg=16, autosave=False) is None
+
+
+def test_run_until_converged(station):
+    station.qm_manager.simulator = QMSimulator(station, seed=0, time_dilation=0.1)
+    rabi = Rabi()
+
+    until = FitConverged("X180_amplitude", rel_error=0.05, rabi_amp=0.4)
+    res = rabi.run("Q7", [np.linspace(0, 1, 41)], Navg=10000, until=until)
+    assert res.data.attrs["converged"] == 1
+    assert 16 <= res.data.attrs["Navg"] < 10000
+    assert res.id is not None
+
+    res = rabi.run("Q7", [np.linspace(0, 1, 41)], Navg=64, until=TargetSNR(1e9), autosave=False)
+    assert res.data.attrs["converged"] == 0
+    assert res.data.attrs["Navg"] == 64
+
+    # Without a fit_parameters the run does not start
+    assert QubitSpectroscopy().run("Q7", [np.linspace(5.78e9, 5.82e9, 11)], until=until, autosave=False) is None
+
+
+def test_checkpointed_run(station, monkeypatch):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    t1 = T1()
+    full = t1.run("Q7", [np.arange(0, 10000, 1000)], Navg=300, autosave=False)
+
+    execute = station.execute
+    calls = []
+    def killed_after_two_chunks(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 2:
+            raise KeyboardInterrupt
+        return execute(*args, **kwargs)
+    monkeypatch.setattr(station, "execute", killed_after_two_chunks)
+
+    with pytest.raises(KeyboardInterrupt):
+        t1.run("Q7", [np.arange(0, 10000, 1000)], Navg=300, checkpoint_Navg=100)
+    monkeypatch.setattr(station, "execute", execute)
+
+    checkpoint = ExperimentResult.db.load_result(ExperimentResult.db.current_id)
+    assert json.loads(checkpoint.data.attrs["checkpoint"])["count"] == 200
+
+    res = checkpoint.resume()
+    assert res.id == checkpoint.id
+    assert json.loads(res.data.attrs["checkpoint"])["count"] == 300
+    assert len([f for f in os.listdir(ExperimentResult.db.db_path) if f.startswith(f"{res.id}_")]) == 1
+    # The mean of the chunks is as close to the noiseless response as the full run
+    assert np.allclose(res.data["iq"], full.data["iq"], atol=5e-5)
+
+    res = SingleShotReadout().run("Q7", [np.arange(100), ["ground", "excited"]], Navg=100, checkpoint_Navg=40)
+    assert res.data["iq"].shape == (100, 2)
+    assert np.array_equal(res.data["iteration"], np.arange(100))
+
+    # Without autosave the chunks are merged in memory only
+    saved_id = ExperimentResult.db.current_id
+    res = t1.run("Q7", [np.arange(0, 10000, 1000)], Navg=300, checkpoint_Navg=100, autosave=False)
+    assert res.id is None and json.loads(res.data.attrs["checkpoint"])["count"] == 300
+    assert checkpoint.resume(autosave=False).id == checkpoint.id
+    assert ExperimentResult.db.current_id == saved_id
+
+
+def test_discriminate_on_hardware(station):
+    simulator = station.qm_manager.simulator = QMSimulator(station, seed=0)
+    ground, excited = simulator.resonator_response("Q7", excited=0), simulator.resonator_response("Q7", excited=1)
+    with station.change_settings():
+        station.config["Q7"].readout_discriminator = ReadoutDisc(ground, 1 / (excited - ground))
+
+    with pytest.raises(ValueError):
+        T1(readout_type=ReadoutType.state)
+    state = SingleShotReadout(readout_type=ReadoutType.state)
+    script = generate_qua_script(state.build_program("Q7", 1000, [np.arange(1000), ["ground", "excited"]]))
+    assert "boolean_to_int" in script and "save_all" not in script
+    res = state.run("Q7", [np.arange(1000), ["ground", "excited"]], Navg=1000, autosave=False)
+    assert res.data["e_state"].dims == ("state",)
+
+    # The same shots discriminated on the host
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    shots = SingleShotReadout().run("Q7", [np.arange(1000), ["ground", "excited"]], Navg=1000, autosave=False)
+    station.config["Q7"].readout_discriminator.discriminate_data(shots.data)
+    assert np.allclose(res.data["e_state"], (shots.data["e_state"] > 0.5).mean("iteration"))
+    assert res.data["e_state"].sel(state="ground") < 0.5 < res.data["e_state"].sel(state="excited")
+    res.analyze()
+
+    histogram = ReadoutOptimization(readout_type=ReadoutType.histogram, histogram_bins=16)
+    sweeps = [np.linspace(5.79e9, 5.81e9, 3), np.array([0.05, 0.1])]
+    assert "histogram" in generate_qua_script(histogram.build_program("Q7", 200, [np.arange(200), *sweeps, ["ground", "excited"]]))
+    res = histogram.run("Q7", sweeps, Navg=200, autosave=False)
+    assert res.data["counts"].dims == ("frequency", "amplitude", "state", "I", "Q")
+    assert np.all(res.data["counts"].sum(["I", "Q"]) == 200)
+
+    res = SingleShotReadout(readout_type=ReadoutType.histogram).run("Q7", [np.arange(100), ["ground", "excited"]], Navg=100, autosave=False)
+    res.analyze()
+
+
+def test_active_reset(station):
+    simulator = station.qm_manager.simulator = QMSimulator(station, seed=0, time_dilation=1e-3)
+    ground, excited = simulator.resonator_response("Q7", excited=0), simulator.resonator_response("Q7", excited=1)
+    with station.change_settings():
+        station.config["Q7"].readout_discriminator = ReadoutDisc(ground, 1 / (excited - ground))
+
+    rabi = Rabi()
+    script = generate_qua_script(rabi.build_program("Q7", 100, [np.linspace(0, 1, 11)], active_reset=True))
+    assert "while_" in script and "histogram" in script
+
+    res = rabi.run("Q7", [np.linspace(0, 1, 11)], Navg=100, active_reset=True, autosave=False)
+    metrics = json.loads(res.data.attrs["metrics"])
+    assert metrics["reset_shots"] == 1100
+    assert 0 < metrics["reset_pulses"] < 1100 and metrics["reset_failures"] < 10
+    assert json.loads(res.data.attrs["run_kwargs"])["active_reset"]
+
+    passive, active = (
+        simulator.job_duration(rabi.build_program("Q7", 100, [np.linspace(0, 1, 11)], **kwargs).qtl_run)
+        for kwargs in [{}, {"active_reset": True}]
+    )
+    assert passive > 5 * active
+
+    res = SingleQubitRB().run("Q7", [np.array([1, 5, 10])], Navg=10, active_reset=True, autosave=False)
+    assert json.loads(res.data.attrs["metrics"])["reset_shots"] == 30
+
+
+def test_hand_written_programs(station, capsys):
+    # Without a sweep spec the generic run modes are refused instead of silently not applied
+    with pytest.raises(ValueError):
+        SingleQubitRB(readout_type=ReadoutType.state)
+    drag, rb = DragCalibration(), SingleQubitRB()
+    assert drag.run("Q7", [np.linspace(-1, 1, 5), [0, 1]], active_reset=True, autosave=False) is None
+    assert rb.supports_active_reset() and not drag.supports_active_reset()
+    assert drag.run_streamed("Q7", [np.linspace(-1, 1, 5), [0, 1]]) is None
+    assert run_merged([(rb, "Q7", [np.array([1, 5])], {}), (T1(), "Q4", [np.arange(0, 1000, 100)], {})]) is None
+    assert rb.run(elements=["Q7", "Q4"], sweeps=[np.array([1, 5])], autosave=False) is None
+
+    station.max_result_bytes = 8
+    axis, chunks = rb.split_sweeps("Q7", 10, [np.array([1, 5, 10])])
+    assert axis is None and len(chunks) == 1
+    assert "no sweep spec to split" in capsys.readouterr().out
+
+
+def test_ramsey_wait_after(station):
+    # wait_after is in ns, the wait is in 4 ns clock cycles
+    script = generate_qua_script(Ramsey2F().build_program("Q7", 100, [np.array([-1e6, 1e6]), np.arange(16, 4000, 40)], wait_after=50000))
+    assert "wait(12500, 'resonator_Q7')" in script
+
+
+def test_repetition_delay_from_T1(station):
+    simulator = station.qm_manager.simulator = QMSimulator(station, seed=0)
+    ground, excited = simulator.resonator_response("Q7", excited=0), simulator.resonator_response("Q7", excited=1)
+    with station.change_settings():
+        station.config["Q7"].readout_discriminator = ReadoutDisc(ground, 1 / (excited - ground))
+
+    res = T1().run("Q7", [np.arange(0, 100000, 4000)], Navg=200, autosave=False)
+    assert json.loads(res.data.attrs["run_kwargs"])["wait_after"] == 50000
+    station.reload_config(["Q7", "Q4"], res.analyze())
+    assert abs(station.config["Q7"].T1 - simulator.get_qubit("Q7").T1) < 0.2 * simulator.get_qubit("Q7").T1
+
+    station.repetition_T1s = 3
+    res = Rabi().run("Q7", [np.linspace(0, 1, 11)], autosave=False)
+    wait_after = json.loads(res.data.attrs["run_kwargs"])["wait_after"]
+    assert wait_after % 4 == 0 and abs(wait_after - 3 * station.config["Q7"].T1 * 1e9) < 4
+    # Given waits and resonator experiments keep their wait_after
+    res = Rabi().run("Q7", [np.linspace(0, 1, 11)], wait_after=1000, autosave=False)
+    assert json.loads(res.data.attrs["run_kwargs"])["wait_after"] == 1000
+    res = ReadoutResonatorSpectroscopy().run("Q7", [np.linspace(5.79e9, 5.81e9, 11)], autosave=False)
+    assert json.loads(res.data.attrs["run_kwargs"])["wait_after"] == 1000
+
+
+def test_runtime_estimate(station, monkeypatch, tmp_path):
+    monkeypatch.setattr(QTLQMExperiment, "runtime_model", RuntimeModel())
+    monkeypatch.setattr(T1, "metrics_sink", JSONLinesSink(tmp_path / "metrics.jsonl"))
+    simulator = station.qm_manager.simulator = QMSimulator(station, seed=0, time_dilation=2)
+
+    t1, sweeps = T1(), [np.arange(0, 10000, 1000)]
+    estimate = t1.estimate_runtime("Q7", sweeps, Navg=100)
+    shot_len = 100 + 4500 + 400 + station.config["Q7"].readout_len + 50000
+    assert np.isclose(estimate, 100 * 10 * shot_len * 1e-9)
+    assert ReadoutResonatorSpectroscopy().estimate_runtime("Q7", [np.linspace(5e9, 5.1e9, 10)], Navg=100) < estimate / 10
+
+    # The simulated hardware runs 2x slower than estimated, and the results are polled
+    for _ in range(3):
+        res = t1.run("Q7", sweeps, Navg=100, autosave=False)
+    assert json.loads(res.data.attrs["metrics"])["estimated_duration"] == estimate
+    log = T1.runtime_model.log
+    assert len(log) == 3 and all(entry["measured"] > 2 * entry["estimated"] for entry in log)
+    assert 2 < T1.runtime_model.correction("QM-T1") < 5
+    assert T1.runtime_model.correction("QM-Rabi") == 1
+    assert RuntimeModel().load(tmp_path / "metrics.jsonl").correction("QM-T1") == T1.runtime_model.correction("QM-T1")
+
+    corrected = t1.estimate_runtime("Q7", sweeps, Navg=100)
+    items = [
+        (T1(), "Q7", sweeps, {"Navg": 100}),
+        (T1(), "Q7", sweeps, {"Navg": 1000}),
+        (Rabi(), "Q7", [np.linspace(0, 1, 10)], {"Navg": 100}),
+    ]
+    plan = plan_campaign(items, budget=3 * corrected)
+    assert [item for item, _ in plan["scheduled"]] == [items[0], items[2]]
+    assert [item for item, _ in plan["deferred"]] == [items[1]]
+    assert [future.result().data.attrs["element"] for future in run_plan(plan, autosave=False)] == ["Q7", "Q7"]
+
+
+def test_readout_optimization_fidelities(station, tmp_path):
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    ro = ReadoutOptimization()
+    res = ro.run("Q7", [np.linspace(5.79e9, 5.81e9, 5), np.linspace(0.05, 0.2, 4)], Navg=200, autosave=False)
+    fids = ro.fidelities(res.data)
+    assert fids["fidelity"].dims == ("frequency", "amplitude")
+
+    # Same as assigning every slice to the nearest mean
+    data = res.data.isel(frequency=1, amplitude=2)
+    g, e = data["iq"].sel(state="ground"), data["iq"].sel(state="excited")
+    excited = lambda iq: np.abs(iq - e.mean()) < np.abs(iq - g.mean())
+    fidelity = 0.5 * (float(excited(e).mean()) + 1 - float(excited(g).mean()))
+    assert np.isclose(fids["fidelity"][1, 2], fidelity)
+    assert np.isclose(fids["g_mean"][1, 2], g.mean())
+
+    # The best threshold on the axis through the means does at least as well
+    assert np.all(ro.fidelities(res.data, method="threshold")["fidelity"] >= fids["fidelity"] - 1e-12)
+
+    res.data.to_netcdf(tmp_path / "ro.nc", auto_complex=True)
+    with xr.open_dataset(tmp_path / "ro.nc", auto_complex=True) as lazy:
+        xr.testing.assert_allclose(ro.fidelities(lazy, chunk_size=2), fids)
+    res.analyze()
+
+
+def test_fit_slices(station):
+    frequencies = np.linspace(5.79e9, 5.81e9, 101)
+    f0s = 5.8e9 + 2e6 * np.cos(np.linspace(0, np.pi, 20))
+    rng = np.random.default_rng(0)
+    slices = np.array([notch_res_abs(frequencies, f0, 1e-3, 0.1, 1e6, 0.2e6) for f0 in f0s])
+    slices += rng.normal(0, 1e-5, slices.shape)
+    slices[5] = np.nan
+    p0 = [5.8e9, 1e-3, 0, 1e6, 1e6]
+
+    cold = fit_slices(notch_res_abs, frequencies, slices, p0)
+    warm = fit_slices(notch_res_abs, frequencies, slices, p0, warm_start=True)
+    pooled = fit_slices(notch_res_abs, frequencies, slices, p0, warm_start=True, processes=2)
+    for fits in [cold, warm, pooled]:
+        assert fits.status[5] != "converged" and np.all(np.isnan(fits.params[5]))
+        assert np.sum(fits.converged) == 19
+        np.testing.assert_allclose(fits.params[fits.converged, 0], f0s[fits.converged], atol=5e4)
+    # The second block of the pool starts from p0 again
+    np.testing.assert_allclose(pooled.params[pooled.converged, 0], warm.params[warm.converged, 0], atol=1e3)
+
+    station.qm_manager.simulator = QMSimulator(station, seed=0)
+    res = ReadoutFluxSpectroscopy().run("Q7", [np.linspace(-0.5, 0.5, 8), np.linspace(5.79e9, 5.81e9, 51)], Navg=100, autosave=False)
+    res.analyze(warm_start=True)
+
@@ -22,3 +22,48 @@ def test_qm_config(station):
         station.config["Q7"].X180_amplitude = 0.999
     station.reload_config(["Q7", "Q4"])
     assert station.config["Q7"].X180_amplitude == 0.999
+
+
+def test_unchanged_config_keeps_qm(station):
+    station.reload_config(["Q7"])
+    qm = station.qm
+
+    assert station.reload_config(["Q7"]) == {}
+    assert station.qm is qm
+
+    station.config["Q7"].frequency = 5.9e9
+    diff = station.reload_config(["Q7"])
+    assert diff["elements"]["changed"] == ["drive_Q7"]
+
+    qm = station.qm
+    station.reload_config(["Q7"], force=True)
+    assert station.qm is not qm
+
+
+def test_live_config_updates(station):
+    station.reload_config(["Q7", "Q4"])
+    qm = station.qm
+    open_count = station.qm_manager.open_count
+
+    station.config["Q7"].frequency = 5.9e9
+    station.config["Q4"].flux.dc_volt = 0.1
+    station.config["Q4"].drive.gain = -10
+    station.reload_config(["Q7", "Q4"])
+    assert station.last_load == "live"
+    assert station.qm is qm
+    assert station.qm_manager.open_count == open_count
+    assert ("intermediate_frequency", "drive_Q7", 5.9e9 - 6e9) in qm.live_updates
+    assert ("dc_offset", "flux_Q4", 0.1) in qm.live_updates
+    assert ("gain", "drive_Q4", -10) in qm.live_updates
+
+    station.config["PL"]["LO_frequency"] = 6.1e9
+    station.reload_config(["Q7", "Q4"])
+    assert station.last_load == "live"
+    assert ("LO_frequency", "resonator_Q7", 6.1e9) in qm.live_updates
+    assert ("downconversion_LO_frequency", "resonator_Q7", 6.1e9) in qm.live_updates
+
+    # New elements need the QM to be reopened
+    station.reload_config(["Q7", "Q4", "Q3"])
+    assert station.last_load == "reopen"
+    assert station.qm is not qm
+    assert station.qm_manager.open_count == open_count + 1